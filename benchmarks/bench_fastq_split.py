@@ -0,0 +1,101 @@
+"""
+Benchmarks FASTQ demultiplexing throughput (read pairs per second) of the raw byte-level scanner used by fastq_split
+against the previous pysam.FastxFile-based path.
+
+Usage: python benchmarks/bench_fastq_split.py [--reads N] [--processes P]
+"""
+
+import argparse
+import gzip
+import random
+import re
+import tempfile
+import time
+
+import pysam
+
+from pathlib import Path
+
+from lougheed_gtseq.barcodes import I7_BARCODES, I5_BARCODES, get_i7_barcode, get_i5_barcode
+from lougheed_gtseq.models import Sample
+from lougheed_gtseq.steps.fastq_split import fastq_split
+
+READ_INDEX_PATTERN = re.compile(r"^[ACGT]{6}\+[ACGT]{6}$")
+
+
+def make_samples() -> list[Sample]:
+    i5s = list(I5_BARCODES.keys())
+    return [
+        Sample(sample_id=f"S{i}", batch="BENCH", plate=1 + i // 96, i7=1 + i // 96, i5=i5s[i % 96]) for i in range(384)
+    ]
+
+
+def write_reads(samples: list[Sample], out_dir: Path, n_reads: int) -> tuple[Path, Path]:
+    rng = random.Random(42)
+    indices = [f"{get_i7_barcode(s.i7)}+{get_i5_barcode(s.i5)}" for s in samples]
+    indices.append(f"{I7_BARCODES[1]}+NNNNNN")  # some unassignable reads
+
+    r1, r2 = out_dir / "bench_R1.fastq.gz", out_dir / "bench_R2.fastq.gz"
+    with gzip.open(r1, "wt", compresslevel=1) as fh1, gzip.open(r2, "wt", compresslevel=1) as fh2:
+        for i in range(n_reads):
+            index = rng.choice(indices)
+            name = f"M04106:147:000000000-M245M:1:1101:{10000 + i % 20000}:{1000 + i // 20000}"
+            seq = "".join(rng.choices("ACGT", k=150))
+            fh1.write(f"@{name} 1:N:0:{index}\n{seq}\n+\n{'F' * 150}\n")
+            fh2.write(f"@{name} 2:N:0:{index}\n{seq[::-1]}\n+\n{'F' * 150}\n")
+
+    return r1, r2
+
+
+def split_file_pysam(samples: list[Sample], fq_path: Path, split_dir: Path, suffix: str):
+    # Previous implementation: one pass per file, through pysam records, a regex and re-serialization of each read
+    index_seqs_lookup = {f"{get_i7_barcode(s.i7)}+{get_i5_barcode(s.i5)}": i for i, s in enumerate(samples)}
+    handles = {}
+    try:
+        with pysam.FastxFile(str(fq_path)) as fq:
+            for read in fq:
+                read_index = read.comment.split(":")[-1]
+                if not READ_INDEX_PATTERN.match(read_index) or read_index not in index_seqs_lookup:
+                    continue
+                si = index_seqs_lookup[read_index]
+                if si not in handles:
+                    handles[si] = open(split_dir / f"GTSeq_{samples[si].full_name()}_{suffix}.fastq", "w")
+                handles[si].write(str(read) + "\n")
+    finally:
+        for fh in handles.values():
+            fh.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--reads", type=int, default=500000, help="Number of read pairs to generate.")
+    parser.add_argument("--processes", type=int, default=1, help="Processes for the scanner-based split.")
+    args = parser.parse_args()
+
+    samples = make_samples()
+
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        r1, r2 = write_reads(samples, td, args.reads)
+
+        pysam_dir = td / "pysam"
+        pysam_dir.mkdir()
+        start = time.perf_counter()
+        split_file_pysam(samples, r1, pysam_dir, "R1")
+        split_file_pysam(samples, r2, pysam_dir, "R2")
+        pysam_time = time.perf_counter() - start
+
+        scanner_dir = td / "scanner"
+        scanner_dir.mkdir()
+        start = time.perf_counter()
+        fastq_split(samples, scanner_dir, (r1, r2), processes=args.processes)
+        scanner_time = time.perf_counter() - start
+
+    print(f"read pairs:          {args.reads}")
+    print(f"pysam path:          {args.reads / pysam_time:12.0f} read pairs/s ({pysam_time:.2f}s)")
+    print(f"byte scanner (p={args.processes}): {args.reads / scanner_time:12.0f} read pairs/s ({scanner_time:.2f}s)")
+    print(f"speedup:             {pysam_time / scanner_time:12.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Benchmarks panel genotyping speed of the native (pysam + NumPy) genotyper against bcftools mpileup | bcftools call on
+synthetic BAMs with known genotypes, and reports genotype concordance between the two backends and with the truth.
+Requires bcftools on the PATH.
+
+Usage: python benchmarks/bench_genotyper.py [--sites N] [--samples M] [--depth D] [--processes P]
+"""
+
+import argparse
+import random
+import tempfile
+import time
+
+import numpy as np
+import pysam
+
+from pathlib import Path
+
+from lougheed_gtseq.genotyper import genotype_panel
+from lougheed_gtseq.steps.call_alleles import _pileup_and_call
+
+CONTIG_LENGTH = 200000
+READ_LENGTH = 120
+
+
+def write_reference(out_dir: Path, n_contigs: int, rng: random.Random) -> tuple[Path, dict[str, str]]:
+    seqs = {f"chr{i + 1}": "".join(rng.choices("ACGT", k=CONTIG_LENGTH)) for i in range(n_contigs)}
+    ref = out_dir / "ref.fa"
+    with open(ref, "w") as fh:
+        for name, seq in seqs.items():
+            fh.write(f">{name}\n")
+            fh.writelines(f"{seq[i : i + 80]}\n" for i in range(0, len(seq), 80))
+    pysam.faidx(str(ref))
+    return ref, seqs
+
+
+def write_panel(out_dir: Path, seqs: dict[str, str], n_sites: int, rng: random.Random) -> tuple[Path, list]:
+    per_contig = n_sites // len(seqs) + 1
+    sites = []
+    for contig, seq in seqs.items():
+        for pos in sorted(rng.sample(range(1000, CONTIG_LENGTH - 1000, 1000), per_contig)):
+            ref_base = seq[pos - 1]
+            sites.append((contig, pos, ref_base, rng.choice([b for b in "ACGT" if b != ref_base])))
+    sites = sites[:n_sites]
+
+    panel = out_dir / "panel.tsv"
+    with open(panel, "w") as fh:
+        fh.writelines(f"{contig}\t{pos}\t{ref},{alt}\n" for contig, pos, ref, alt in sites)
+    return panel, sites
+
+
+def write_bam(bam: Path, seqs: dict[str, str], sites: list, genotypes: list[int], depth: float, rng: random.Random):
+    header = {"HD": {"VN": "1.6", "SO": "coordinate"}, "SQ": [{"SN": c, "LN": len(s)} for c, s in seqs.items()]}
+    contig_ids = {c: i for i, c in enumerate(seqs)}
+    reads = []
+
+    for (contig, pos, ref, alt), gt in zip(sites, genotypes):
+        for ri in range(np.random.default_rng(rng.getrandbits(32)).poisson(depth)):
+            start = pos - 1 - rng.randrange(10, READ_LENGTH - 10)
+            seq = list(seqs[contig][start : start + READ_LENGTH])
+            seq[pos - 1 - start] = alt if rng.random() < gt / 2 else ref
+            quals = [rng.randint(15, 40) for _ in seq]
+            for i, q in enumerate(quals):  # sequencing errors at the rate given by each base quality
+                if rng.random() < 10 ** (-q / 10):
+                    seq[i] = rng.choice([b for b in "ACGT" if b != seq[i]])
+            reads.append((contig_ids[contig], start, f"{contig}_{pos}_{ri}", "".join(seq), quals))
+
+    with pysam.AlignmentFile(str(bam), "wb", header=header) as bf:
+        for ref_id, start, name, seq, quals in sorted(reads):
+            a = pysam.AlignedSegment(bf.header)
+            a.query_name = name
+            a.reference_id = ref_id
+            a.reference_start = start
+            a.cigarstring = f"{READ_LENGTH}M"
+            a.mapping_quality = 60
+            a.query_sequence = seq
+            a.query_qualities = pysam.qualitystring_to_array("".join(chr(q + 33) for q in quals))
+            bf.write(a)
+    pysam.index(str(bam))
+
+
+def read_genotypes(vcf: Path) -> dict[tuple[str, int], list[int | None]]:
+    with pysam.VariantFile(str(vcf)) as vf:
+        return {
+            (rec.contig, rec.pos): [None if s["GT"][0] is None else sum(s["GT"]) for s in rec.samples.values()]
+            for rec in vf
+        }
+
+
+def concordance(a: dict, b: dict) -> tuple[int, int]:
+    pairs = [(x, y) for key in a.keys() & b.keys() for x, y in zip(a[key], b[key]) if x is not None and y is not None]
+    return sum(x == y for x, y in pairs), len(pairs)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sites", type=int, default=320, help="Number of panel sites.")
+    parser.add_argument("--samples", type=int, default=24, help="Number of samples (BAMs).")
+    parser.add_argument("--depth", type=float, default=30, help="Mean read depth per site and sample.")
+    parser.add_argument("--processes", type=int, default=1, help="Processes for the native genotyper.")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        ref, seqs = write_reference(td, 4, rng)
+        panel, sites = write_panel(td, seqs, args.sites, rng)
+
+        truth = {}
+        bams = []
+        for si in range(args.samples):
+            genotypes = [rng.choice((0, 1, 1, 2)) for _ in sites]
+            bam = td / f"S{si}.bam"
+            # Some samples are sequenced poorly, to exercise low-depth calls
+            write_bam(bam, seqs, sites, genotypes, args.depth if si % 4 else args.depth / 6, rng)
+            bams.append(bam)
+            for (contig, pos, *_), gt in zip(sites, genotypes):
+                truth.setdefault((contig, pos), []).append(gt)
+
+        bam_list = td / "bams.txt"
+        bam_list.write_text("".join(f"{bam}\n" for bam in bams))
+
+        start = time.perf_counter()
+        _pileup_and_call(ref, bam_list, panel, td / "bcftools.vcf", indexed_regions=False)
+        bcftools_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        genotype_panel(ref, bams, panel, td / "native.vcf", args.processes)
+        native_time = time.perf_counter() - start
+
+        bcftools_gts = read_genotypes(td / "bcftools.vcf")
+        native_gts = read_genotypes(td / "native.vcf")
+
+    n_agree, n_both = concordance(bcftools_gts, native_gts)
+    bcftools_truth, bcftools_n = concordance(bcftools_gts, truth)
+    native_truth, native_n = concordance(native_gts, truth)
+
+    print(f"sites x samples:     {args.sites} x {args.samples} (mean depth {args.depth})")
+    print(f"bcftools:            {bcftools_time:8.2f}s ({len(bcftools_gts)} variant sites)")
+    print(f"native (p={args.processes}):        {native_time:8.2f}s ({len(native_gts)} variant sites)")
+    print(f"speedup:             {bcftools_time / native_time:8.1f}x")
+    print(f"concordance:         {n_agree / n_both:8.2%} of {n_both} genotypes called by both")
+    print(f"bcftools vs truth:   {bcftools_truth / bcftools_n:8.2%} of {bcftools_n}")
+    print(f"native vs truth:     {native_truth / native_n:8.2%} of {native_n}")
+
+
+if __name__ == "__main__":
+    main()
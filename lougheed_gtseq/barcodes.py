@@ -1,4 +1,5 @@
 import functools
+import numpy as np
 import re
 
 __all__ = [
@@ -8,6 +9,11 @@ __all__ = [
     "I5_BARCODES",
     "normalize_i5_coordinate",
     "get_i5_barcode",
+    "INDEX_NO_MATCH",
+    "INDEX_AMBIGUOUS",
+    "encode_index_pair",
+    "build_index_table",
+    "lookup_index_fields",
 ]
 
 # "Barcode (on sample sheet)"
@@ -166,3 +172,113 @@ def normalize_i5_coordinate(coordinate: str):
 @functools.cache
 def get_i5_barcode(coordinate: str):
     return I5_BARCODES[normalize_i5_coordinate(coordinate)]
+
+
+# -- Index pair lookup tables ------------------------------------------------------------------------------------------
+
+INDEX_NO_MATCH = -1
+INDEX_AMBIGUOUS = -2
+
+INDEX_LENGTH = 6
+INDEX_PAIR_LENGTH = INDEX_LENGTH * 2
+INDEX_TABLE_SIZE = 4**INDEX_PAIR_LENGTH  # one entry for every possible 2-bit-encoded 6+6 bp index pair
+
+BASES = "ACGT"
+
+# Byte value --> 2-bit base code; anything other than A/C/G/T (e.g., N) is -1, and counts as a mismatch in lookups.
+BASE_CODES = np.full(256, -1, dtype=np.int8)
+for _code, _base in enumerate(BASES):
+    BASE_CODES[ord(_base)] = _code
+
+# Weights to turn an array of 12 2-bit base codes into an integer, most significant (first) base first.
+INDEX_PAIR_WEIGHTS = 4 ** np.arange(INDEX_PAIR_LENGTH - 1, -1, -1, dtype=np.int64)
+
+# Offsets of the 12 index bases within an i7+i5 field, i.e., skipping the + separator
+INDEX_FIELD_OFFSETS = np.array([*range(INDEX_LENGTH), *range(INDEX_LENGTH + 1, INDEX_PAIR_LENGTH + 1)], dtype=np.int64)
+INDEX_FIELD_LENGTH = INDEX_PAIR_LENGTH + 1
+
+
+def encode_index_pair(i7: str, i5: str) -> int:
+    seq = i7 + i5
+    if len(i7) != INDEX_LENGTH or len(i5) != INDEX_LENGTH or any(b not in BASES for b in seq):
+        raise ValueError(f"Invalid index pair: {i7}+{i5}")
+
+    code = 0
+    for b in seq:
+        code = (code << 2) | BASES.index(b)
+    return code
+
+
+def build_index_table(index_pairs: dict[tuple[str, str], int], max_mismatches: int = 1) -> np.ndarray:
+    """
+    Builds an array-backed lookup table of every 2-bit-encoded i7+i5 index pair to a sample index. Index pairs within
+    max_mismatches (0 or 1) of a sample's barcodes are assigned to that sample; pairs which are within one mismatch of
+    more than one sample's barcodes are marked as INDEX_AMBIGUOUS. Exact matches always take precedence.
+    :param index_pairs: dictionary of (i7 sequence, i5 sequence) to sample index.
+    :param max_mismatches: maximum Hamming distance (0 or 1) from a barcode pair to assign a read to a sample.
+    :return: an int16 array of length 4^12 holding a sample index, INDEX_NO_MATCH, or INDEX_AMBIGUOUS for each pair.
+    """
+
+    if max_mismatches not in (0, 1):
+        raise ValueError(f"Unsupported number of index mismatches: {max_mismatches}")
+
+    if len(index_pairs) > np.iinfo(np.int16).max:
+        raise ValueError(f"Too many index pairs for lookup table: {len(index_pairs)}")
+
+    table = np.full(INDEX_TABLE_SIZE, INDEX_NO_MATCH, dtype=np.int16)
+    exact_codes = {encode_index_pair(i7, i5): si for (i7, i5), si in index_pairs.items()}
+
+    if max_mismatches == 1:
+        for code, si in exact_codes.items():
+            for pos in range(INDEX_PAIR_LENGTH):
+                shift = 2 * (INDEX_PAIR_LENGTH - 1 - pos)
+                base = (code >> shift) & 0b11
+                for sub in range(4):
+                    if sub == base:
+                        continue
+                    neighbour = code ^ ((base ^ sub) << shift)
+                    current = table[neighbour]
+                    table[neighbour] = si if current in (INDEX_NO_MATCH, si) else INDEX_AMBIGUOUS
+
+    for code, si in exact_codes.items():
+        table[code] = si
+
+    return table
+
+
+def lookup_index_fields(table: np.ndarray, buf: np.ndarray, field_ends: np.ndarray) -> np.ndarray:
+    """
+    Looks up a batch of 13-byte i7+i5 index fields (e.g., ATCACG+AAACGG) in a table made by build_index_table.
+    :param table: index lookup table from build_index_table.
+    :param buf: uint8 array holding the raw bytes containing the index fields.
+    :param field_ends: positions in buf immediately after the end of each index field.
+    :return: an array of sample indices, with INDEX_NO_MATCH for malformed fields or fields which cannot be resolved.
+    """
+
+    field_starts = field_ends - INDEX_FIELD_LENGTH
+    valid = field_starts >= 0
+    field_starts = np.where(valid, field_starts, 0)
+
+    valid &= buf[field_starts + INDEX_LENGTH] == ord("+")
+    # bcl2fastq puts the index sequences after the final colon in the read comment
+    valid &= buf[np.maximum(field_starts - 1, 0)] == ord(":")
+
+    codes = BASE_CODES[buf[field_starts[:, np.newaxis] + INDEX_FIELD_OFFSETS]]
+    unknown = codes < 0
+    valid &= unknown.sum(axis=1) <= 1
+
+    codes = np.where(valid[:, np.newaxis] & ~unknown, codes, 0)
+    sample_indices = table[codes @ INDEX_PAIR_WEIGHTS]
+
+    # A single N (or other non-ACGT base) counts as one mismatch: the field is resolved only if every base in its place
+    # looks up the same sample, i.e., the other 11 bases are within max_mismatches - 1 of exactly one sample's barcodes.
+    if (has_unknown := valid & unknown.any(axis=1)).any():
+        unknown_weights = unknown[has_unknown] @ INDEX_PAIR_WEIGHTS
+        unknown_codes = codes[has_unknown] @ INDEX_PAIR_WEIGHTS
+        candidates = table[unknown_codes[:, np.newaxis] + unknown_weights[:, np.newaxis] * np.arange(len(BASES))]
+        sample_indices[has_unknown] = np.where(
+            (candidates == candidates[:, :1]).all(axis=1), candidates[:, 0], INDEX_NO_MATCH
+        )
+
+    sample_indices[~valid] = INDEX_NO_MATCH
+    return sample_indices
@@ -1,27 +1,99 @@
+import heapq
+import itertools
 import sys
-from csv import DictReader, DictWriter
+import tempfile
+from contextlib import ExitStack
+from csv import DictReader, DictWriter, reader as csv_reader
 from pathlib import Path
+from typing import Iterator, TextIO
 
-__all__ = ["combine_sex_markers"]
+__all__ = [
+    "COMBINE_SEX_MARKERS_RUN_ROWS",
+    "COMBINE_SEX_MARKERS_MAX_OPEN_RUNS",
+    "union_header",
+    "combine_sex_markers",
+]
 
+# Rows per sorted run spilled to disk; this (and the number of runs open at once) bounds memory use
+COMBINE_SEX_MARKERS_RUN_ROWS = 50_000
+# Maximum number of runs merged at once; more runs are merged in several passes
+COMBINE_SEX_MARKERS_MAX_OPEN_RUNS = 128
 
-def combine_sex_markers(files: list[Path]):
+SORT_KEY = "Sample"
+
+
+def union_header(files: list[Path]) -> list[str]:
+    """
+    Union of the header fields of several CSV files, in order of first appearance.
     """
-    Combines sex genotypes from multiple different batches into a single file.
+    fields: dict[str, None] = {}
+    for file in files:
+        with open(file, "r", newline="") as fh:
+            fields.update((f, None) for f in next(csv_reader(fh), []))
+    return list(fields)
+
+
+def _sort_key(record: dict) -> str:
+    return record[SORT_KEY]
+
+
+def _read_records(fh: TextIO) -> Iterator[dict]:
+    for record in DictReader(fh):
+        if None in record:  # extra values without a header field
+            del record[None]
+        yield record
+
+
+def _write_run(tmp_dir: Path, fieldnames: list[str], records: list[dict]) -> Path:
+    fd, path = tempfile.mkstemp(suffix=".csv", dir=tmp_dir)
+    with open(fd, "w", newline="") as fh:
+        writer = DictWriter(fh, fieldnames=fieldnames, restval="")
+        writer.writeheader()
+        writer.writerows(records)
+    return Path(path)
+
+
+def _merge(runs: list[Path], fieldnames: list[str], out: TextIO):
+    # heapq.merge is stable: records with equal keys come out in run order, i.e. in input file/row order
+    with ExitStack() as stack:
+        readers = [_read_records(stack.enter_context(open(run, "r", newline=""))) for run in runs]
+        writer = DictWriter(out, fieldnames=fieldnames, restval="")
+        writer.writeheader()
+        writer.writerows(heapq.merge(*readers, key=_sort_key))
+
+
+def combine_sex_markers(files: list[Path], out: TextIO | None = None):
+    """
+    Combines sex genotypes from multiple different batches into a single file, sorted by sample, using an external
+    merge sort: each input is split into sorted runs on disk, which are then k-way merged, so memory use stays bounded
+    no matter how many batches are combined. The output header is the union of all input headers; records are padded
+    with empty values for fields their file lacks.
     :param files: A list of CSV files, output from Nate Campbell's GTseq pipeline.
+    :param out: File handle to write the combined CSV to (default: stdout.)
     """
-    records = []
 
-    for file in files:
-        with open(file, "r") as fh:
-            reader = DictReader(fh)
-            for record in reader:
-                if None in record:
-                    del record[None]
-                records.append(record)
-
-    records.sort(key=lambda r: r["Sample"])
-
-    writer = DictWriter(sys.stdout, fieldnames=list(records[0].keys()))
-    writer.writeheader()
-    writer.writerows(records)
+    fieldnames = union_header(files)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        runs: list[Path] = []
+        for file in files:
+            with open(file, "r", newline="") as fh:
+                records = _read_records(fh)
+                while chunk := list(itertools.islice(records, COMBINE_SEX_MARKERS_RUN_ROWS)):
+                    runs.append(_write_run(Path(tmp_dir), fieldnames, sorted(chunk, key=_sort_key)))
+
+        # Merge runs in passes of at most COMBINE_SEX_MARKERS_MAX_OPEN_RUNS until they can all be merged at once;
+        # consecutive runs are merged together so that ties stay in input order.
+        while len(runs) > COMBINE_SEX_MARKERS_MAX_OPEN_RUNS:
+            merged_runs = []
+            for i in range(0, len(runs), COMBINE_SEX_MARKERS_MAX_OPEN_RUNS):
+                group = runs[i : i + COMBINE_SEX_MARKERS_MAX_OPEN_RUNS]
+                fd, path = tempfile.mkstemp(suffix=".csv", dir=tmp_dir)
+                with open(fd, "w", newline="") as fh:
+                    _merge(group, fieldnames, fh)
+                for run in group:
+                    run.unlink()
+                merged_runs.append(Path(path))
+            runs = merged_runs
+
+        _merge(runs, fieldnames, out or sys.stdout)
@@ -0,0 +1,105 @@
+import struct
+import zlib
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, Literal
+
+__all__ = [
+    "Compression",
+    "BGZF_EOF",
+    "bgzf_compress",
+    "BgzfWriter",
+    "BgzfWriterPool",
+]
+
+Compression = Literal["none", "bgzf"]
+
+# Maximum uncompressed payload of a single BGZF block; same value used by htslib.
+BGZF_BLOCK_DATA_SIZE = 0xFF00
+
+# Empty BGZF block which marks the end of a BGZF file; see the SAM specification, section 4.1.2.
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+# gzip header with the FEXTRA flag set and a 'BC' extra subfield holding the total block size minus 1
+_BGZF_HEADER = struct.Struct("<4BI2BH2BHH")
+
+
+def bgzf_compress(data: bytes, level: int = 6) -> bytes:
+    """
+    Compresses data into one or more independent BGZF blocks, which are valid (multi-member) gzip as well.
+    Compression happens inside zlib, which releases the GIL, so this can be run from multiple threads at once.
+    """
+
+    blocks = []
+
+    for offset in range(0, len(data), BGZF_BLOCK_DATA_SIZE):
+        chunk = data[offset : offset + BGZF_BLOCK_DATA_SIZE]
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        deflated = compressor.compress(chunk) + compressor.flush()
+        block_size = _BGZF_HEADER.size + len(deflated) + 8
+        blocks.append(_BGZF_HEADER.pack(0x1F, 0x8B, 8, 4, 0, 0, 0xFF, 6, ord("B"), ord("C"), 2, block_size - 1))
+        blocks.append(deflated)
+        blocks.append(struct.pack("<II", zlib.crc32(chunk), len(chunk)))
+
+    return b"".join(blocks)
+
+
+class BgzfWriter:
+    def __init__(self, path: Path, pool: "BgzfWriterPool"):
+        self._fh: BinaryIO = open(path, "wb")
+        self._pool = pool
+        self._buf: list[bytes] = []
+        self._buf_size = 0
+        self._pending: deque[Future] = deque()
+
+    def _drain(self, max_pending: int):
+        # Write out compressed blocks in the order they were submitted. Blocks which are already compressed are written
+        # right away; we only wait on compression if too many blocks are in flight for this file.
+        while self._pending and (self._pending[0].done() or len(self._pending) > max_pending):
+            self._fh.write(self._pending.popleft().result())
+
+    def _submit(self):
+        if self._buf:
+            self._pending.append(self._pool.executor.submit(bgzf_compress, b"".join(self._buf), self._pool.level))
+            self._buf.clear()
+            self._buf_size = 0
+
+    def write(self, data: bytes):
+        self._buf.append(data)
+        self._buf_size += len(data)
+        if self._buf_size >= self._pool.batch_size:
+            self._submit()
+        self._drain(self._pool.max_pending)
+
+    def close(self):
+        self._submit()
+        self._drain(0)
+        self._fh.write(BGZF_EOF)
+        self._fh.close()
+
+
+class BgzfWriterPool:
+    """
+    Opens BGZF-compressed output files whose data is compressed by a shared pool of background threads, so that the
+    code producing the data does not have to wait on zlib. Data written to each file stays in order.
+    """
+
+    def __init__(self, threads: int, level: int = 6, batch_size: int = 4 * BGZF_BLOCK_DATA_SIZE, max_pending: int = 8):
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="bgzf")
+        self.level = level
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+
+    def open(self, path: Path) -> BgzfWriter:
+        return BgzfWriter(path, self)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
@@ -22,7 +22,7 @@ def cmd_pipeline(args):
             )
             exit(1)
 
-        if not gtseq_scripts_path.exists():
+        if args.sex_genotyper == "perl" and not gtseq_scripts_path.exists():
             print(
                 "--gtseq-scripts must point to a directory containing the contents of the "
                 "https://github.com/GTseq/GTseq-Pipeline/ repository.",
@@ -36,16 +36,28 @@ def cmd_pipeline(args):
         batch=args.batch,
         run=args.run if r2 is None else (args.run, args.r2),
         samples=args.samples,
+        index_mismatches=args.index_mismatches,
+        split_compression=args.split_compression,
+        align_mode=args.align_mode,
+        align_reference=args.align_reference,
+        panel_bams=args.panel_bams,
+        genotyper=args.genotyper,
+        genotype_shards=args.genotype_shards,
+        pileup_cache=args.pileup_cache,
         call_sex=call_sex,
+        sex_genotyper=args.sex_genotyper,
         gtseq_scripts=args.gtseq_scripts,
         min_dp=args.min_dp,
         min_gq=args.min_gq,
         min_called_prop=args.min_called_prop,
         het_sigma=args.het_sigma,
         drop_failed_samples=args.drop_failed,
+        plots=args.plots,
         vcf=args.vcf,
         sex_calls=args.sex_calls,
         continue_run=args.continue_run,
+        step_cache=not args.no_step_cache,
+        step_cache_hash=args.step_cache_hash,
         genomes=args.genomes,
         processes=args.processes,
     )
@@ -65,13 +77,20 @@ def cmd_qc(args):
         args.min_called_prop,
         args.het_sigma,
         args.drop_failed,
+        args.plots,
     )
 
 
+def cmd_qc_sweep(args):
+    from .qc_sweep import run_qc_sweep
+
+    run_qc_sweep(args.vcf, args.min_dp, args.min_gq, args.min_called_prop, args.het_sigma, args.out)
+
+
 def cmd_snp_success(args):
     from .snp_success import run_snp_success
 
-    run_snp_success(args.vcf)
+    run_snp_success(args.vcf, args.out, args.processes, args.plots)
 
 
 def cmd_reheader(args):
@@ -87,6 +106,41 @@ def cmd_combine_sex_markers(args):
     combine_sex_markers(args.csv)
 
 
+def cmd_ref(args):
+    from .genome_cache import BWA_INDEX_EXTENSIONS, verify_cached_files
+    from .steps.amplicon_ref import amplicon_reference_file_for, build_amplicon_reference_if_needed
+    from .steps.download_ref import GENOME_INDEX_EXTENSIONS, ensure_genome, genome_file_for
+
+    genome_file = genome_file_for(args.species, args.genomes)
+
+    if args.action == "prewarm":
+        genome_file = ensure_genome(args.species, args.genomes, args.processes, full_check=True)
+        if args.amplicons:
+            build_amplicon_reference_if_needed(args.species, genome_file, full_check=True)
+        return
+
+    # verify
+    if not args.genomes.is_dir():
+        print(f"{args.genomes}: no genomes installed (run 'ref prewarm' to download and build them)", file=sys.stderr)
+        exit(1)
+
+    to_check = [(genome_file, GENOME_INDEX_EXTENSIONS)]
+    if args.amplicons:
+        to_check.append((amplicon_reference_file_for(args.species, genome_file), BWA_INDEX_EXTENSIONS))
+
+    ok = True
+    for main_file, extensions in to_check:
+        if problems := verify_cached_files(main_file, extensions):
+            ok = False
+            for path, problem in problems.items():
+                print(f"{path}: {problem}", file=sys.stderr)
+        else:
+            print(f"{main_file}: OK")
+
+    if not ok:
+        exit(1)
+
+
 QC_DEFAULT_MIN_DP: int = 6
 QC_DEFAULT_MIN_GQ: int = 18
 QC_DEFAULT_MIN_CALLED_PROP: float = 0.75
@@ -123,6 +177,19 @@ def _add_qc_args(subparser):
         action="store_true",
         help="Whether to exclude samples which fail the QC threshold for loci called.",
     )
+    _add_plots_arg(subparser)
+
+
+def _add_plots_arg(subparser):
+    subparser.add_argument(
+        "--plots",
+        choices=("none", "terminal", "png"),
+        default="png",
+        help=(
+            "Plot output: none, text histograms in the terminal, or text histograms plus PNG figures (written next "
+            "to the VCF, rendered in the background.)"
+        ),
+    )
 
 
 def main():
@@ -152,6 +219,15 @@ def main():
         default=Path.cwd() / "GTseq-Pipeline",
         help="Directory holding GTseq pipeline scripts from Campbell et al.",
     )
+    run_parser.add_argument(
+        "--sex-genotyper",
+        choices=("perl", "native"),
+        default="perl",
+        help=(
+            "Sex-linked marker genotyper: the Campbell et al. Perl scripts (requires --gtseq-scripts), or an "
+            "in-process re-implementation of them which does not need Perl."
+        ),
+    )
     run_parser.add_argument(
         "--no-sex-calls",
         action="store_true",
@@ -162,8 +238,95 @@ def main():
         type=Path,
         help="Location for shared reference genome resources. Downloaded genomes will be put here.",
     )
+    run_parser.add_argument(
+        "--index-mismatches",
+        type=int,
+        choices=(0, 1),
+        default=1,
+        help="Maximum number of mismatches between read index sequences and sample barcodes when demultiplexing.",
+    )
+    run_parser.add_argument(
+        "--split-compression",
+        type=str,
+        choices=("none", "bgzf"),
+        default="none",
+        help="Compression for demultiplexed per-sample FASTQs. BGZF output is compressed in background threads.",
+    )
+    run_parser.add_argument(
+        "--align-mode",
+        type=str,
+        choices=("sample", "batch", "batch-split"),
+        default="sample",
+        help=(
+            "How to run read alignment: one bwa process per sample, or one bwa process for the whole batch, producing "
+            "a single multi-sample BAM (batch) or per-sample BAMs split by read group (batch-split)."
+        ),
+    )
+    run_parser.add_argument(
+        "--align-reference",
+        type=str,
+        choices=("genome", "amplicons"),
+        default="genome",
+        help=(
+            "Reference to align reads to: the full genome, or a small cached reference built from windows around the "
+            "panel's sites (much faster; alignments are lifted back to genome coordinates.) Since the rest of the "
+            "genome is absent, reads from off-target paralogous regions may be placed on amplicons."
+        ),
+    )
+    run_parser.add_argument(
+        "--panel-bams",
+        action="store_true",
+        help=(
+            "Only keep alignments overlapping the species panel's amplicons in BAMs, which makes sorting, indexing "
+            "and allele calling faster and BAMs smaller. Off-target and unplaced reads are dropped."
+        ),
+    )
+    run_parser.add_argument(
+        "--genotyper",
+        choices=("bcftools", "native"),
+        default="bcftools",
+        help=(
+            "Genotype calling backend: bcftools mpileup | bcftools call, or an in-process pileup and vectorised "
+            "genotype caller specialized for the panel's biallelic SNPs. Genotypes are highly concordant, but "
+            "likelihoods and qualities differ slightly. --genotype-shards and --pileup-cache only apply to bcftools."
+        ),
+    )
+    run_parser.add_argument(
+        "--genotype-shards",
+        type=int,
+        default=1,
+        help=(
+            "Split the panel into this many region shards and genotype them concurrently (up to --processes at a "
+            "time), using BAM indices to jump to each shard's sites. 1 genotypes the whole panel in one pass."
+        ),
+    )
+    run_parser.add_argument(
+        "--pileup-cache",
+        action="store_true",
+        help=(
+            "Cache per-BAM pileups (allele depths, read depths and genotype likelihoods at the panel sites) in the "
+            "work directory, keyed by BAM checksum, and call genotypes jointly from them. Only new or changed BAMs are "
+            "piled up again when re-running or extending a batch. Takes the place of --genotype-shards."
+        ),
+    )
     run_parser.add_argument("--processes", "-p", type=int, help="Number of processes to use.", default=4)
     run_parser.add_argument("--continue-run", type=Path, help="Continue/restart an existing run.")
+    run_parser.add_argument(
+        "--no-step-cache",
+        action="store_true",
+        help=(
+            "Run every step, rather than re-using results of steps whose parameters, inputs and code are unchanged "
+            "from any previous run in the work directory."
+        ),
+    )
+    run_parser.add_argument(
+        "--step-cache-hash",
+        action="store_true",
+        help=(
+            "Fingerprint step input files by their contents (SHA-256) for the step cache, rather than by path, size "
+            "and modification time. Slower, but survives copying or touching input files."
+        ),
+    )
     run_parser.add_argument("batch", type=str, help="Batch ID (e.g., APR2025).")
     run_parser.add_argument(
         "run",
@@ -195,6 +358,72 @@ def main():
 
     # ------------------------------------------------------------------------------------------------------------------
 
+    ref_parser = subparsers.add_parser("ref", help="Verify or pre-build the shared reference genome cache.")
+    ref_parser.add_argument(
+        "action",
+        type=str,
+        choices=("verify", "prewarm"),
+        help=(
+            "verify: check that all cached reference files are present and match their checksums. prewarm: download "
+            "and/or (re-)build any missing or invalid reference files ahead of a run."
+        ),
+    )
+    ref_parser.add_argument(
+        "--species",
+        type=str,
+        help="Species/GTseq panel to prepare the reference for.",
+        choices=("polar",),
+        required=True,
+    )
+    ref_parser.add_argument(
+        "--genomes",
+        type=Path,
+        default=Path.cwd() / "ref",
+        help="Location for shared reference genome resources.",
+    )
+    ref_parser.add_argument(
+        "--amplicons",
+        action="store_true",
+        help="Include the amplicon mini-reference used by --align-reference amplicons.",
+    )
+    ref_parser.add_argument("--processes", "-p", type=int, help="Number of processes to use.", default=4)
+    ref_parser.set_defaults(func=cmd_ref)
+
+    # ------------------------------------------------------------------------------------------------------------------
+
+    qc_sweep_parser = subparsers.add_parser(
+        "qc-sweep",
+        help=(
+            "Evaluate QC over a grid of thresholds, reporting sample pass/fail counts and heterozygosity bounds for "
+            "each parameter set. The VCF is parsed once into a cached genotype matrix (<vcf>.gtmatrix.npz.)"
+        ),
+    )
+    qc_sweep_parser.add_argument("vcf", type=Path, help="VCF to evaluate QC thresholds for.")
+    qc_sweep_parser.add_argument(
+        "--min-dp", type=int, nargs="+", default=[0, 5, 10, QC_DEFAULT_MIN_DP, 20, 30], help="Minimum read depths."
+    )
+    qc_sweep_parser.add_argument(
+        "--min-gq", type=int, nargs="+", default=[0, 10, QC_DEFAULT_MIN_GQ, 20, 30], help="Minimum genotype qualities."
+    )
+    qc_sweep_parser.add_argument(
+        "--min-called-prop",
+        type=float,
+        nargs="+",
+        default=[0.5, 0.6, 0.7, QC_DEFAULT_MIN_CALLED_PROP, 0.8, 0.9],
+        help="Minimum proportions of successfully-called loci.",
+    )
+    qc_sweep_parser.add_argument(
+        "--het-sigma",
+        type=float,
+        nargs="+",
+        default=[1, QC_DEFAULT_HET_SIGMA, 3],
+        help="Numbers of standard deviations from the mean heterozygosity.",
+    )
+    qc_sweep_parser.add_argument("--out", type=Path, help="Output CSV file for the results table (default: stdout.)")
+    qc_sweep_parser.set_defaults(func=cmd_qc_sweep)
+
+    # ------------------------------------------------------------------------------------------------------------------
+
     reheader_parser = subparsers.add_parser("reheader", help="Reheader VCF with normalized sample names.")
     reheader_parser.add_argument("batch", type=str, help="Batch ID (e.g., APR2025).")
     reheader_parser.add_argument("samples", type=Path, help="Path to sample sheet.")
@@ -203,8 +432,15 @@ def main():
 
     # ------------------------------------------------------------------------------------------------------------------
 
-    success_parser = subparsers.add_parser("snp-success", help="Calculate call success rates of SNPs in a VCF.")
-    success_parser.add_argument("vcf", type=Path, help="The VCF to calculate SNP success rates for.")
+    success_parser = subparsers.add_parser(
+        "snp-success", help="Calculate call success rates and other per-SNP statistics of one or more VCF/BCF files."
+    )
+    success_parser.add_argument(
+        "vcf", type=Path, nargs="+", help="The VCF/BCF file(s) to calculate SNP statistics for (e.g., one per batch.)"
+    )
+    success_parser.add_argument("--out", type=Path, help="Output TSV file for per-SNP statistics (default: stdout.)")
+    success_parser.add_argument("--processes", "-p", type=int, help="Number of processes to use.", default=4)
+    _add_plots_arg(success_parser)
     success_parser.set_defaults(func=cmd_snp_success)
 
     # ------------------------------------------------------------------------------------------------------------------
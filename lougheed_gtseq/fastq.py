@@ -0,0 +1,195 @@
+import gzip
+import numpy as np
+
+from pathlib import Path
+from pydantic import BaseModel, ConfigDict
+from typing import BinaryIO, Iterator
+
+__all__ = [
+    "open_fastq",
+    "FastqBlockReader",
+    "read_paired_blocks",
+    "FastqRecords",
+    "scan_records",
+    "gather_ranges",
+    "interleave_records",
+]
+
+NEWLINE = ord("\n")
+
+
+def open_fastq(path: Path) -> BinaryIO:
+    """
+    Opens a plain or gzipped FASTQ file for reading raw bytes.
+    """
+    with open(path, "rb") as fh:
+        is_gzip = fh.read(2) == b"\x1f\x8b"
+    return gzip.open(path, "rb") if is_gzip else open(path, "rb")
+
+
+class FastqBlockReader:
+    """
+    Reads large, record-aligned blocks of raw bytes from a FASTQ stream, without parsing individual records.
+    """
+
+    def __init__(self, fh: BinaryIO, block_size: int):
+        self._fh = fh
+        self._block_size = block_size
+        self._buf = b""
+        self._buf_lines = 0  # number of newlines in _buf, maintained as data is added/removed
+        self._eof = False
+
+    def _fill(self) -> None:
+        data = self._fh.read(self._block_size)
+        if not data:
+            self._eof = True
+            if self._buf:  # the last record may be missing its final newline, or be followed by blank lines
+                self._buf = self._buf.rstrip(b"\r\n") + b"\n"
+                self._buf_lines = self._buf.count(b"\n")
+            return
+        self._buf += data
+        self._buf_lines += data.count(b"\n")
+
+    def _take_lines(self, n_lines: int) -> bytes:
+        if self._eof and self._buf_lines % 4 and n_lines > self._buf_lines - self._buf_lines % 4:
+            raise ValueError(f"Truncated FASTQ record at end of file: {self._buf[-200:]!r}")
+        n_lines = min(n_lines, self._buf_lines - self._buf_lines % 4)
+        if n_lines == 0:
+            return b""
+        if n_lines == self._buf_lines:
+            cut = self._buf.rfind(b"\n") + 1
+        else:
+            cut = int(np.flatnonzero(np.frombuffer(self._buf, dtype=np.uint8) == NEWLINE)[n_lines - 1]) + 1
+        block, self._buf = self._buf[:cut], self._buf[cut:]
+        self._buf_lines -= n_lines
+        return block
+
+    def read_block(self) -> bytes:
+        """
+        Reads roughly block_size bytes worth of complete records; returns an empty bytes object at the end of the file.
+        A record longer than block_size makes for a larger block, rather than being mistaken for the end of the file.
+        :raises ValueError: if the file ends part-way through a record.
+        """
+        while not self._eof and (len(self._buf) < self._block_size or self._buf_lines < 4):
+            self._fill()
+        return self._take_lines(self._buf_lines)
+
+    def read_records(self, n_records: int) -> bytes:
+        """
+        Reads exactly n_records complete records, or fewer if the end of the file is reached first.
+        :raises ValueError: if the file ends part-way through a record.
+        """
+        while not self._eof and self._buf_lines < n_records * 4:
+            self._fill()
+        return self._take_lines(n_records * 4)
+
+
+def read_paired_blocks(fh_r1: BinaryIO, fh_r2: BinaryIO, block_size: int) -> Iterator[tuple[bytes, bytes]]:
+    """
+    Reads pairs of R1/R2 blocks holding the same number of records from two FASTQ streams. If the R2 stream runs out
+    of records first, the final R2 block will hold fewer records than its R1 block.
+    """
+
+    reader_r1 = FastqBlockReader(fh_r1, block_size)
+    reader_r2 = FastqBlockReader(fh_r2, block_size)
+
+    while block_r1 := reader_r1.read_block():
+        yield block_r1, reader_r2.read_records(block_r1.count(b"\n") // 4)
+
+    if block_r2 := reader_r2.read_block():
+        yield b"", block_r2
+
+
+class FastqRecords(BaseModel):
+    """
+    Byte offsets of the records in a buffer holding complete FASTQ records. All offsets are positions in the buffer;
+    end offsets are exclusive and do not include the line's newline character.
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    starts: np.ndarray  # start of each record (the @ character)
+    ends: np.ndarray  # end of each record, including the quality line's newline
+    header_ends: np.ndarray  # end of each header line
+    seq_starts: np.ndarray
+    seq_ends: np.ndarray
+    qual_starts: np.ndarray
+    qual_ends: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+
+def scan_records(buf: np.ndarray) -> FastqRecords:
+    """
+    Locates every record in a uint8 buffer of complete 4-line FASTQ records (e.g., a block from FastqBlockReader.)
+    :param buf: uint8 array view of the raw FASTQ bytes.
+    :return: offsets of each record and its lines within the buffer.
+    """
+
+    line_ends = np.flatnonzero(buf == NEWLINE)
+    n_records = len(line_ends) // 4
+    line_ends = line_ends[: n_records * 4].reshape(n_records, 4)
+
+    starts = np.empty(n_records, dtype=line_ends.dtype)
+    starts[:1] = 0
+    starts[1:] = line_ends[:-1, 3] + 1
+
+    # Tolerate Windows line endings
+    content_ends = line_ends - (buf[np.maximum(line_ends - 1, 0)] == ord("\r"))
+
+    if n_records and not ((buf[starts] == ord("@")).all() and (buf[line_ends[:, 1] + 1] == ord("+")).all()):
+        raise ValueError("Malformed FASTQ records in buffer")
+
+    return FastqRecords(
+        starts=starts,
+        ends=line_ends[:, 3] + 1,
+        header_ends=content_ends[:, 0],
+        seq_starts=line_ends[:, 0] + 1,
+        seq_ends=content_ends[:, 1],
+        qual_starts=line_ends[:, 2] + 1,
+        qual_ends=content_ends[:, 3],
+    )
+
+
+def gather_ranges(data: bytes, starts: np.ndarray, ends: np.ndarray) -> bytes:
+    """
+    Concatenates the byte ranges [starts[i], ends[i]) of a buffer, in order, without any per-range Python code.
+    """
+    return b"".join(map(data.__getitem__, map(slice, starts.tolist(), ends.tolist())))
+
+
+def interleave_records(block_r1: bytes, block_r2: bytes, comment: bytes) -> bytes:
+    """
+    Interleaves the records of an R1 block and the matching R2 block (R1, R2, R1, R2, ...), replacing each header's
+    comment (everything after the read name) with the given comment, e.g., a SAM tag for bwa mem -C.
+    """
+
+    data = block_r1 + block_r2 + b" " + comment
+    buf = np.frombuffer(data, dtype=np.uint8)
+    comment_start = len(block_r1) + len(block_r2)
+
+    records_r1 = scan_records(buf[: len(block_r1)])
+    records_r2 = scan_records(buf[len(block_r1) : comment_start])
+    if len(records_r1) != len(records_r2):
+        raise ValueError(f"Mismatched R1/R2 record counts: {len(records_r1)} != {len(records_r2)}")
+
+    separators = np.flatnonzero((buf[:comment_start] == ord(" ")) | (buf[:comment_start] == ord("\t")))
+    separators = np.append(separators, comment_start)
+
+    def _segments(records: FastqRecords, offset: int) -> np.ndarray:
+        # Three byte ranges per record: the read name, the new comment, and the rest of the record from the header end
+        starts, header_ends, ends = records.starts + offset, records.header_ends + offset, records.ends + offset
+        name_ends = np.minimum(separators[np.searchsorted(separators, starts)], header_ends)
+        n = len(starts)
+        return np.stack(
+            (
+                np.stack((starts, np.full(n, comment_start), header_ends), axis=1),
+                np.stack((name_ends, np.full(n, len(data)), ends), axis=1),
+            ),
+            axis=2,
+        )
+
+    # Shape (n records, 2 mates, 3 segments, start/end) -> record-major order interleaves the mates
+    segments = np.stack((_segments(records_r1, 0), _segments(records_r2, len(block_r1))), axis=1)
+    return gather_ranges(data, segments[..., 0].ravel(), segments[..., 1].ravel())
@@ -0,0 +1,177 @@
+import contextlib
+import fcntl
+import hashlib
+import os
+import subprocess
+from pathlib import Path
+from typing import Iterator
+
+import pysam
+
+from .compression import BGZF_EOF
+from .logger import logger
+from .metrics import measured_check_call
+from .models import CachedFile, CacheManifest
+
+__all__ = [
+    "BWA_INDEX_EXTENSIONS",
+    "FAIDX_EXTENSIONS",
+    "cache_lock",
+    "file_digest",
+    "manifest_path",
+    "read_manifest",
+    "write_manifest",
+    "check_cached_files",
+    "verify_cached_files",
+    "faidx_atomic",
+    "bwa_index_atomic",
+]
+
+BWA_INDEX_EXTENSIONS = (".amb", ".ann", ".bwt", ".pac", ".sa")
+FAIDX_EXTENSIONS = (".fai", ".gzi")  # .gzi only exists for bgzipped FASTA files
+
+DIGEST_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+@contextlib.contextmanager
+def cache_lock(folder: Path, name: str) -> Iterator[None]:
+    """
+    Holds an exclusive lock on a named entry of a cache folder, which may be shared between concurrent pipeline runs
+    (possibly on different machines, if the file system supports locking.) Other runs wait for the holder to finish
+    building the entry, then re-use it.
+    """
+
+    with open(folder / f".{name}.lock", "a") as fh:
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info("Waiting for another process to finish with cached files: %s", name)
+            fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def file_digest(path: Path, algorithm: str = "sha256") -> str:
+    h = hashlib.new(algorithm)
+    with open(path, "rb") as fh:
+        while chunk := fh.read(DIGEST_CHUNK_SIZE):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def manifest_path(main_file: Path) -> Path:
+    return main_file.with_name(f"{main_file.name}.manifest.json")
+
+
+def _cached_paths(main_file: Path, extensions: tuple[str, ...]) -> list[Path]:
+    return [main_file, *(Path(f"{main_file}{ext}") for ext in extensions)]
+
+
+def read_manifest(main_file: Path) -> CacheManifest | None:
+    if not (path := manifest_path(main_file)).exists():
+        return None
+    with open(path, "r") as fh:
+        return CacheManifest.model_validate_json(fh.read())
+
+
+def write_manifest(
+    main_file: Path, extensions: tuple[str, ...], source_url: str | None = None, source_md5: str | None = None
+) -> CacheManifest:
+    """
+    Checksums a cached file and its index files and atomically writes a manifest for them, marking them as complete.
+    """
+
+    manifest = CacheManifest(
+        source_url=source_url,
+        source_md5=source_md5,
+        files={
+            p.name: CachedFile(size=p.stat().st_size, sha256=file_digest(p))
+            for p in _cached_paths(main_file, extensions)
+        },
+    )
+
+    path = manifest_path(main_file)
+    tmp = path.with_name(f"{path.name}.tmp")
+    with open(tmp, "w") as fh:
+        fh.write(manifest.model_dump_json(indent=2))
+    os.replace(tmp, path)
+
+    return manifest
+
+
+def check_cached_files(main_file: Path, extensions: tuple[str, ...], full: bool = False) -> dict[Path, str]:
+    """
+    Checks a cached file and its index files against the cache manifest.
+    :param main_file: the main cached file, e.g., a bgzipped genome FASTA.
+    :param extensions: extensions of the index files which must accompany the main file.
+    :param full: whether to verify file checksums; otherwise, only file presence and sizes are checked.
+    :return: dictionary of {problem file: description} - empty if everything is present and valid.
+    """
+
+    manifest = read_manifest(main_file)
+    problems: dict[Path, str] = {}
+
+    for p in _cached_paths(main_file, extensions):
+        if not p.exists():
+            problems[p] = "missing"
+        elif manifest is None:
+            # Files built before the cache had manifests: adopt them if a bgzipped main file is at least complete
+            if p == main_file and p.name.endswith(".gz"):
+                with open(p, "rb") as fh:
+                    fh.seek(max(p.stat().st_size - len(BGZF_EOF), 0))
+                    if fh.read() != BGZF_EOF:
+                        problems[p] = "truncated (no BGZF end-of-file marker)"
+        elif (entry := manifest.files.get(p.name)) is None:
+            problems[p] = "not in manifest"
+        elif p.stat().st_size != entry.size:
+            problems[p] = f"size mismatch (expected {entry.size}, got {p.stat().st_size})"
+        elif full and file_digest(p) != entry.sha256:
+            problems[p] = "checksum mismatch"
+
+    return problems
+
+
+def verify_cached_files(main_file: Path, extensions: tuple[str, ...]) -> dict[Path, str]:
+    """
+    Fully verifies (including checksums) a complete set of cached files, waiting for any build in progress to finish.
+    """
+    if not main_file.parent.is_dir():  # nothing cached yet; there is no folder to hold a lock file in either
+        return {p: "missing" for p in _cached_paths(main_file, extensions)}
+    with cache_lock(main_file.parent, main_file.name):
+        problems = check_cached_files(main_file, extensions, full=True)
+        if not problems and read_manifest(main_file) is None:
+            problems[manifest_path(main_file)] = "missing"
+    return problems
+
+
+def faidx_atomic(fasta: Path):
+    """
+    Builds a FASTA index (plus a BGZF index for bgzipped files) under temporary names, then moves them into place.
+    """
+
+    fai, gzi = Path(f"{fasta}.fai"), Path(f"{fasta}.gzi")
+    fai_tmp, gzi_tmp = fai.with_name(f"{fai.name}.tmp"), gzi.with_name(f"{gzi.name}.tmp")
+
+    args = [str(fasta), "--fai-idx", str(fai_tmp)]
+    if fasta.name.endswith(".gz"):
+        args.extend(("--gzi-idx", str(gzi_tmp)))
+    pysam.faidx(*args)
+
+    if fasta.name.endswith(".gz"):
+        os.replace(gzi_tmp, gzi)
+    os.replace(fai_tmp, fai)
+
+
+def bwa_index_atomic(fasta: Path):
+    """
+    Builds a bwa index under a temporary prefix, then moves the index files into place.
+    """
+
+    tmp_prefix = fasta.with_name(f"{fasta.name}.tmp-bwa")
+    measured_check_call(("bwa", "index", "-p", str(tmp_prefix), str(fasta)), stderr=subprocess.DEVNULL)
+
+    # .sa is written last by bwa index, and so is moved into place last too
+    for ext in BWA_INDEX_EXTENSIONS:
+        os.replace(f"{tmp_prefix}{ext}", f"{fasta}{ext}")
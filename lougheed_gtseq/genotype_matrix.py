@@ -0,0 +1,220 @@
+import gzip
+import numpy as np
+import os
+
+from pathlib import Path
+from pydantic import BaseModel, ConfigDict
+from typing import TextIO
+
+__all__ = [
+    "GT_MISSING",
+    "GENOTYPE_MATRIX_CACHE_VERSION",
+    "GenotypeMatrix",
+    "open_vcf",
+    "qc_sample_mask",
+    "parse_record_genotypes",
+    "stack_genotypes",
+    "read_genotype_matrix",
+    "genotype_matrix_cache_path",
+    "load_genotype_matrix",
+    "sigma_bounds",
+    "write_masked_vcf",
+]
+
+GT_MISSING = -1  # allele code for a missing (.) allele
+
+UINT16_MAX = np.iinfo(np.uint16).max
+
+# Bump when the cached genotype matrix format changes, so stale cache files are re-built
+GENOTYPE_MATRIX_CACHE_VERSION = 1
+
+
+def open_vcf(path: Path) -> TextIO:
+    """
+    Opens a plain or (b)gzipped VCF file for reading text.
+    """
+    with open(path, "rb") as fh:
+        is_gzip = fh.read(2) == b"\x1f\x8b"
+    return gzip.open(path, "rt") if is_gzip else open(path, "r")
+
+
+class GenotypeMatrix(BaseModel):
+    """
+    Dense, sites x samples matrices of the genotype fields QC relies on.
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    samples: list[str]
+    gt: np.ndarray  # int8, sites x samples x 2: allele indices of each genotype (GT_MISSING for .)
+    dp: np.ndarray  # uint16, sites x samples; 0 if missing
+    gq: np.ndarray  # uint16, sites x samples; 0 if missing
+
+    @property
+    def n_sites(self) -> int:
+        return self.gt.shape[0]
+
+    def called(self, min_dp: int, min_gq: int) -> np.ndarray:
+        """
+        Boolean sites x samples mask of genotypes which pass depth and quality thresholds (DP >= min_dp, GQ > min_gq;
+        missing DP/GQ values never pass.)
+        """
+        return (self.gt >= 0).all(axis=-1) & (self.dp > 0) & (self.dp >= min_dp) & (self.gq > 0) & (self.gq > min_gq)
+
+    def heterozygous(self) -> np.ndarray:
+        """
+        Boolean sites x samples mask of genotypes with two different alleles.
+        """
+        return (self.gt[..., 0] != self.gt[..., 1]) & (self.gt >= 0).all(axis=-1)
+
+
+def qc_sample_mask(samples: list[str]) -> np.ndarray:
+    """
+    Boolean mask of samples subject to QC; control samples are excluded.
+    """
+    return np.array(["control" not in s.lower() for s in samples], dtype=bool)  # TODO: parametrize
+
+
+def _parse_gt(gt: str) -> tuple[int, int]:
+    alleles = gt.replace("|", "/").split("/")
+    codes = [GT_MISSING if a == "." else int(a) for a in alleles]
+    return codes[0], codes[-1]  # haploid genotypes are treated as homozygous
+
+
+def _int_column(values: list[str]) -> np.ndarray:
+    # Parses a column of integer FORMAT values in one go; missing values (a whole field of .) become 0
+    ints = np.array(["0" if v == "." else v for v in values], dtype=np.int64)
+    return np.minimum(ints, UINT16_MAX).astype(np.uint16)
+
+
+def parse_record_genotypes(line: str, n_samples: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Parses the GT, DP and GQ fields of every sample from one VCF data line. The sample columns are split into one flat
+    list of FORMAT values, which is then sliced by field.
+    :return: (GT allele codes (n_samples x 2, int8), DP (uint16), GQ (uint16)); missing DP/GQ values are 0.
+    """
+
+    fields = line.rstrip("\n").split("\t", 9)
+    format_keys = fields[8].split(":")
+    k = len(format_keys)
+
+    values = fields[9].replace("\t", ":").split(":")
+    if len(values) != n_samples * k:
+        # Trailing missing values may be left out for some samples (e.g., just ./.); pad them back out
+        values = [v for s in fields[9].split("\t") for v in (s.split(":") + ["."] * k)[:k]]
+
+    # GT is always the first FORMAT field; only a handful of distinct GT strings exist, so parse each once
+    gt_values = values[0::k]
+    gt_strs = np.array(gt_values)
+    gt = np.empty((n_samples, 2), dtype=np.int8)
+    for gt_str in set(gt_values):
+        gt[gt_strs == gt_str] = _parse_gt(gt_str)
+
+    dp, gq = (
+        _int_column(values[format_keys.index(key) :: k]) if key in format_keys else np.zeros(n_samples, dtype=np.uint16)
+        for key in ("DP", "GQ")
+    )
+
+    return gt, dp, gq
+
+
+def stack_genotypes(
+    rows: list[tuple[np.ndarray, np.ndarray, np.ndarray]], n_samples: int
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Stacks parse_record_genotypes results into sites x samples (x 2) GT, DP and GQ matrices.
+    """
+    if not rows:
+        return (
+            np.zeros((0, n_samples, 2), dtype=np.int8),
+            np.zeros((0, n_samples), dtype=np.uint16),
+            np.zeros((0, n_samples), dtype=np.uint16),
+        )
+    gt_rows, dp_rows, gq_rows = zip(*rows)
+    return np.stack(gt_rows), np.stack(dp_rows), np.stack(gq_rows)
+
+
+def read_genotype_matrix(vcf: Path) -> GenotypeMatrix:
+    """
+    Reads the GT, DP and GQ fields of every sample into dense matrices, in a single pass over the VCF text.
+    """
+
+    rows: list[tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+    samples: list[str] = []
+
+    with open_vcf(vcf) as fh:
+        for line in fh:
+            if line.startswith("##"):
+                continue
+            if line.startswith("#"):
+                samples = line.rstrip("\n").split("\t")[9:]
+                continue
+            rows.append(parse_record_genotypes(line, len(samples)))
+
+    gt, dp, gq = stack_genotypes(rows, len(samples))
+    return GenotypeMatrix(samples=samples, gt=gt, dp=dp, gq=gq)
+
+
+def genotype_matrix_cache_path(vcf: Path) -> Path:
+    return vcf.with_name(f"{vcf.name}.gtmatrix.npz")
+
+
+def _source_key(vcf: Path) -> np.ndarray:
+    st = vcf.stat()
+    return np.array([GENOTYPE_MATRIX_CACHE_VERSION, st.st_size, st.st_mtime_ns], dtype=np.int64)
+
+
+def load_genotype_matrix(vcf: Path) -> GenotypeMatrix:
+    """
+    Loads a VCF's genotype matrix from its cache file (next to the VCF), parsing the VCF and writing the cache file
+    first if it is missing or the VCF has changed since (by size and modification time.)
+    """
+
+    cache = genotype_matrix_cache_path(vcf)
+    source_key = _source_key(vcf)
+
+    if cache.exists():
+        with np.load(cache) as npz:
+            if np.array_equal(npz["source_key"], source_key):
+                return GenotypeMatrix(samples=npz["samples"].tolist(), gt=npz["gt"], dp=npz["dp"], gq=npz["gq"])
+
+    gm = read_genotype_matrix(vcf)
+
+    cache_tmp = cache.with_name(f"{cache.name}.{os.getpid()}.tmp.npz")
+    np.savez(cache_tmp, source_key=source_key, samples=np.array(gm.samples, dtype=str), gt=gm.gt, dp=gm.dp, gq=gm.gq)
+    os.replace(cache_tmp, cache)
+
+    return gm
+
+
+def sigma_bounds(values: np.ndarray, sigma: float) -> tuple[float, float]:
+    """
+    Returns (mean - sigma * SD, mean + sigma * SD) of values.
+    """
+    mean, sd = np.mean(values), np.std(values)
+    return mean - sigma * sd, mean + sigma * sd
+
+
+def write_masked_vcf(vcf: Path, vcf_out: Path, mask: np.ndarray):
+    """
+    Copies a VCF, setting genotypes to missing (./.) wherever the sites x samples mask is True.
+    """
+
+    si = 0
+    with open_vcf(vcf) as fh, open(vcf_out, "w") as fh_out:
+        for line in fh:
+            if line.startswith("#"):
+                fh_out.write(line)
+                continue
+
+            site_mask = mask[si]
+            si += 1
+            if not site_mask.any():
+                fh_out.write(line)
+                continue
+
+            fields = line.rstrip("\n").split("\t")
+            for ni in np.flatnonzero(site_mask):
+                # GT is always the first FORMAT field
+                fields[9 + ni] = "./." + fields[9 + ni][len(fields[9 + ni].split(":", 1)[0]) :]
+            fh_out.write("\t".join(fields) + "\n")
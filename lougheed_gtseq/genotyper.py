@@ -0,0 +1,302 @@
+import math
+import multiprocessing
+from pathlib import Path
+
+import numpy as np
+import pysam
+
+from .logger import logger
+from .pileup_cache import load_panel_alleles
+
+__all__ = [
+    "GENOTYPER_MIN_BASE_QUALITY",
+    "GENOTYPER_MAX_DEPTH",
+    "GENOTYPER_QUALITY_BINS",
+    "bam_sample_names",
+    "count_panel_alleles",
+    "genotype_likelihoods",
+    "call_genotypes",
+    "genotype_panel",
+]
+
+# Pileup settings, mirroring bcftools mpileup's defaults: minimum base quality (-Q) and maximum per-file depth (-d).
+# Anomalous read pairs are skipped and overlapping mates are only counted once, as in mpileup. Base alignment quality
+# (BAQ) is not computed: it mostly guards against false SNPs next to indels, which matter little at known panel
+# sites, and it would make piling up several times slower.
+GENOTYPER_MIN_BASE_QUALITY = 13
+GENOTYPER_MAX_DEPTH = 250  # per sample, rather than per file, so multi-sample BAMs are not starved
+
+# Base qualities are counted in this many bins; higher qualities go in the top bin.
+GENOTYPER_QUALITY_BINS = 64
+
+# Observations of the same allele at a site are not independent (e.g., PCR duplicates, systematic errors), so - as in
+# samtools/bcftools' error model - the k-th best observation of an allele only counts with weight 0.7 * 0.83^k + 0.3.
+ERROR_DEPENDENCY = 0.83
+ERROR_DEPENDENCY_FLOOR = 0.3
+
+MAX_GQ = 127
+MIN_ALLELE_FREQUENCY = 1e-3  # bounds the estimated panel allele frequency prior, so no genotype is ruled out entirely
+ALLELE_FREQUENCY_ITERATIONS = 10
+
+PanelSite = tuple[str, int, tuple[str, str]]  # contig, 1-based position, (REF, ALT)
+
+# Per-process panel sites for pileup workers; set once by _init_pileup_worker rather than sent with every task
+_worker_sites: list[PanelSite] = []
+
+
+def bam_sample_names(bam: Path) -> list[str]:
+    """
+    Sample names in a BAM as bcftools mpileup sees them: read group SM values in header order, or the file name as
+    given if the BAM has no read groups.
+    """
+    with pysam.AlignmentFile(str(bam)) as bf:
+        read_groups = bf.header.to_dict().get("RG", [])
+    return list(dict.fromkeys(rg.get("SM", rg["ID"]) for rg in read_groups)) or [str(bam)]
+
+
+def _init_pileup_worker(sites: list[PanelSite]):
+    global _worker_sites
+    _worker_sites = sites
+
+
+def _pileup_task(task: tuple[int, Path, int, int]) -> tuple[int, int, np.ndarray, np.ndarray]:
+    """
+    Counts high-quality panel allele observations for a block of panel sites in one BAM.
+    :return: (BAM index, first site index, allele counts (sites x samples x alleles x quality bins), depths (sites x
+             samples) - all high-quality bases, including those not matching a panel allele.)
+    """
+
+    bam_i, bam, site_start, site_end = task
+    sample_names = bam_sample_names(bam)
+    n_sites = site_end - site_start
+
+    counts = np.zeros((n_sites, len(sample_names), 2, GENOTYPER_QUALITY_BINS), dtype=np.uint16)
+    depths = np.zeros((n_sites, len(sample_names)), dtype=np.int32)
+
+    # Sites are grouped by contig, so that each contig's sites are piled up in a single pass - re-seeking for every
+    # site would mean decompressing the same BAM blocks over and over for nearby sites.
+    contig_sites: dict[str, dict[int, int]] = {}
+    for si, (contig, pos, _) in enumerate(_worker_sites[site_start:site_end]):
+        contig_sites.setdefault(contig, {})[pos - 1] = si
+
+    with pysam.AlignmentFile(str(bam)) as bf:
+        # In multi-sample BAMs, each read's sample is looked up through its read group
+        rg_samples = {rg["ID"]: sample_names.index(rg.get("SM", rg["ID"])) for rg in bf.header.to_dict().get("RG", [])}
+
+        for contig, positions in contig_sites.items():
+            if contig not in bf.references:
+                continue
+
+            for col in bf.pileup(
+                contig,
+                min(positions),
+                max(positions) + 1,
+                truncate=True,
+                compute_baq=False,
+                min_base_quality=GENOTYPER_MIN_BASE_QUALITY,
+                max_depth=GENOTYPER_MAX_DEPTH * len(sample_names),
+            ):
+                if (si := positions.get(col.reference_pos)) is None:
+                    continue
+
+                bases = np.array([b.upper() for b in col.get_query_sequences()], dtype="U1")
+                quals = np.array(col.get_query_qualities(), dtype=np.int64)
+                keep = (bases != "") & (quals >= GENOTYPER_MIN_BASE_QUALITY)  # '' marks deletions/reference skips
+
+                if len(sample_names) > 1:
+                    samples = np.array([rg_samples[p.alignment.get_tag("RG")] for p in col.pileups], dtype=np.int64)
+                else:
+                    samples = np.zeros(len(bases), dtype=np.int64)
+
+                depths[si] = np.bincount(samples[keep], minlength=len(sample_names))
+
+                q_bins = np.minimum(quals, GENOTYPER_QUALITY_BINS - 1)
+                for ai, allele in enumerate(_worker_sites[site_start + si][2]):
+                    is_allele = keep & (bases == allele)
+                    np.add.at(counts[si], (samples[is_allele], ai, q_bins[is_allele]), 1)
+
+    return bam_i, site_start, counts, depths
+
+
+def count_panel_alleles(
+    bams: list[Path], sites: list[PanelSite], processes: int
+) -> tuple[list[str], np.ndarray, np.ndarray]:
+    """
+    Piles up reads at the panel sites in indexed BAMs across a process pool, counting high-quality observations of each
+    panel allele by base quality.
+    :param bams: indexed BAMs to pile up, each holding one or more samples (distinguished by read group.)
+    :param sites: biallelic panel sites.
+    :param processes: number of pileup worker processes.
+    :return: (sample names, allele counts (sites x samples x alleles x quality bins), depths (sites x samples).)
+    """
+
+    bam_samples = [bam_sample_names(bam) for bam in bams]
+    sample_names = list(dict.fromkeys(s for names in bam_samples for s in names))
+    bam_sample_indices = [np.array([sample_names.index(s) for s in names]) for names in bam_samples]
+
+    counts = np.zeros((len(sites), len(sample_names), 2, GENOTYPER_QUALITY_BINS), dtype=np.uint16)
+    depths = np.zeros((len(sites), len(sample_names)), dtype=np.int32)
+
+    # Each BAM is piled up in one task, unless there are fewer BAMs than processes (e.g., a single multi-sample BAM from
+    # batch alignment), in which case the panel is split into blocks of sites to keep every process busy.
+    sites_per_task = math.ceil(len(sites) / math.ceil(processes / len(bams))) if bams else 1
+    tasks = [
+        (bam_i, bam, start, min(start + sites_per_task, len(sites)))
+        for bam_i, bam in enumerate(bams)
+        for start in range(0, len(sites), sites_per_task)
+    ]
+
+    # spawn rather than fork: other pipeline steps' threads may be running, holding locks a forked child would inherit
+    with multiprocessing.get_context("spawn").Pool(
+        processes, initializer=_init_pileup_worker, initargs=(sites,)
+    ) as pool:
+        for bam_i, site_start, task_counts, task_depths in pool.imap_unordered(_pileup_task, tasks):
+            # The same sample may be spread over several BAMs (as with bcftools mpileup), so counts are summed
+            site_end = site_start + task_counts.shape[0]
+            counts[site_start:site_end, bam_sample_indices[bam_i]] += task_counts
+            depths[site_start:site_end, bam_sample_indices[bam_i]] += task_depths
+
+    return sample_names, counts, depths
+
+
+def _dependent_weight_sum(n: np.ndarray) -> np.ndarray:
+    # Closed form of sum(0.7 * 0.83^k + 0.3 for k in range(n))
+    return (1 - ERROR_DEPENDENCY_FLOOR) * (1 - ERROR_DEPENDENCY**n) / (
+        1 - ERROR_DEPENDENCY
+    ) + ERROR_DEPENDENCY_FLOOR * n
+
+
+def genotype_likelihoods(counts: np.ndarray) -> np.ndarray:
+    """
+    Computes phred-scaled genotype likelihoods (VCF PL order: 0/0, 0/1, 1/1; normalized so the best is 0) from
+    allele observation counts by base quality.
+    :param counts: allele counts, sites x samples x alleles (REF, ALT) x quality bins.
+    :return: float array of PLs, sites x samples x 3.
+    """
+
+    # Weight each observation by its rank (best quality first) among observations of the same allele
+    desc = counts[..., ::-1].astype(np.int64)
+    n_before = np.cumsum(desc, axis=-1) - desc
+    weights = _dependent_weight_sum(n_before + desc) - _dependent_weight_sum(n_before)
+    qualities = np.arange(GENOTYPER_QUALITY_BINS - 1, -1, -1)
+    weighted_quality = (weights * qualities).sum(axis=-1)  # sites x samples x alleles
+
+    # A homozygous genotype costs the (weighted) qualities of every observation of the other allele; a heterozygous
+    # genotype explains any observation with probability 1/2.
+    n_obs = counts.sum(axis=(-1, -2))
+    pl = np.stack(
+        (weighted_quality[..., 1], 10 * np.log10(2) * n_obs, weighted_quality[..., 0]),
+        axis=-1,
+    )
+    return pl - pl.min(axis=-1, keepdims=True)
+
+
+def call_genotypes(pl: np.ndarray, called: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Calls genotypes from PLs with a Hardy-Weinberg prior based on the panel allele frequency at each site, estimated
+    by expectation-maximization over the samples with data.
+    :param pl: PLs, sites x samples x 3.
+    :param called: boolean mask of samples with data at each site, sites x samples.
+    :return: (genotypes as ALT allele counts (-1 if not called), GQs, per-site QUALs.)
+    """
+
+    likelihoods = 10 ** (-pl / 10)
+    n_called = np.maximum(called.sum(axis=1), 1)
+    p = np.full(pl.shape[0], 0.5)
+
+    for _ in range(ALLELE_FREQUENCY_ITERATIONS):
+        prior = np.stack(((1 - p) ** 2, 2 * p * (1 - p), p**2), axis=-1)[:, None, :]
+        posterior = likelihoods * prior
+        posterior /= posterior.sum(axis=-1, keepdims=True)
+        alt_dosage = ((posterior[..., 1] + 2 * posterior[..., 2]) * called).sum(axis=1)
+        p = np.clip(alt_dosage / (2 * n_called), MIN_ALLELE_FREQUENCY, 1 - MIN_ALLELE_FREQUENCY)
+
+    genotypes = np.where(called, posterior.argmax(axis=-1), -1)
+
+    with np.errstate(divide="ignore"):
+        gq = np.minimum(-10 * np.log10(1 - posterior.max(axis=-1)), MAX_GQ)
+        # QUAL: phred-scaled probability that every sample is homozygous for the reference allele
+        qual = -10 * np.where(called, np.log10(posterior[..., 0]), 0).sum(axis=1)
+
+    return genotypes, np.rint(np.nan_to_num(gq, posinf=MAX_GQ)).astype(int), np.nan_to_num(qual, posinf=999)
+
+
+def _vcf_header(ref_genome: Path, sample_names: list[str]) -> pysam.VariantHeader:
+    header = pysam.VariantHeader()
+    with pysam.FastaFile(str(ref_genome)) as fa:
+        for contig, length in zip(fa.references, fa.lengths):
+            header.contigs.add(contig, length=length)
+    header.add_line(f"##reference=file://{ref_genome.resolve()}")
+    header.add_meta("INFO", items=[("ID", "DP"), ("Number", 1), ("Type", "Integer"), ("Description", "Raw read depth")])
+    header.add_meta(
+        "INFO",
+        items=[("ID", "AC"), ("Number", "A"), ("Type", "Integer"), ("Description", "Allele count in genotypes")],
+    )
+    header.add_meta(
+        "INFO",
+        items=[("ID", "AN"), ("Number", 1), ("Type", "Integer"), ("Description", "Total number of called alleles")],
+    )
+    for format_id, number, type_, description in (
+        ("GT", 1, "String", "Genotype"),
+        ("PL", "G", "Integer", "List of Phred-scaled genotype likelihoods"),
+        ("DP", 1, "Integer", "Number of high-quality bases"),
+        ("AD", "R", "Integer", "Allelic depths (high-quality bases)"),
+        ("GQ", 1, "Integer", "Phred-scaled Genotype Quality"),
+    ):
+        header.add_meta(
+            "FORMAT", items=[("ID", format_id), ("Number", number), ("Type", type_), ("Description", description)]
+        )
+    for sample in sample_names:
+        header.add_sample(sample)
+    return header
+
+
+def genotype_panel(ref_genome: Path, bams: list[Path], allele_file: Path, vcf_out: Path, processes: int):
+    """
+    In-process alternative to bcftools mpileup | bcftools call -mv -C alleles for a fixed panel of biallelic SNPs:
+    piles up panel sites across a process pool, computes genotype likelihoods and calls genotypes in vectorised form,
+    and writes variant sites (with GT, PL, DP, AD and GQ fields) to a VCF.
+    """
+
+    panel = load_panel_alleles(allele_file)
+    if any(len(alleles) != 2 for alleles in panel.values()):
+        raise ValueError(f"Native genotyper only supports biallelic panel sites: {allele_file}")
+    sites: list[PanelSite] = [(contig, pos, tuple(alleles)) for (contig, pos), alleles in panel.items()]
+
+    logger.info("Piling up %d panel sites in %d BAMs with %d processes", len(sites), len(bams), processes)
+    sample_names, counts, depths = count_panel_alleles(bams, sites, processes)
+
+    allele_depths = counts.sum(axis=-1)
+    # Samples with only non-panel bases (neither REF nor ALT) have no evidence for any genotype: leave them uncalled
+    called = allele_depths.sum(axis=-1) > 0
+    pl = genotype_likelihoods(counts)
+    genotypes, gq, qual = call_genotypes(pl, called)
+    pl = np.rint(pl).astype(int)
+
+    gt_alleles = {-1: (None, None), 0: (0, 0), 1: (0, 1), 2: (1, 1)}
+
+    with pysam.VariantFile(
+        str(vcf_out), "wz" if vcf_out.name.endswith(".gz") else "w", header=_vcf_header(ref_genome, sample_names)
+    ) as vf:
+        for si in np.flatnonzero((genotypes > 0).any(axis=1)):  # variant sites only, as with bcftools call -v
+            contig, pos, alleles = sites[si]
+            site_called = called[si]
+            record = vf.new_record(
+                contig=contig,
+                start=pos - 1,
+                alleles=alleles,
+                qual=round(float(qual[si]), 3),
+                info={
+                    "DP": int(depths[si].sum()),
+                    "AC": (int(genotypes[si][site_called].sum()),),
+                    "AN": int(2 * site_called.sum()),
+                },
+            )
+            for ni, sample in enumerate(record.samples.values()):
+                sample["GT"] = gt_alleles[int(genotypes[si, ni])]
+                sample["PL"] = tuple(pl[si, ni].tolist())
+                sample["DP"] = int(depths[si, ni])
+                sample["AD"] = tuple(allele_depths[si, ni].tolist())
+                if site_called[ni]:
+                    sample["GQ"] = int(gq[si, ni])
+            vf.write(record)
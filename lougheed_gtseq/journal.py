@@ -0,0 +1,144 @@
+import contextlib
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import Executor, as_completed
+from pathlib import Path
+from pydantic import BaseModel, ConfigDict
+from typing import Any, Callable, Iterator
+
+from .compression import BGZF_EOF
+from .logger import logger
+from .step_cache import file_fingerprint, value_fingerprint
+
+__all__ = [
+    "unit_key",
+    "atomic_path",
+    "valid_bam",
+    "valid_nonempty",
+    "WorkUnit",
+    "Journal",
+    "run_units",
+]
+
+
+def unit_key(*parts: Any) -> str:
+    """
+    Hash identifying the work a unit does: its parameters and input values, with any files in them fingerprinted.
+    """
+    return hashlib.sha256(json.dumps(value_fingerprint(list(parts)), default=str).encode()).hexdigest()
+
+
+@contextlib.contextmanager
+def atomic_path(path: Path) -> Iterator[Path]:
+    """
+    Yields a temporary path next to path (with the same suffix) to write to, which is moved into place if the context
+    exits normally and removed otherwise, so that path only ever holds a complete file.
+    """
+    tmp = path.with_name(f".{path.stem}.{os.getpid()}.{threading.get_ident()}.tmp{path.suffix}")
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def valid_bam(bam: Path) -> bool:
+    """
+    Checks a BAM was completely written (it ends with the BGZF EOF block) and has an index.
+    """
+    if not bam.is_file() or bam.stat().st_size < len(BGZF_EOF):
+        return False
+    with open(bam, "rb") as fh:
+        fh.seek(-len(BGZF_EOF), os.SEEK_END)
+        if fh.read() != BGZF_EOF:
+            return False
+    return any(Path(f"{bam}{ext}").is_file() for ext in (".bai", ".csi"))
+
+
+def valid_nonempty(path: Path) -> bool:
+    return path.is_file() and path.stat().st_size > 0
+
+
+class WorkUnit(BaseModel):
+    """
+    An independent piece of per-sample (or per-batch) work, whose completion is tracked in a Journal. run takes no
+    arguments; to use a process pool executor, it must be picklable (e.g., a functools.partial of a module function.)
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    name: str
+    key: str  # from unit_key; a unit done with a different key (e.g., other inputs or parameters) is done again
+    outputs: list[Path]
+    run: Callable[[], Any]
+    validate_output: Callable[[Path], bool] = valid_nonempty
+
+
+class _JournalEntry(BaseModel):
+    unit: str
+    key: str
+    outputs: list[tuple[Path, list]]  # output paths and their fingerprints when the unit was done
+
+
+class Journal:
+    """
+    Append-only record of completed work units (one JSON line each), so interrupted steps only redo unfinished
+    units. A unit counts as done if its latest entry has the same key and its outputs are unchanged and valid.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: dict[str, _JournalEntry] = {}
+
+        if path.exists():
+            with open(path, "r") as fh:
+                for line in fh:
+                    try:
+                        entry = _JournalEntry.model_validate_json(line)
+                    except ValueError:  # e.g., a line torn by a crash while it was being written
+                        continue
+                    self._entries[entry.unit] = entry
+
+    def done(self, unit: WorkUnit) -> bool:
+        entry = self._entries.get(unit.name)
+        return (
+            entry is not None
+            and entry.key == unit.key
+            and [p for p, _ in entry.outputs] == unit.outputs
+            and all(file_fingerprint(p) == fp and unit.validate_output(p) for p, fp in entry.outputs)
+        )
+
+    def record(self, unit: WorkUnit):
+        entry = _JournalEntry(unit=unit.name, key=unit.key, outputs=[(p, file_fingerprint(p)) for p in unit.outputs])
+        with self._lock:
+            with open(self.path, "a") as fh:
+                fh.write(entry.model_dump_json() + "\n")
+                fh.flush()
+                os.fsync(fh.fileno())
+            self._entries[unit.name] = entry
+
+
+def run_units(units: list[WorkUnit], journal: Journal, executor: Executor, description: str):
+    """
+    Runs the units which are not done yet on an executor, recording each in the journal as soon as it finishes. If
+    any units fail, the others still run (and are recorded); the first error is raised at the end.
+    """
+
+    pending = [u for u in units if not journal.done(u)]
+    logger.info("%s: %d to do, %d already done", description, len(pending), len(units) - len(pending))
+
+    error: BaseException | None = None
+    futures = {executor.submit(u.run): u for u in pending}
+    for future in as_completed(futures):
+        unit = futures[future]
+        if (exc := future.exception()) is not None:
+            logger.error("%s: %s failed: %s", description, unit.name, exc)
+            error = error or exc
+            continue
+        journal.record(unit)
+
+    if error is not None:
+        raise error
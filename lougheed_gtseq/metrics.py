@@ -0,0 +1,437 @@
+import contextlib
+import contextvars
+import csv
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from pydantic import BaseModel
+from typing import Iterator
+
+from .logger import logger
+
+__all__ = [
+    "ResourceUsage",
+    "CommandMetrics",
+    "StepMetrics",
+    "RunMetrics",
+    "MeasuredPopen",
+    "measured_check_call",
+    "measure_step",
+    "step_thread_pool",
+    "record_throughput",
+    "MetricsRecorder",
+    "record_metrics",
+    "METRICS_TABLE_COLUMNS",
+    "metrics_table",
+    "write_run_metrics",
+]
+
+# ru_maxrss is in kilobytes on Linux, bytes on macOS
+_RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+# Per-process resource usage comes from os.wait4 (POSIX); os.waitid (e.g., not on macOS) lets /proc I/O counters be read
+# before the process is reaped
+_HAVE_WAIT4 = hasattr(os, "wait4")
+_HAVE_WAITID = hasattr(os, "waitid") and hasattr(os, "WNOWAIT")
+
+# Tools whose first argument is a subcommand (or script) worth telling apart in summaries
+_SUBCOMMAND_TOOLS = ("bwa", "samtools", "bcftools", "perl")
+
+METRICS_TABLE_COLUMNS = (
+    "kind",
+    "name",
+    "count",
+    "wall_time",
+    "user_time",
+    "sys_time",
+    "max_rss",
+    "read_bytes",
+    "write_bytes",
+    "throughput",
+)
+
+
+class ResourceUsage(BaseModel):
+    wall_time: float = 0.0  # seconds
+    user_time: float = 0.0  # CPU seconds
+    sys_time: float = 0.0
+    max_rss: int = 0  # peak resident set size, in bytes
+    # Bytes read and written through system calls, including pipes and page cache hits (rchar/wchar); Linux only
+    read_bytes: int | None = None
+    write_bytes: int | None = None
+
+
+class CommandMetrics(ResourceUsage):
+    label: str  # program, with its subcommand for multi-tool programs (e.g., samtools sort)
+    args: list[str]
+    step: str | None  # pipeline step which ran the command, if any
+    start: float  # seconds since metrics recording started
+    returncode: int
+
+
+class StepMetrics(ResourceUsage):
+    """
+    Resource usage of an executed step: CPU time and I/O of the whole pipeline process and every child process reaped
+    while the step ran, and the peak RSS of any process known to have peaked during it. Where other steps ran at the
+    same time (concurrent_steps), their usage is included too; commands are attributed exactly.
+    """
+
+    name: str
+    start: float  # seconds since metrics recording started
+    commands: int = 0
+    concurrent_steps: list[str] = []
+    throughput: dict[str, float] = {}
+
+
+class RunMetrics(ResourceUsage):
+    steps: list[StepMetrics]
+    commands: list[CommandMetrics]
+
+
+def _io_bytes(pid: int | str) -> tuple[int | None, int | None]:
+    try:
+        with open(f"/proc/{pid}/io", "r") as fh:
+            fields = dict(line.split(":", 1) for line in fh if ":" in line)
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _process_usage() -> ResourceUsage:
+    # Cumulative usage of this process and all of its reaped children, at the current time (wall_time is left at 0)
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read_bytes, write_bytes = _io_bytes("self")  # includes reaped children's I/O
+    return ResourceUsage(
+        user_time=own.ru_utime + children.ru_utime,
+        sys_time=own.ru_stime + children.ru_stime,
+        max_rss=max(own.ru_maxrss, children.ru_maxrss) * _RSS_UNIT,
+        read_bytes=read_bytes,
+        write_bytes=write_bytes,
+    )
+
+
+def _usage_since(before: ResourceUsage, wall_time: float) -> ResourceUsage:
+    after = _process_usage()
+    return ResourceUsage(
+        wall_time=wall_time,
+        user_time=after.user_time - before.user_time,
+        sys_time=after.sys_time - before.sys_time,
+        # Peaks are high-water marks over the process' lifetime, so only tell us something if they rose
+        max_rss=after.max_rss if after.max_rss > before.max_rss else 0,
+        read_bytes=None if after.read_bytes is None else after.read_bytes - before.read_bytes,
+        write_bytes=None if after.write_bytes is None else after.write_bytes - before.write_bytes,
+    )
+
+
+def _command_label(args: list[str]) -> str:
+    program = os.path.basename(args[0]) if args else ""
+    if program in _SUBCOMMAND_TOOLS and len(args) > 1:
+        return f"{program} {os.path.basename(args[1])}"
+    return program
+
+
+# Name of the pipeline step running in the current thread, which commands are attributed to
+_current_step: contextvars.ContextVar[str | None] = contextvars.ContextVar("_current_step", default=None)
+
+
+class MetricsRecorder:
+    """
+    Collects the metrics of every step and command run while it is active (see record_metrics.)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._t0 = time.perf_counter()
+        self._usage = _process_usage()
+        self.steps: list[StepMetrics] = []
+        self.commands: list[CommandMetrics] = []
+        self._throughput: dict[str, dict[str, float]] = {}
+
+    def elapsed(self, t: float) -> float:
+        return t - self._t0
+
+    def add_command(self, command: CommandMetrics):
+        with self._lock:
+            self.commands.append(command)
+
+    def add_throughput(self, step: str | None, name: str, per_second: float):
+        with self._lock:
+            self._throughput.setdefault(step or "", {})[name] = per_second
+
+    def add_step(self, name: str, start: float, usage: ResourceUsage):
+        with self._lock:
+            commands = [c for c in self.commands if c.step == name]
+            self.steps.append(
+                StepMetrics(
+                    name=name,
+                    start=self.elapsed(start),
+                    commands=len(commands),
+                    throughput=self._throughput.pop(name, {}),
+                    **(usage.model_dump() | {"max_rss": max([usage.max_rss, *(c.max_rss for c in commands)])}),
+                )
+            )
+
+    def report(self) -> RunMetrics:
+        usage = _usage_since(self._usage, self.elapsed(time.perf_counter()))
+        with self._lock:
+            steps = [s.model_copy(deep=True) for s in self.steps]
+            commands = list(self.commands)
+
+        for s in steps:
+            s.concurrent_steps = [
+                o.name
+                for o in steps
+                if o is not s and o.start < s.start + s.wall_time and s.start < o.start + o.wall_time
+            ]
+
+        # The run's peak is that of the pipeline process or any of its reaped children, whenever it was reached
+        usage.max_rss = _process_usage().max_rss
+        return RunMetrics(steps=steps, commands=commands, **usage.model_dump())
+
+
+# Recorder of the current run's metrics; None when metrics are not being recorded (e.g., standalone utilities.)
+_recorder: MetricsRecorder | None = None
+
+
+@contextlib.contextmanager
+def record_metrics() -> Iterator[MetricsRecorder]:
+    global _recorder
+    _recorder = MetricsRecorder()
+    try:
+        yield _recorder
+    finally:
+        _recorder = None
+
+
+class MeasuredPopen(subprocess.Popen):
+    """
+    subprocess.Popen which records the command's wall time, CPU time, peak RSS and I/O once it is waited on, for the
+    run's metrics. Commands are attributed to the step which started them.
+
+    The process is reaped with os.wait4 (for its resource usage) by poll() and wait() themselves, under their own lock,
+    and returncode is set from its exit status, so Popen never waits on the process. Where available, os.waitid first
+    waits for the process to exit without reaping it, so its I/O counters in /proc can still be read. On platforms
+    without os.wait4, the plain Popen methods are used and only wall time is recorded.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._start = time.perf_counter()
+        self._step = _current_step.get()
+        self._reap_lock = threading.Lock()
+        self._recorded = False
+        super().__init__(*args, **kwargs)
+
+    def poll(self):
+        if not _HAVE_WAIT4:
+            return self._record(super().poll())
+        # As with Popen.poll, don't wait for the lock: another thread holding it is already waiting for the process
+        if not self._reap_lock.acquire(blocking=False):
+            return None
+        try:
+            return self._reap(block=False)
+        finally:
+            self._reap_lock.release()
+
+    def wait(self, timeout=None):
+        if not _HAVE_WAIT4:
+            return self._record(super().wait(timeout))
+
+        if timeout is None:
+            with self._reap_lock:
+                return self._reap(block=True)
+
+        # Poll with a growing delay until the deadline, like Popen.wait with a timeout
+        deadline = time.monotonic() + timeout
+        delay = 0.0005
+        while (returncode := self.poll()) is None:
+            if (remaining := deadline - time.monotonic()) <= 0:
+                raise subprocess.TimeoutExpired(self.args, timeout)
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.05)
+        return returncode
+
+    def _reap(self, block: bool) -> int | None:
+        if self.returncode is not None:
+            return self.returncode
+
+        options = 0 if block else os.WNOHANG
+        read_bytes, write_bytes = None, None
+        try:
+            if _HAVE_WAITID:
+                # Wait for the process to exit without reaping it, so its I/O counters can still be read
+                if os.waitid(os.P_PID, self.pid, os.WEXITED | os.WNOWAIT | options) is None:
+                    return None
+                read_bytes, write_bytes = _io_bytes(self.pid)
+            pid, status, ru = os.wait4(self.pid, options)
+        except ChildProcessError:
+            # Reaped elsewhere, or SIGCHLD is ignored; as in Popen, the exit status is lost
+            self.returncode = 0
+            return self._record(0)
+
+        if pid == 0:  # still running (without waitid to tell us)
+            return None
+
+        self.returncode = os.waitstatus_to_exitcode(status)
+        return self._record(self.returncode, ru, read_bytes, write_bytes)
+
+    def _record(
+        self,
+        returncode: int | None,
+        ru: resource.struct_rusage | None = None,
+        read_bytes: int | None = None,
+        write_bytes: int | None = None,
+    ) -> int | None:
+        if returncode is None or (recorder := _recorder) is None or self._recorded:
+            return returncode
+        self._recorded = True
+
+        args = [str(a) for a in ([self.args] if isinstance(self.args, (str, bytes, os.PathLike)) else self.args)]
+        recorder.add_command(
+            CommandMetrics(
+                label=_command_label(args),
+                args=args,
+                step=self._step,
+                start=recorder.elapsed(self._start),
+                returncode=returncode,
+                wall_time=time.perf_counter() - self._start,
+                user_time=ru.ru_utime if ru else 0.0,
+                sys_time=ru.ru_stime if ru else 0.0,
+                max_rss=ru.ru_maxrss * _RSS_UNIT if ru else 0,
+                read_bytes=read_bytes,
+                write_bytes=write_bytes,
+            )
+        )
+        return returncode
+
+
+def measured_check_call(*popenargs, **kwargs) -> int:
+    """
+    Like subprocess.check_call, with the command's resource usage recorded (see MeasuredPopen.)
+    """
+    with MeasuredPopen(*popenargs, **kwargs) as p:
+        try:
+            returncode = p.wait()
+        except BaseException:  # e.g., KeyboardInterrupt; as in subprocess.call
+            p.kill()
+            raise
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, p.args)
+    return 0
+
+
+@contextlib.contextmanager
+def measure_step(name: str) -> Iterator[None]:
+    """
+    Measures a pipeline step run in the current thread, attributing any commands it starts (from this thread, or from
+    a step_thread_pool) to it.
+    """
+
+    token = _current_step.set(name)
+    start = time.perf_counter()
+    usage = _process_usage()
+    try:
+        yield
+    finally:
+        _current_step.reset(token)
+        if (recorder := _recorder) is not None:
+            recorder.add_step(name, start, _usage_since(usage, time.perf_counter() - start))
+
+
+def step_thread_pool(max_workers: int, **kwargs) -> ThreadPoolExecutor:
+    """
+    ThreadPoolExecutor whose worker threads attribute the commands they run to the step creating it (new threads do not
+    inherit the step of the thread which starts them.)
+    """
+    return ThreadPoolExecutor(max_workers, initializer=_current_step.set, initargs=(_current_step.get(),), **kwargs)
+
+
+def record_throughput(name: str, per_second: float):
+    """
+    Records a throughput figure (e.g., read_pairs_per_second) for the step running in the current thread.
+    """
+    if (recorder := _recorder) is not None:
+        recorder.add_throughput(_current_step.get(), name, per_second)
+
+
+def _table_row(kind: str, name: str, count: int, usages: list[ResourceUsage], throughput: dict[str, float]) -> dict:
+    def _sum(field: str) -> int | None:
+        values = [getattr(u, field) for u in usages]
+        return None if any(v is None for v in values) else sum(values)
+
+    return {
+        "kind": kind,
+        "name": name,
+        "count": count,
+        "wall_time": sum(u.wall_time for u in usages),
+        "user_time": sum(u.user_time for u in usages),
+        "sys_time": sum(u.sys_time for u in usages),
+        "max_rss": max((u.max_rss for u in usages), default=0),
+        "read_bytes": _sum("read_bytes"),
+        "write_bytes": _sum("write_bytes"),
+        "throughput": ";".join(f"{k}={v:.1f}" for k, v in throughput.items()),
+    }
+
+
+def metrics_table(metrics: RunMetrics) -> list[dict]:
+    """
+    Summary table of a run's metrics, with METRICS_TABLE_COLUMNS: one row per step (in start order), one per kind of
+    command (summed over every time it was run), and one for the whole run.
+    """
+
+    rows = [_table_row("step", s.name, 1, [s], s.throughput) for s in sorted(metrics.steps, key=lambda s: s.start)]
+
+    by_label: dict[str, list[CommandMetrics]] = {}
+    for c in metrics.commands:
+        by_label.setdefault(c.label, []).append(c)
+    rows.extend(_table_row("command", label, len(cs), cs, {}) for label, cs in sorted(by_label.items()))
+
+    rows.append(_table_row("run", "total", 1, [metrics], {}))
+    return rows
+
+
+def _format_row(row: dict) -> list[str]:
+    def _mib(v: int | None) -> str:
+        return "-" if v is None else f"{v / 1024**2:.1f}"
+
+    cpu = row["user_time"] + row["sys_time"]
+    return [
+        row["kind"],
+        row["name"],
+        str(row["count"]),
+        f"{row['wall_time']:.1f}",
+        f"{cpu:.1f}",
+        f"{cpu / row['wall_time'] * 100:.0f}" if row["wall_time"] else "-",
+        _mib(row["max_rss"] or None),  # 0: no new peak during the step
+        _mib(row["read_bytes"]),
+        _mib(row["write_bytes"]),
+        row["throughput"],
+    ]
+
+
+def write_run_metrics(metrics: RunMetrics, run_work_dir: Path):
+    """
+    Writes a run's metrics to metrics.json (everything) and metrics.tsv (summary table) in its work directory, and logs
+    the summary table.
+    """
+
+    with open(run_work_dir / "metrics.json", "w") as fh:
+        fh.write(metrics.model_dump_json(indent=2))
+
+    rows = metrics_table(metrics)
+    with open(run_work_dir / "metrics.tsv", "w", newline="") as fh:
+        writer = csv.DictWriter(fh, fieldnames=METRICS_TABLE_COLUMNS, delimiter="\t", lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(rows)
+
+    table = [["kind", "name", "n", "wall s", "CPU s", "CPU %", "peak MiB", "read MiB", "written MiB", "throughput"]]
+    table.extend(_format_row(row) for row in rows)
+    widths = [max(len(r[i]) for r in table) for i in range(len(table[0]))]
+    logger.info("Run metrics:")
+    for r in table:
+        logger.info("  %s", "  ".join(v.ljust(w) for v, w in zip(r, widths)).rstrip())
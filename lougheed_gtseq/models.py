@@ -1,12 +1,46 @@
 from pathlib import Path
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, computed_field
+from typing import Literal
 
-__all__ = ["SexCallingParams", "Params", "Sample"]
+from .compression import Compression
+
+__all__ = [
+    "AlignMode",
+    "AlignReference",
+    "Genotyper",
+    "SexGenotyper",
+    "PlotMode",
+    "SexCallingParams",
+    "Params",
+    "Sample",
+    "SplitStats",
+    "SplitManifest",
+    "CachedFile",
+    "CacheManifest",
+]
+
+# sample: one bwa run per sample; batch: one bwa run for all samples, producing a multi-sample BAM with a read group per
+# sample; batch-split: like batch, but the multi-sample BAM is split back into per-sample BAMs.
+AlignMode = Literal["sample", "batch", "batch-split"]
+
+# genome: align to the full reference genome; amplicons: align to a small reference built from windows around the
+# panel's sites, lifting alignments back to genome coordinates.
+AlignReference = Literal["genome", "amplicons"]
+
+# bcftools: bcftools mpileup | bcftools call; native: in-process pysam pileup and vectorised genotype calling.
+Genotyper = Literal["bcftools", "native"]
+
+# perl: GTseq_Genotyper_v3.pl / GTseq_GenoCompile_v3.pl from Campbell et al.; native: in-process re-implementation.
+SexGenotyper = Literal["perl", "native"]
+
+# none: no plots; terminal: text histograms only; png: text histograms, plus PNG figures rendered in the background.
+PlotMode = Literal["none", "terminal", "png"]
 
 
 class SexCallingParams(BaseModel):
     # Sex-linked marker calling parameters
     call_sex: bool
+    sex_genotyper: SexGenotyper
     gtseq_scripts: Path
     sex_calls: Path
 
@@ -19,19 +53,36 @@ class Params(SexCallingParams):
     run: Path | tuple[Path, Path]  # Illumina machine output directory or tuple of (R1 fastq, R2 fastq)
     samples: Path
 
+    # Demultiplexing parameters
+    index_mismatches: int
+    split_compression: Compression
+
+    # Alignment parameters
+    align_mode: AlignMode
+    align_reference: AlignReference
+    panel_bams: bool  # only keep alignments overlapping the species panel's amplicons
+
+    # Genotyping parameters
+    genotyper: Genotyper
+    genotype_shards: int  # number of panel region shards to genotype concurrently; 1 = no sharding
+    pileup_cache: bool  # re-use per-BAM pileups (keyed by BAM checksum) from previous runs in the work directory
+
     # QC parameters
     min_dp: int
     min_gq: int
     min_called_prop: float
     het_sigma: int
     drop_failed_samples: bool
+    plots: PlotMode
 
     # Output
     vcf: Path
     sex_calls: Path | None  # override to make optional
 
-    # Continuation
+    # Continuation / re-use of step results
     continue_run: Path | None
+    step_cache: bool  # re-use results of unchanged steps from any run in the work directory
+    step_cache_hash: bool  # fingerprint input files by content hash, rather than path, size and modification time
 
     # Other parameters
     genomes: Path | None
@@ -47,3 +98,40 @@ class Sample(BaseModel):
 
     def full_name(self) -> str:
         return f"{self.sample_id}_{self.batch}_plate_{self.plate}_{str(self.i7).zfill(3)}_{self.i5}"
+
+
+class SplitStats(BaseModel):
+    read_pairs: int = 0
+    bases: int = 0  # R1 + R2
+    quality_sum: int = 0  # sum of PHRED base qualities, R1 + R2
+
+    @computed_field
+    @property
+    def mean_quality(self) -> float:
+        return self.quality_sum / self.bases if self.bases else 0.0
+
+    def add(self, read_pairs: int, bases: int, quality_sum: int):
+        self.read_pairs += read_pairs
+        self.bases += bases
+        self.quality_sum += quality_sum
+
+
+class SplitManifest(BaseModel):
+    # Per-sample demultiplexing statistics, collected while splitting reads by sample; keyed by sample index
+    samples: dict[int, SplitStats]
+    unassigned_read_pairs: int
+
+    def read_pairs(self, sample_index: int) -> int:
+        return self.samples[sample_index].read_pairs if sample_index in self.samples else 0
+
+
+class CachedFile(BaseModel):
+    size: int
+    sha256: str
+
+
+class CacheManifest(BaseModel):
+    # Record of a complete set of cached reference files (e.g., a genome and its indices), written once they are built
+    source_url: str | None = None
+    source_md5: str | None = None  # checksum of the file as downloaded, before any re-compression
+    files: dict[str, CachedFile]  # keyed by file name
@@ -0,0 +1,156 @@
+import re
+from pathlib import Path
+from typing import Iterable, Iterator
+
+__all__ = [
+    "PANEL_WINDOW",
+    "panel_allele_file",
+    "load_panel_sites",
+    "PanelIntervals",
+    "amplicon_contig_name",
+    "SamLiftover",
+]
+
+# Half-width (in bases) of the window kept around each panel site; wide enough to hold any GTseq amplicon's reads
+PANEL_WINDOW = 250
+
+# CIGAR operations which consume reference bases
+_CIGAR_REF_OPS = re.compile(rb"(\d+)[MDN=X]")
+
+
+def panel_allele_file(species: str) -> Path:
+    return Path(__file__).parent / "alleles" / f"{species}.tsv"
+
+
+def load_panel_sites(allele_file: Path) -> list[tuple[str, int]]:
+    """
+    Loads (contig, 1-based position) pairs for the sites in a panel allele TSV (contig, position, alleles.)
+    """
+    sites = []
+    with open(allele_file, "r") as fh:
+        for line in fh:
+            if line.strip():
+                contig, pos, *_ = line.split("\t")
+                sites.append((contig, int(pos)))
+    return sites
+
+
+class PanelIntervals:
+    """
+    Merged, 1-based inclusive intervals around panel sites, e.g. to extract an amplicon mini-reference or to write a BED
+    file restricting alignments to the panel.
+    """
+
+    def __init__(self, sites: list[tuple[str, int]], window: int = PANEL_WINDOW):
+        by_contig: dict[str, list[tuple[int, int]]] = {}
+        for contig, pos in sites:
+            by_contig.setdefault(contig, []).append((max(pos - window, 1), pos + window))
+
+        self._intervals: dict[str, list[tuple[int, int]]] = {}
+
+        for contig, intervals in by_contig.items():
+            merged: list[tuple[int, int]] = []
+            for start, end in sorted(intervals):
+                if merged and start <= merged[-1][1] + 1:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+                else:
+                    merged.append((start, end))
+            self._intervals[contig] = merged
+
+    @classmethod
+    def from_allele_file(cls, allele_file: Path, window: int = PANEL_WINDOW) -> "PanelIntervals":
+        return cls(load_panel_sites(allele_file), window)
+
+    def __len__(self) -> int:
+        return sum(map(len, self._intervals.values()))
+
+    def __iter__(self) -> Iterator[tuple[str, int, int]]:
+        # (contig, start, end) for each merged interval, in contig order of first appearance and then position order
+        for contig, intervals in self._intervals.items():
+            yield from ((contig, start, end) for start, end in intervals)
+
+    def write_bed(self, path: Path):
+        """
+        Writes the intervals as a BED file (0-based, half-open), e.g. for samtools view -L.
+        """
+        with open(path, "w") as fh:
+            fh.writelines(f"{contig}\t{start - 1}\t{end}\n" for contig, start, end in self)
+
+
+def amplicon_contig_name(contig: str, start: int, end: int) -> str:
+    """
+    Name of an amplicon mini-reference contig holding the 1-based inclusive region [start, end] of a genome contig.
+    """
+    return f"{contig}_{start}_{end}"
+
+
+class SamLiftover:
+    """
+    Lifts SAM lines aligned to an amplicon mini-reference (whose contigs are named by amplicon_contig_name) back to
+    genome coordinates. The mini-reference's @SQ header lines are replaced with the genome's, so the resulting
+    alignments look as if they had been aligned to the whole genome. SA/XA tags hold mini-reference coordinates in
+    their values and are dropped rather than rewritten.
+
+    Mates aligned to different amplicon contigs of the same genome contig have no TLEN from bwa; it is filled in as
+    bwa would have for a pair on one contig (5' end to 5' end), using the mate's CIGAR from its MC tag. This is left
+    to the (rare) lines which need it, so the common case stays a few byte operations per line.
+    """
+
+    def __init__(self, genome_contigs: Iterable[tuple[str, int]]):
+        self._sq_header = b"".join(f"@SQ\tSN:{name}\tLN:{length}\n".encode() for name, length in genome_contigs)
+        self._offsets: dict[bytes, tuple[bytes, int]] = {}
+
+    def _add_amplicon_contig(self, sq_line: bytes):
+        name = next(f[3:] for f in sq_line.rstrip(b"\r\n").split(b"\t") if f.startswith(b"SN:"))
+        contig, start, _end = name.rsplit(b"_", 2)
+        self._offsets[name] = (contig, int(start) - 1)
+
+    @staticmethod
+    def _template_length(fields: list[bytes]) -> bytes:
+        flag = int(fields[1])
+        if flag & 0xC:  # read or mate unmapped
+            return fields[8]
+
+        if flag & 0x20:
+            if (mate_cigar := next((f[5:] for f in fields[11:] if f.startswith(b"MC:Z:")), None)) is None:
+                return fields[8]  # without the mate's CIGAR, its 5' end is unknown
+            p1 = int(fields[7]) + sum(int(n) for n in _CIGAR_REF_OPS.findall(mate_cigar)) - 1
+        else:
+            p1 = int(fields[7])
+
+        p0 = int(fields[3]) + (sum(int(n) for n in _CIGAR_REF_OPS.findall(fields[5])) - 1 if flag & 0x10 else 0)
+        return b"%d" % -(p0 - p1 + (p0 > p1) - (p0 < p1))
+
+    def lift_lines(self, lines: Iterable[bytes]) -> Iterator[bytes]:
+        sq_written = False
+        offsets = self._offsets
+
+        for line in lines:
+            if line.startswith(b"@"):
+                if line.startswith(b"@SQ\t"):
+                    self._add_amplicon_contig(line)
+                    if not sq_written:
+                        sq_written = True
+                        yield self._sq_header
+                else:
+                    yield line
+                continue
+
+            fields = line.rstrip(b"\n").split(b"\t")
+            rname, rnext = fields[2], fields[6]
+
+            if (lift := offsets.get(rname)) is not None:
+                fields[2] = lift[0]
+                if fields[3] != b"0":
+                    fields[3] = b"%d" % (int(fields[3]) + lift[1])
+
+            if rnext == b"=":
+                rnext = rname
+            if (lift_next := offsets.get(rnext)) is not None:
+                fields[6] = b"=" if lift_next[0] == fields[2] else lift_next[0]
+                if fields[7] != b"0":
+                    fields[7] = b"%d" % (int(fields[7]) + lift_next[1])
+                if rnext != rname and fields[6] == b"=":
+                    fields[8] = self._template_length(fields)
+
+            yield b"\t".join(f for i, f in enumerate(fields) if i < 11 or f[:3] not in (b"SA:", b"XA:")) + b"\n"
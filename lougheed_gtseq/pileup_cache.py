@@ -0,0 +1,261 @@
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import struct
+import subprocess
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import pysam
+
+from .genome_cache import DIGEST_CHUNK_SIZE
+from .logger import logger
+from .metrics import MeasuredPopen, step_thread_pool
+from .step_cache import file_fingerprint
+
+__all__ = [
+    "PILEUP_CACHE_VERSION",
+    "bam_content_digest",
+    "cached_bam_digest",
+    "pileup_settings_key",
+    "load_panel_alleles",
+    "add_panel_alleles",
+    "fill_missing_samples",
+    "cached_pileups",
+]
+
+# Bump when the cached pileup contents change (e.g., different mpileup options), so stale records are not re-used
+PILEUP_CACHE_VERSION = 1
+
+PileupKey = tuple[str, int]  # contig, position
+
+
+def bam_content_digest(bam: Path) -> str:
+    """
+    Checksums a BAM's alignment records, reference sequence dictionary and read groups, ignoring the rest of its header
+    (which holds e.g. @PG lines with per-run file paths), so that re-aligning the same reads gives the same digest.
+    """
+
+    h = hashlib.sha256()
+
+    # BAM files are BGZF, which is multi-member gzip; read the decompressed stream: magic, l_text, text, n_ref, refs...
+    with gzip.open(bam, "rb") as fh:
+        if fh.read(4) != b"BAM\1":
+            raise ValueError(f"Not a BAM file: {bam}")
+
+        (l_text,) = struct.unpack("<i", fh.read(4))
+        header_text = fh.read(l_text)
+        h.update(b"".join(line + b"\n" for line in header_text.split(b"\n") if line.startswith(b"@RG")))
+
+        (n_ref,) = struct.unpack("<i", fh.read(4))
+        for _ in range(n_ref):
+            (l_name,) = struct.unpack("<i", fh.read(4))
+            h.update(fh.read(l_name + 4))  # name and length
+
+        while chunk := fh.read(DIGEST_CHUNK_SIZE):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def cached_bam_digest(bam: Path, cache_dir: Path) -> str:
+    """
+    Returns bam_content_digest(bam), looked up by the BAM's file fingerprint (path, size and modification time) in
+    the cache's digests directory, so that BAMs are only decompressed and checksummed when they are new or changed.
+    """
+
+    fingerprint = hashlib.sha256(json.dumps(file_fingerprint(bam)).encode()).hexdigest()[:24]
+    digest_file = cache_dir / "digests" / fingerprint
+
+    try:
+        return digest_file.read_text()
+    except FileNotFoundError:
+        pass
+
+    digest = bam_content_digest(bam)
+
+    digest_file.parent.mkdir(exist_ok=True)
+    tmp = digest_file.with_name(f"{fingerprint}.{os.getpid()}.tmp")  # other runs may share the cache
+    tmp.write_text(digest)
+    os.replace(tmp, digest_file)
+
+    return digest
+
+
+def pileup_settings_key(ref_genome: Path, allele_file: Path) -> str:
+    """
+    Digest of everything besides the BAM which determines a cached pileup's contents.
+    """
+    h = hashlib.sha256(f"{PILEUP_CACHE_VERSION}\n{ref_genome.name}\n".encode())
+    with open(allele_file, "rb") as fh:
+        h.update(fh.read())
+    return h.hexdigest()[:12]
+
+
+def load_panel_alleles(allele_file: Path) -> dict[PileupKey, list[str]]:
+    """
+    Loads {(contig, position): [REF, ALT, ...]} from a panel allele TSV.
+    """
+    panel = {}
+    with open(allele_file, "r") as fh:
+        for line in fh:
+            if line.strip():
+                contig, pos, alleles = line.rstrip("\n").split("\t")[:3]
+                panel[(contig, int(pos))] = alleles.split(",")
+    return panel
+
+
+def _genotype_index(j: int, k: int) -> int:
+    # VCF ordering of diploid genotypes j/k (Number=G fields)
+    j, k = min(j, k), max(j, k)
+    return k * (k + 1) // 2 + j
+
+
+def add_panel_alleles(lines: Iterable[str], panel: dict[PileupKey, list[str]]) -> Iterator[str]:
+    """
+    Rewrites single-sample mpileup VCF records so that every panel allele is listed explicitly, even if the sample
+    has no reads supporting it. mpileup summarizes unseen alleles as <*>, and bcftools merge does not carry <*>'s
+    likelihoods over to alleles seen only in other samples; listing the panel alleles up front, with <*>'s values,
+    makes merged per-sample pileups equivalent to a joint mpileup of the same BAMs for genotype calling.
+    """
+
+    for line in lines:
+        if line.startswith("#"):
+            yield line
+            continue
+
+        fields = line.rstrip("\n").split("\t")
+        old_alleles = [fields[3], *fields[4].split(",")]
+
+        if (panel_alleles := panel.get((fields[0], int(fields[1])))) is None or "<*>" not in old_alleles:
+            yield line
+            continue
+
+        unseen = [a for a in panel_alleles[1:] if a not in old_alleles]
+        if not unseen:
+            yield line
+            continue
+
+        star = old_alleles.index("<*>")
+        new_alleles = [*old_alleles[:star], *unseen, *old_alleles[star:]]
+        allele_map = [old_alleles.index(a) if a in old_alleles else star for a in new_alleles]
+        n = len(new_alleles)
+
+        def _per_allele(values: list[str], missing: str) -> list[str]:
+            return [values[allele_map[i]] if new_alleles[i] in old_alleles else missing for i in range(n)]
+
+        fields[4] = ",".join(new_alleles[1:])
+
+        info = fields[7].split(";")
+        for i, entry in enumerate(info):
+            if entry.startswith("QS="):
+                info[i] = "QS=" + ",".join(_per_allele(entry[3:].split(","), "0"))
+        fields[7] = ";".join(info)
+
+        format_keys = fields[8].split(":")
+        for si in range(9, len(fields)):
+            values = fields[si].split(":")
+            for fi, key in enumerate(format_keys):
+                if fi >= len(values) or values[fi] == ".":
+                    continue
+                if key == "PL":
+                    pl = values[fi].split(",")
+                    values[fi] = ",".join(
+                        pl[_genotype_index(allele_map[j], allele_map[k])] for k in range(n) for j in range(k + 1)
+                    )
+                elif key == "AD":
+                    values[fi] = ",".join(_per_allele(values[fi].split(","), "0"))
+            fields[si] = ":".join(values)
+
+        yield "\t".join(fields) + "\n"
+
+
+def fill_missing_samples(lines: Iterable[str]) -> Iterator[str]:
+    """
+    Rewrites merged pileup VCF records so that samples without a record of their own at a site (i.e., with no reads
+    there) have zero-coverage values - all-zero PL and AD, and a DP of 0 - as they would in a joint mpileup, instead of
+    the missing values bcftools merge fills in for them.
+    """
+
+    for line in lines:
+        if line.startswith("#"):
+            yield line
+            continue
+
+        fields = line.rstrip("\n").split("\t")
+        n = len(fields[4].split(",")) + 1
+        zeros = {"PL": ",".join(["0"] * (n * (n + 1) // 2)), "AD": ",".join(["0"] * n), "DP": "0"}
+
+        format_keys = fields[8].split(":")
+        for si in range(9, len(fields)):
+            values = fields[si].split(":")
+            if any(v != "." for v in values):
+                continue
+            values += ["."] * (len(format_keys) - len(values))  # trailing missing values may be dropped
+            fields[si] = ":".join(zeros.get(key, v) for key, v in zip(format_keys, values))
+
+        yield "\t".join(fields) + "\n"
+
+
+def _build_pileup(ref_genome: Path, regions: Path, panel: dict[PileupKey, list[str]], bam: Path, cached: Path) -> None:
+    tmp = cached.with_name(f"{cached.name}.{os.getpid()}.tmp")  # other runs may share the cache
+    tmp_gz = Path(f"{tmp}.gz")
+
+    pileup_p = MeasuredPopen(
+        ("bcftools", "mpileup", "-f", str(ref_genome), "-R", str(regions), "--annotate", "AD,DP", "-Ov", str(bam)),
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        with open(tmp, "w") as fh:
+            fh.writelines(add_panel_alleles(pileup_p.stdout, panel))
+    finally:
+        pileup_p.stdout.close()
+    if pileup_p.wait() != 0:
+        raise subprocess.CalledProcessError(pileup_p.returncode, pileup_p.args)
+
+    # bgzip + tabix index (removing the plain-text file), then move into place - index first, so a cached record is
+    # only ever visible once it is complete.
+    pysam.tabix_index(str(tmp), preset="vcf", force=True)
+    os.replace(f"{tmp_gz}.tbi", f"{cached}.tbi")
+    os.replace(tmp_gz, cached)
+
+
+def cached_pileups(
+    bams: list[Path], ref_genome: Path, allele_file: Path, regions: Path, cache_dir: Path, processes: int
+) -> list[Path]:
+    """
+    Returns per-BAM pileup records (bgzipped, indexed VCFs of genotype likelihoods, allele depths and read depths at
+    the panel sites), piling up only BAMs whose contents have not been seen before. Records are keyed by BAM checksum,
+    so they survive across runs and BAM moves/renames; checksums themselves are cached by BAM file fingerprint.
+    :param bams: BAMs to get pileup records for.
+    :param ref_genome: reference genome the BAMs were aligned to.
+    :param allele_file: panel allele TSV.
+    :param regions: bgzipped, tabix-indexed copy of the panel allele TSV for indexed BAM access.
+    :param cache_dir: pileup cache directory.
+    :param processes: maximum number of BAMs to pile up at once.
+    :return: list of pileup record files, in the same order as bams.
+    """
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    settings_key = pileup_settings_key(ref_genome, allele_file)
+    panel = load_panel_alleles(allele_file)
+
+    with step_thread_pool(max_workers=max(processes, 1)) as executor:
+        records = [
+            cache_dir / f"{digest[:24]}.{settings_key}.vcf.gz"
+            for digest in executor.map(cached_bam_digest, bams, itertools.repeat(cache_dir))
+        ]
+
+        # Identical BAMs (e.g., empty ones) share a record, which only needs to be piled up once
+        missing = {record: bam for bam, record in zip(bams, records) if not record.exists()}
+        logger.info("Pileup cache: %d/%d BAMs already piled up", len(bams) - len(missing), len(bams))
+
+        for future in [
+            executor.submit(_build_pileup, ref_genome, regions, panel, bam, record) for record, bam in missing.items()
+        ]:
+            future.result()
+
+    return records
@@ -1,39 +1,34 @@
-import pickle
 from datetime import datetime
 from pathlib import Path
-from typing import Callable
 
 from .logger import logger
+from .metrics import record_metrics, write_run_metrics
 from .models import Params
+from .plots import wait_for_plots
+from .scheduling import CpuBudget, ScheduleReport, Step, run_steps
+from .step_cache import StepCache
 from .steps.load_samples import load_samples
 from .steps.download_ref import download_genome_if_needed
+from .steps.amplicon_ref import build_amplicon_reference_if_needed
 from .steps.fastq_generate import fastq_generate
 from .steps.fastq_split import fastq_split
 from .steps.fastq_align import fastq_align
 from .steps.call_alleles import call_alleles
 from .steps.reheader import reheader_vcf
-from .steps.run_qc import run_qc
+from .steps.run_qc import qc_vcf_path, run_qc
 from .steps.call_sex_markers import call_sex_markers
 
 __all__ = ["run_pipeline"]
 
 
-def step(name, call: Callable, work_dir: Path, only_if: bool | None = None):
-    if only_if is not None and not only_if:
-        logger.info("step %s: not needed", name)
-        return None
-
-    done_file = work_dir / f"{name}.done"
-    if done_file.exists():
-        logger.info("step %s: already done", name)
-        with open(done_file, "rb") as fh:
-            return pickle.load(fh)
-    else:
-        logger.info("step %s: executing", name)
-        res = call()
-        with open(done_file, "wb") as fh:
-            pickle.dump(res, fh)
-        return res
+def _log_schedule_report(report: ScheduleReport):
+    by_name = {t.name: t for t in report.steps}
+    logger.info(
+        "Pipeline finished in %.1fs (%.1fs of step time); critical path: %s",
+        report.wall_time,
+        report.step_time,
+        " -> ".join(f"{name} ({by_name[name].duration:.1f}s)" for name in report.critical_path),
+    )
 
 
 def run_pipeline(params: Params):
@@ -49,54 +44,200 @@ def run_pipeline(params: Params):
     fastq_dir = run_work_dir / "fastq"
     fastq_dir.mkdir(exist_ok=True)
 
-    # 1. Load samples from sample sheet
-    samples = load_samples(params.batch, params.samples, logger)
+    def _p(threads: int) -> Params:
+        # Multithreaded steps size their own pools from params.processes: give them what they were allotted
+        return params.model_copy(update={"processes": threads})
+
+    # Steps are declared with the values they need and produce, and run concurrently as soon as their inputs are
+    # ready, sharing params.processes CPU threads. Declaration order is their priority when threads are short.
+    # Heavy steps start with a guaranteed share of the budget (and take more if it is free), leaving the rest to steps
+    # which run alongside them, e.g. the genome download (one thread) or sex-linked marker calling (whatever is left.)
+    main_share = max(params.processes * 3 // 4, 1)
+    steps = [
+        # 1. Load samples from sample sheet
+        Step(
+            name="load_samples",
+            call=lambda threads: load_samples(params.batch, params.samples, logger),
+            outputs=("samples",),
+        ),
+        # 2. Download the reference genome, if needed (mostly network-bound, so it only takes one thread)
+        Step(
+            name="download_genome",
+            call=lambda threads: download_genome_if_needed(_p(threads)),
+            outputs=("ref_genome",),
+        ),
+        #    ... and, if aligning to amplicons only, build the amplicon mini-reference from it
+        Step(
+            name="amplicon_reference",
+            call=lambda threads, ref_genome: build_amplicon_reference_if_needed(params.species, ref_genome),
+            inputs=("ref_genome",),
+            outputs=("amplicon_ref",),
+            only_if=params.align_reference == "amplicons",
+        ),
+        # 3. If R2 is not set: Re-generate FASTQ using bcl2fastq so that we get index sequences in read names
+        Step(
+            name="fastq_generate",
+            call=lambda threads: fastq_generate(_p(threads), fastq_dir),
+            outputs=("generated_fastq_dir",),
+            threads=params.processes,
+            min_threads=main_share,
+            only_if=isinstance(params.run, Path),
+            cache=True,
+            key_files=(params.run,) if isinstance(params.run, Path) else (),
+        ),
+        # 4. Split FASTQ by sample
+        Step(
+            name="fastq_split",
+            # bcl2fastq output may come from a previous run's directory (step cache); split reads are written next to it
+            call=lambda threads, samples, generated_fastq_dir: fastq_split(
+                samples,
+                generated_fastq_dir or fastq_dir,
+                r1_r2=params.run if isinstance(params.run, tuple) else None,
+                processes=threads,
+                index_mismatches=params.index_mismatches,
+                compression=params.split_compression,
+            ),
+            inputs=("samples", "generated_fastq_dir"),
+            outputs=("sample_fastqs_r1", "sample_fastqs_r2", "split_manifest"),
+            threads=params.processes,
+            min_threads=main_share,
+            cache=True,
+            key_params={
+                "index_mismatches": params.index_mismatches,
+                "split_compression": params.split_compression,
+            },
+            key_files=params.run if isinstance(params.run, tuple) else (),
+        ),
+        # 5. Align sample FASTQs to the reference genome
+        Step(
+            name="fastq_align",
+            call=lambda threads, samples, sample_fastqs_r1, sample_fastqs_r2, split_manifest, ref_genome, amplicon_ref: (
+                fastq_align(
+                    _p(threads),
+                    run_work_dir,
+                    samples,
+                    sample_fastqs_r1,
+                    sample_fastqs_r2,
+                    split_manifest,
+                    ref_genome,
+                    amplicon_ref,
+                )
+            ),
+            inputs=(
+                "samples",
+                "sample_fastqs_r1",
+                "sample_fastqs_r2",
+                "split_manifest",
+                "ref_genome",
+                "amplicon_ref",
+            ),
+            outputs=("sample_bams",),
+            threads=params.processes,
+            min_threads=main_share,
+            cache=True,
+            key_params={
+                "species": params.species,
+                "align_mode": params.align_mode,
+                "align_reference": params.align_reference,
+                "panel_bams": params.panel_bams,
+            },
+        ),
+        # 6. Call alleles for the species panel and generate a VCF
+        Step(
+            name="call_alleles",
+            call=lambda threads, sample_bams, ref_genome: call_alleles(
+                _p(threads), run_work_dir, sample_bams, ref_genome
+            ),
+            inputs=("sample_bams", "ref_genome"),
+            threads=params.processes,
+            min_threads=main_share,
+            cache=True,
+            key_params={
+                "species": params.species,
+                "genotyper": params.genotyper,
+                "pileup_cache": params.pileup_cache,
+                "vcf": params.vcf,
+            },
+            output_files=(params.vcf,),
+        ),
+        # 7. Re-header the VCF to normalize/standardize sample names
+        Step(
+            name="reheader_vcf",
+            call=lambda threads, samples: reheader_vcf(samples, params.vcf, logger),
+            inputs=("samples",),
+            after=("call_alleles",),
+            cache=True,
+            key_files=(params.vcf,),  # re-headered in place; cached under its state both before and after
+            output_files=(params.vcf,),
+            modifies=(params.vcf,),
+        ),
+        # 8. Run quality control steps on the VCF and generate a second, derived, quality-controlled VCF
+        Step(
+            name="run_qc",
+            call=lambda threads: run_qc(
+                params.work_dir,
+                params.vcf,
+                None,  # infer second output filename from first output filename
+                params.min_dp,
+                params.min_gq,
+                params.min_called_prop,
+                params.het_sigma,
+                params.drop_failed_samples,
+                params.plots,
+            ),
+            after=("reheader_vcf",),
+            cache=True,
+            key_params={
+                "work_dir": params.work_dir,
+                "min_dp": params.min_dp,
+                "min_gq": params.min_gq,
+                "min_called_prop": params.min_called_prop,
+                "het_sigma": params.het_sigma,
+                "drop_failed_samples": params.drop_failed_samples,
+                "plots": params.plots,
+            },
+            key_files=(params.vcf,),
+            output_files=(qc_vcf_path(params.vcf, params.min_dp, params.min_gq),),
+        ),
+        # 9. (Optional) call sex-linked markers; only needs the split FASTQs, so it runs alongside steps 5-8
+        # TODO: what to do about R2 here?
+        Step(
+            name="call_sex_markers",
+            call=lambda threads, samples, sample_fastqs_r1: call_sex_markers(
+                params, run_work_dir, samples, sample_fastqs_r1, threads
+            ),
+            inputs=("samples", "sample_fastqs_r1"),
+            threads=params.processes,
+            min_threads=1,
+            only_if=params.call_sex,
+            cache=True,
+            key_params={
+                "species": params.species,
+                "sex_genotyper": params.sex_genotyper,
+                "sex_calls": params.sex_calls,
+            },
+            output_files=(params.sex_calls,) if params.sex_calls else (),
+        ),
+    ]
 
-    # 2. If R2 is not set: Re-generate FASTQ using bcl2fastq so that we get index sequences in read names
-    step(
-        "fastq_generate", lambda: fastq_generate(params, fastq_dir), run_work_dir, only_if=isinstance(params.run, Path)
-    )
+    if params.call_sex:
+        logger.info("Calling sex-linked markers and generating CSV: %s", params.sex_calls)
 
-    # 3. Split FASTQ by sample
-    sample_fastqs_r1, sample_fastqs_r2 = step(
-        "fastq_split",
-        lambda: fastq_split(samples, fastq_dir, r1_r2=params.run if isinstance(params.run, tuple) else None),
-        run_work_dir,
-    )
+    # Step results are cached for the whole work directory, so unchanged steps are re-used by later runs too
+    step_cache = StepCache(params.work_dir / "step_cache", params.step_cache_hash) if params.step_cache else None
 
-    # 4. Download the reference genome, if needed
-    ref_genome = download_genome_if_needed(params)
+    # Every executed step and every external command it runs is measured (wall time, CPU time, peak RSS and I/O)
+    with record_metrics() as recorder:
+        _, report = run_steps(steps, CpuBudget(params.processes), step_cache)
 
-    # 5. Align sample FASTQs to the reference genome
-    sample_bams = step(
-        "fastq_align",
-        lambda: fastq_align(params, run_work_dir, samples, sample_fastqs_r1, sample_fastqs_r2, ref_genome),
-        run_work_dir,
-    )
+        # QC figures are rendered in the background while the remaining steps run; make sure they are written before
+        # exiting
+        wait_for_plots()
 
-    # 6. Call alleles for the species panel and generate a VCF
-    step("call_alleles", lambda: call_alleles(params, run_work_dir, sample_bams, ref_genome), run_work_dir)
-
-    # 7. Re-header the VCF to normalize/standardize sample names
-    step("reheader_vcf", lambda: reheader_vcf(samples, params.vcf, logger), run_work_dir)
-
-    # 8. Run quality control steps on the VCF and generate a second, derived, quality-controlled VCF
-    step(
-        "run_qc",
-        lambda: run_qc(
-            params.work_dir,
-            params.vcf,
-            None,  # infer second output filename from first output filename
-            params.min_dp,
-            params.min_gq,
-            params.min_called_prop,
-            params.het_sigma,
-            params.drop_failed_samples,
-        ),
-        run_work_dir,
-    )
+        metrics = recorder.report()
 
-    # 9. (Optional) call sex-linked markers
-    if params.call_sex:
-        logger.info("Calling sex-linked markers and generating CSV: %s", params.sex_calls)
-        call_sex_markers(params, run_work_dir, samples, sample_fastqs_r1)  # TODO: what to do about R2 here?
+    _log_schedule_report(report)
+    with open(run_work_dir / "schedule.json", "w") as fh:
+        fh.write(report.model_dump_json(indent=2))
+
+    write_run_metrics(metrics, run_work_dir)
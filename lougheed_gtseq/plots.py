@@ -0,0 +1,94 @@
+import multiprocessing
+import numpy as np
+import termplotlib as tpl
+
+from pathlib import Path
+from pydantic import BaseModel
+
+from .logger import logger
+from .models import PlotMode
+
+__all__ = [
+    "PLOT_DPI",
+    "Histogram",
+    "histogram",
+    "render_plots",
+    "wait_for_plots",
+]
+
+PLOT_DPI = 220
+
+# PNG rendering processes started by render_plots, which have not been waited on yet
+_plot_processes: list[multiprocessing.Process] = []
+
+
+class Histogram(BaseModel):
+    # Pre-computed histogram and its presentation; small and picklable, so it can be sent to a rendering process
+    counts: list[int]
+    edges: list[float]
+    title: str
+    x_label: str
+    y_label: str
+    v_lines: list[tuple[float, str]] = []  # (x, colour)
+    fig_size: tuple[float, float] | None = None  # in inches; None = matplotlib default
+    png: Path
+
+
+def histogram(values, bins: int, **kwargs) -> Histogram:
+    counts, edges = np.histogram(values, bins=bins)
+    return Histogram(counts=counts.tolist(), edges=edges.tolist(), **kwargs)
+
+
+def _show_terminal(h: Histogram):
+    fig = tpl.figure()
+    fig.hist(h.counts, h.edges, orientation="horizontal", force_ascii=False)
+    fig.show()
+
+
+def _render_pngs(histograms: list[Histogram]):
+    # Runs in a separate process; matplotlib is only ever imported here, with a non-interactive backend
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    for h in histograms:
+        fig = plt.figure(figsize=h.fig_size)
+        plt.title(h.title)
+        plt.stairs(h.counts, h.edges, fill=True)
+        plt.xlabel(h.x_label)
+        plt.ylabel(h.y_label)
+        for x, colour in h.v_lines:
+            plt.axvline(x, color=colour)
+        fig.savefig(h.png, dpi=PLOT_DPI)
+        plt.close(fig)
+
+
+def render_plots(histograms: list[Histogram], mode: PlotMode):
+    """
+    Renders histograms according to the plot mode: terminal histograms are printed right away (they are cheap), while
+    PNGs are rendered in a background process so that callers can carry on without waiting for matplotlib.
+    """
+
+    if mode == "none":
+        return
+
+    for h in histograms:
+        _show_terminal(h)
+
+    if mode == "png":
+        # spawn rather than fork: the pipeline may have other threads running, which a forked child would not survive
+        p = multiprocessing.get_context("spawn").Process(target=_render_pngs, args=(histograms,))
+        p.start()
+        _plot_processes.append(p)
+
+
+def wait_for_plots():
+    """
+    Waits for any background PNG rendering to finish.
+    """
+    while _plot_processes:
+        p = _plot_processes.pop()
+        p.join()
+        if p.exitcode != 0:
+            logger.warning("Plot rendering process exited with code %s", p.exitcode)
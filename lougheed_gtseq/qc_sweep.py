@@ -0,0 +1,150 @@
+import contextlib
+import csv
+import itertools
+import numpy as np
+import sys
+
+from pathlib import Path
+
+from .genotype_matrix import GenotypeMatrix, load_genotype_matrix, qc_sample_mask
+from .logger import logger
+
+__all__ = [
+    "QC_SWEEP_COLUMNS",
+    "called_counts",
+    "sweep_qc",
+    "run_qc_sweep",
+]
+
+QC_SWEEP_COLUMNS = (
+    "min_dp",
+    "min_gq",
+    "min_called_prop",
+    "het_sigma",
+    "samples",
+    "failed_prop_called",
+    "failed_heterozygosity",
+    "passed",
+    "success_rate",
+    "mean_prop_called",
+    "het_mean",
+    "het_sd",
+    "het_lb",
+    "het_ub",
+)
+
+
+def called_counts(
+    gm: GenotypeMatrix, samples: np.ndarray, min_dps: np.ndarray, min_gqs: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Counts called and heterozygous genotypes per sample for every (min_dp, min_gq) threshold pair at once, from a 2D
+    histogram of each sample's genotypes by the number of DP and GQ thresholds they pass.
+    :param gm: genotype matrix.
+    :param samples: boolean mask of samples to count for.
+    :param min_dps: sorted minimum DP thresholds (a genotype passes if DP >= min_dp.)
+    :param min_gqs: sorted minimum GQ thresholds (a genotype passes if GQ > min_gq.)
+    :return: (# called, # heterozygous called), each of shape min_dps x min_gqs x samples.
+    """
+
+    gt, dp, gq = gm.gt[:, samples], gm.dp[:, samples], gm.gq[:, samples]
+    n_samples = gt.shape[1]
+
+    # Missing genotypes, DPs or GQs never pass, whatever the thresholds
+    base = (gt >= 0).all(axis=-1) & (dp > 0) & (gq > 0)
+    het = gt[..., 0] != gt[..., 1]
+
+    # A genotype passes the first dp_passes DP thresholds and the first gq_passes GQ thresholds
+    dp_passes = np.searchsorted(min_dps, dp, side="right")
+    gq_passes = np.searchsorted(min_gqs, gq, side="left")
+    sample_idx = np.broadcast_to(np.arange(n_samples), dp.shape)
+
+    counts = np.zeros((2, len(min_dps) + 1, len(min_gqs) + 1, n_samples), dtype=np.int64)
+    np.add.at(counts, (0, dp_passes[base], gq_passes[base], sample_idx[base]), 1)
+    np.add.at(counts, (1, dp_passes[base & het], gq_passes[base & het], sample_idx[base & het]), 1)
+
+    # Genotypes passing thresholds (i, j) are those passing at least i + 1 DP and j + 1 GQ thresholds
+    cumulative = counts[:, ::-1, ::-1].cumsum(axis=1).cumsum(axis=2)[:, ::-1, ::-1]
+    return cumulative[0, 1:, 1:], cumulative[1, 1:, 1:]
+
+
+def sweep_qc(
+    gm: GenotypeMatrix, min_dps: list[int], min_gqs: list[int], min_props: list[float], het_sigmas: list[float]
+) -> list[dict]:
+    """
+    Evaluates run_qc's whole-sample QC (proportion called, then heterozygosity within mean +/- sigma SDs of samples
+    passing the first step) over a grid of thresholds, without writing any VCFs.
+    :return: list of result rows (dictionaries with QC_SWEEP_COLUMNS keys), one per parameter set.
+    """
+
+    min_dps_arr, min_gqs_arr = np.array(sorted(set(min_dps))), np.array(sorted(set(min_gqs)))
+    props_arr, sigmas_arr = np.array(sorted(set(min_props))), np.array(sorted(set(het_sigmas)))
+
+    samples = qc_sample_mask(gm.samples)
+    n_samples = int(samples.sum())
+
+    n_called, n_het = called_counts(gm, samples, min_dps_arr, min_gqs_arr)  # dps x gqs x samples
+
+    props = n_called / max(gm.n_sites, 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        het_props = n_het / n_called
+
+    # Broadcast over min_props x dps x gqs x samples, then het_sigmas x min_props x dps x gqs x samples
+    prop_failed = ~(props[None] >= props_arr[:, None, None, None])
+    prop_ok = ~prop_failed
+    het_b = np.broadcast_to(het_props[None], prop_failed.shape)
+
+    # Mean/SD of heterozygosity over the samples passing the proportion-called step (NaN if there are none)
+    n_prop_ok = prop_ok.sum(axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        het_mean = np.where(prop_ok, het_b, 0).sum(axis=-1) / n_prop_ok
+        het_sd = np.sqrt(np.where(prop_ok, (het_b - het_mean[..., None]) ** 2, 0).sum(axis=-1) / n_prop_ok)
+
+    het_lb = het_mean[None] - sigmas_arr[:, None, None, None] * het_sd[None]
+    het_ub = het_mean[None] + sigmas_arr[:, None, None, None] * het_sd[None]
+    het_failed = prop_ok[None] & ~((het_lb[..., None] <= het_b[None]) & (het_b[None] <= het_ub[..., None]))
+
+    n_prop_failed = prop_failed.sum(axis=-1)
+    n_het_failed = het_failed.sum(axis=-1)
+
+    rows = []
+    for (si, sigma), (pi, min_prop), (di, min_dp), (gi, min_gq) in itertools.product(
+        enumerate(sigmas_arr), enumerate(props_arr), enumerate(min_dps_arr), enumerate(min_gqs_arr)
+    ):
+        passed = n_samples - int(n_prop_failed[pi, di, gi]) - int(n_het_failed[si, pi, di, gi])
+        rows.append(
+            {
+                "min_dp": int(min_dp),
+                "min_gq": int(min_gq),
+                "min_called_prop": float(min_prop),
+                "het_sigma": float(sigma),
+                "samples": n_samples,
+                "failed_prop_called": int(n_prop_failed[pi, di, gi]),
+                "failed_heterozygosity": int(n_het_failed[si, pi, di, gi]),
+                "passed": passed,
+                "success_rate": passed / n_samples if n_samples else 0.0,
+                "mean_prop_called": float(props[di, gi].mean()) if n_samples else 0.0,
+                "het_mean": float(het_mean[pi, di, gi]),
+                "het_sd": float(het_sd[pi, di, gi]),
+                "het_lb": float(het_lb[si, pi, di, gi]),
+                "het_ub": float(het_ub[si, pi, di, gi]),
+            }
+        )
+
+    rows.sort(key=lambda r: (r["min_dp"], r["min_gq"], r["min_called_prop"], r["het_sigma"]))
+    return rows
+
+
+def run_qc_sweep(
+    vcf: Path, min_dps: list[int], min_gqs: list[int], min_props: list[float], het_sigmas: list[float], out: Path | None
+):
+    gm = load_genotype_matrix(vcf)
+    logger.info(f"[QC sweep] {gm.n_sites} sites x {len(gm.samples)} samples")
+
+    rows = sweep_qc(gm, min_dps, min_gqs, min_props, het_sigmas)
+    logger.info(f"[QC sweep] evaluated {len(rows)} parameter sets")
+
+    with open(out, "w", newline="") if out else contextlib.nullcontext(sys.stdout) as fh:
+        writer = csv.DictWriter(fh, fieldnames=QC_SWEEP_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
@@ -0,0 +1,337 @@
+import contextlib
+import math
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from pydantic import BaseModel, ConfigDict
+from typing import Any, Callable, Iterator, Literal
+
+from .logger import logger
+from .metrics import measure_step
+from .step_cache import StepCache
+
+__all__ = [
+    "CpuBudget",
+    "plan_threads",
+    "Step",
+    "StepTiming",
+    "ScheduleReport",
+    "critical_path",
+    "run_steps",
+]
+
+
+class CpuBudget:
+    """
+    A shared pool of CPU threads which concurrent jobs reserve from, so that jobs running at the same time never use
+    more than a fixed total number of threads between them.
+    """
+
+    def __init__(self, total: int):
+        self.total = max(total, 1)
+        self._free = self.total
+        self._cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def reserve(self, n: int) -> Iterator[int]:
+        """
+        Waits until n threads (capped at the budget total) are free and holds them for the duration of the context.
+        :return: the number of threads actually reserved.
+        """
+
+        n = min(max(n, 1), self.total)
+        with self._cond:
+            self._cond.wait_for(lambda: self._free >= n)
+            self._free -= n
+        try:
+            yield n
+        finally:
+            self.release(n)
+
+    def try_reserve(self, n: int, minimum: int = 1, keep: int = 0) -> int:
+        """
+        Reserves up to n threads without waiting, taking fewer if fewer are free. Reserved threads must be given back
+        with release().
+        :param n: number of threads wanted.
+        :param minimum: fewest threads worth taking (capped at the budget total); if fewer are free, none are taken.
+        :param keep: number of free threads to leave for others (e.g., higher-priority jobs which have yet to start.)
+        :return: the number of threads reserved; 0 if fewer than minimum are free.
+        """
+        with self._cond:
+            n = min(max(n, 1), self._free - keep)
+            if n < min(max(minimum, 1), self.total):
+                return 0
+            self._free -= n
+            return n
+
+    def release(self, n: int):
+        with self._cond:
+            self._free += n
+            self._cond.notify_all()
+
+
+def plan_threads(job_sizes: dict[int, int], total_threads: int, size_per_thread: int) -> dict[int, int]:
+    """
+    Sizes per-job thread allocations by job size (e.g., # of reads): one thread per size_per_thread units of work,
+    with at least one thread and at most the whole budget per job.
+    """
+    return {k: min(max(math.ceil(size / size_per_thread), 1), total_threads) for k, size in job_sizes.items()}
+
+
+class Step(BaseModel):
+    """
+    A unit of pipeline work with explicit data dependencies, run by run_steps once everything it needs is available.
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    name: str
+    # Called with threads=<# threads reserved for the step>, plus each input as a keyword argument
+    call: Callable[..., Any]
+    inputs: tuple[str, ...] = ()  # values produced by other steps' outputs
+    outputs: tuple[str, ...] = ()  # names for the values call returns (as a tuple, if there is more than one)
+    after: tuple[
+        str, ...
+    ] = ()  # names of steps which must finish first, without passing any values (e.g., shared files)
+    threads: int = 1  # CPU threads wanted from the shared budget; 0 for steps which do not need any (e.g., I/O-bound)
+    # Fewest threads the step starts with (default: all it wants); it waits for them rather than start on leftovers.
+    # Until a step has started, lower-priority steps leave this many threads free for it.
+    min_threads: int | None = None
+    only_if: bool = True  # if False, the step is skipped and its outputs are None
+
+    # Step cache: whether to re-use the step's result from the step cache, when its key is unchanged. The key covers
+    # the step name, the code version, key_params, the step's input values (with any files in them fingerprinted)
+    # and key_files; output_files are files the step writes outside its result, which must be unchanged for it to be
+    # re-used. A step which changes earlier steps' output files in place lists them in modifies, so that their cache
+    # entries are updated to the files' new state.
+    cache: bool = False
+    key_params: dict[str, Any] = {}
+    key_files: tuple[Path, ...] = ()
+    output_files: tuple[Path, ...] = ()
+    modifies: tuple[Path, ...] = ()
+
+
+class StepTiming(BaseModel):
+    name: str
+    status: Literal["executed", "cached", "skipped"]
+    threads: int
+    ready: float  # seconds since the start of the schedule; when its dependencies were done
+    start: float
+    end: float
+    blocked_by: str | None = None  # if the step waited for CPU threads, the step whose threads it started with
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class ScheduleReport(BaseModel):
+    wall_time: float
+    step_time: float  # sum of all step durations, i.e., what running the steps one after another would take
+    steps: list[StepTiming]
+    critical_path: list[str]  # chain of dependent steps which determined the wall time, first to last
+
+
+def _dependencies(steps: list[Step]) -> dict[str, set[str]]:
+    names = [s.name for s in steps]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicate step names: {names}")
+
+    producers: dict[str, str] = {}
+    for s in steps:
+        for output in s.outputs:
+            if output in producers:
+                raise ValueError(f"Value {output} is produced by both {producers[output]} and {s.name}")
+            producers[output] = s.name
+
+    deps = {}
+    for s in steps:
+        if missing := [i for i in s.inputs if i not in producers] + [a for a in s.after if a not in names]:
+            raise ValueError(f"Step {s.name} depends on unknown values/steps: {missing}")
+        deps[s.name] = {producers[i] for i in s.inputs} | set(s.after)
+    return deps
+
+
+def critical_path(timings: list[StepTiming], deps: dict[str, set[str]]) -> list[str]:
+    """
+    Follows the chain of steps which held up each other, back from the last step to finish: a step was held up by the
+    step whose CPU threads it waited for, if any, and otherwise by the dependency which finished last.
+    """
+
+    by_name = {t.name: t for t in timings}
+    if not by_name:
+        return []
+
+    path = [max(timings, key=lambda t: t.end).name]
+    while True:
+        if (blocked_by := by_name[path[-1]].blocked_by) is not None:
+            path.append(blocked_by)
+        elif preceding := [by_name[d] for d in deps[path[-1]] if d in by_name]:
+            path.append(max(preceding, key=lambda t: t.end).name)
+        else:
+            return path[::-1]
+
+
+def _cache_key(cache: StepCache, step: Step, kwargs: dict[str, Any]) -> str:
+    return cache.key(step.name, step.key_params, kwargs, step.key_files)
+
+
+def _execute(
+    step: Step, kwargs: dict[str, Any], threads: int, cache: StepCache | None, key: str | None
+) -> tuple[Any, tuple[str, ...]]:
+    with measure_step(step.name):
+        res = step.call(threads=threads, **kwargs)
+    if cache is None or key is None:
+        return res, ()
+    # Also store the result under the key for the input files' state after the step ran, so that steps which modify
+    # their input files in place (e.g., re-headering a VCF) are still found in the cache afterwards.
+    keys = (key, _cache_key(cache, step, kwargs))
+    cache.put(list(keys), res, step.output_files)
+    return res, keys
+
+
+def run_steps(
+    steps: list[Step], budget: CpuBudget, cache: StepCache | None = None
+) -> tuple[dict[str, Any], ScheduleReport]:
+    """
+    Runs steps as soon as their inputs are available, concurrently, with each step holding threads from a shared CPU
+    budget while it runs. A step starts with as many of the threads it wants as are free, but no fewer than its
+    min_threads; otherwise it waits for threads to be released. Earlier steps have priority: steps which are ready (or
+    about to be, with all their dependencies finished or running) hold back their min_threads from later steps, so a
+    low-priority step which happens to become ready first cannot starve them.
+    If a step fails, no further steps are started; running steps are waited on, then the error is raised.
+    :param steps: steps to run; list order is their priority.
+    :param budget: CPU thread budget shared by all steps.
+    :param cache: step cache for steps with cache=True; None to always run every step.
+    :return: (all step output values by name, schedule report.)
+    """
+
+    deps = _dependencies(steps)
+
+    values: dict[str, Any] = {}
+    timings: list[StepTiming] = []
+    finished: set[str] = set()
+    pending = list(steps)
+    running: dict[Future, tuple[Step, int, float, str | None]] = {}
+    ready: dict[str, float] = {}  # when each step's dependencies were done
+    lookups: dict[str, tuple[str | None, bool, Any]] = {}  # cache (key, hit, cached result) for each ready step
+    last_finished: str | None = None
+    output_keys: dict[Path, list[str]] = {}  # cache keys of the steps which wrote each output file
+    error: BaseException | None = None
+
+    t0 = time.perf_counter()
+
+    def _min_threads(step: Step) -> int:
+        if not step.only_if or not step.threads:
+            return 0
+        return min(step.threads if step.min_threads is None else step.min_threads, budget.total)
+
+    def _imminent(step: Step) -> bool:
+        running_names = {s.name for s, *_ in running.values()}
+        return deps[step.name] <= finished | running_names
+
+    def _finish(
+        step: Step,
+        res: Any,
+        status: str,
+        threads: int,
+        start: float,
+        blocked_by: str | None = None,
+        keys: tuple[str, ...] = (),
+    ):
+        nonlocal last_finished
+        if cache is not None:
+            for path in step.modifies:
+                cache.refresh_output(output_keys.get(path, []), path)
+        for path in step.output_files:
+            output_keys.setdefault(path, []).extend(keys)
+        if len(step.outputs) == 1:
+            values[step.outputs[0]] = res
+        elif step.outputs:
+            values.update(zip(step.outputs, res if res is not None else [None] * len(step.outputs)))
+        finished.add(step.name)
+        last_finished = step.name
+        timings.append(
+            StepTiming(
+                name=step.name,
+                status=status,
+                threads=threads,
+                ready=ready[step.name],
+                start=start,
+                end=time.perf_counter() - t0,
+                blocked_by=blocked_by,
+            )
+        )
+
+    with ThreadPoolExecutor(max_workers=max(len(steps), 1), thread_name_prefix="step") as executor:
+        while pending or running:
+            # Start (or skip, or restore) every step whose dependencies are done, in priority order, until none are left
+            started = True
+            while started and error is None:
+                started = False
+                keep = 0  # threads held back for higher-priority steps which have yet to start
+                for step in pending:
+                    if not deps[step.name] <= finished:
+                        if _imminent(step):
+                            keep += _min_threads(step)
+                        continue
+
+                    now = time.perf_counter() - t0
+                    kwargs = {i: values[i] for i in step.inputs}
+                    if step.name not in ready:
+                        # Look the step up in the cache once, when it becomes ready, rather than on every pass while it
+                        # waits for threads: keys may hash large input files.
+                        ready[step.name] = now
+                        key = _cache_key(cache, step, kwargs) if step.only_if and step.cache and cache else None
+                        lookups[step.name] = (key, *(cache.get(key) if key is not None else (False, None)))
+                    key, hit, cached = lookups[step.name]
+
+                    if not step.only_if:
+                        logger.info("step %s: not needed", step.name)
+                        _finish(step, None, "skipped", 0, now)
+                    elif hit:
+                        logger.info("step %s: re-using cached result %s", step.name, key[:12])
+                        _finish(step, cached, "cached", 0, now, keys=(key,))
+                    else:
+                        threads = budget.try_reserve(step.threads, _min_threads(step), keep) if step.threads else 0
+                        if step.threads and not threads:
+                            keep += _min_threads(step)
+                            continue  # wait for threads to be released
+                        logger.info("step %s: executing with %d thread(s)", step.name, threads)
+                        # A step which was ready before now waited for threads, which the last step to finish released
+                        blocked_by = last_finished if now > ready[step.name] else None
+                        future = executor.submit(_execute, step, kwargs, threads, cache, key)
+                        running[future] = (step, threads, now, blocked_by)
+
+                    pending.remove(step)
+                    started = True
+                    break
+
+            if not running:
+                if pending and error is None:
+                    raise ValueError(f"Steps can never run (dependency cycle?): {[s.name for s in pending]}")
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step, threads, start, blocked_by = running.pop(future)
+                if threads:
+                    budget.release(threads)
+                if (exc := future.exception()) is not None:
+                    logger.error("step %s: failed: %s", step.name, exc)
+                    error = error or exc
+                    continue
+                res, keys = future.result()
+                _finish(step, res, "executed", threads, start, blocked_by, keys)
+
+    if error is not None:
+        raise error
+
+    report = ScheduleReport(
+        wall_time=time.perf_counter() - t0,
+        step_time=sum(t.duration for t in timings),
+        steps=timings,
+        critical_path=critical_path(timings, deps),
+    )
+    return values, report
@@ -0,0 +1,281 @@
+import csv
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from pydantic import BaseModel
+
+from .fastq import FastqBlockReader, open_fastq
+
+__all__ = [
+    "SEX_GENOTYPER_PRIMER_LENGTH",
+    "SEX_GENOTYPER_MIN_READS",
+    "SexMarker",
+    "SexMarkerCounts",
+    "load_sex_markers",
+    "reverse_complement",
+    "SexMarkerMatcher",
+    "count_sex_marker_reads",
+    "format_genos",
+    "compile_genos",
+    "genotype_sample_sex_markers",
+    "sex_marker_executor",
+]
+
+# As in GTseq_Genotyper_v3.pl: reads are assigned to a marker by the first 14 bases of its forward primer, which
+# on-target R1 reads start with; at least 10 allele-matching reads are needed for a genotype call.
+SEX_GENOTYPER_PRIMER_LENGTH = 14
+SEX_GENOTYPER_MIN_READS = 10
+
+FASTQ_BLOCK_SIZE = 4 * 1024 * 1024
+
+_COMPLEMENT = str.maketrans("ACGTRYKMSWBDHVNacgtrykmswbdhvn[]", "TGCAYRMKSWVHDBNtgcayrmkswvhdbn][")
+_IUPAC_CLASSES = {
+    "R": "[AG]",
+    "Y": "[CT]",
+    "K": "[GT]",
+    "M": "[AC]",
+    "S": "[CG]",
+    "W": "[AT]",
+    "B": "[CGT]",
+    "D": "[AGT]",
+    "H": "[ACT]",
+    "V": "[ACG]",
+    "N": "[ACGT]",
+}
+
+
+class SexMarker(BaseModel):
+    # One row of a Campbell-format marker file (alleles/<species>.sl.csv)
+    name: str
+    allele1: str
+    allele2: str
+    probe1: str
+    probe2: str
+    fwd_primer: str
+    a1_corr: float
+    a2_corr: float
+    a1_corr_str: str  # correction factors as written in the marker file, which .genos files echo back
+    a2_corr_str: str
+
+
+class SexMarkerCounts(BaseModel):
+    raw_reads: int = 0
+    primer_reads: dict[str, int] = {}  # reads starting with each marker's forward primer
+    a1_reads: dict[str, int] = {}
+    a2_reads: dict[str, int] = {}
+
+
+def load_sex_markers(marker_file: Path) -> list[SexMarker]:
+    markers = []
+    with open(marker_file, "r", newline="") as fh:
+        for row in csv.reader(fh):
+            if not row:
+                continue
+            name, a1, a2, probe1, probe2, fwd, a1_corr, a2_corr = row[:8]
+            markers.append(
+                SexMarker(
+                    name=name,
+                    allele1=a1,
+                    allele2=a2,
+                    probe1=probe1,
+                    probe2=probe2,
+                    fwd_primer=fwd,
+                    a1_corr=float(a1_corr),
+                    a2_corr=float(a2_corr),
+                    a1_corr_str=a1_corr,
+                    a2_corr_str=a2_corr,
+                )
+            )
+    return markers
+
+
+def reverse_complement(seq: str) -> str:
+    """
+    Reverse complement of a probe sequence, which may hold IUPAC codes and [...] character classes.
+    """
+    return seq.translate(_COMPLEMENT)[::-1]
+
+
+def _probe_pattern(probe: str) -> str:
+    return "".join(_IUPAC_CLASSES.get(c, c) for c in probe.upper())
+
+
+class SexMarkerMatcher:
+    """
+    All markers' primers and probes, compiled once: a dictionary from forward primer prefix to markers, so each read
+    costs a single lookup, and for each marker one regular expression per allele matching its probe in either
+    orientation.
+    """
+
+    def __init__(self, markers: list[SexMarker]):
+        self.markers = markers
+        self.by_primer: dict[bytes, list[tuple[str, re.Pattern, re.Pattern]]] = {}
+        for m in markers:
+            self.by_primer.setdefault(m.fwd_primer[:SEX_GENOTYPER_PRIMER_LENGTH].upper().encode(), []).append(
+                (
+                    m.name,
+                    re.compile(f"{_probe_pattern(m.probe1)}|{_probe_pattern(reverse_complement(m.probe1))}".encode()),
+                    re.compile(f"{_probe_pattern(m.probe2)}|{_probe_pattern(reverse_complement(m.probe2))}".encode()),
+                )
+            )
+        self.primer_lengths = sorted({len(p) for p in self.by_primer})
+
+    def count(self, sequences: list[bytes], counts: SexMarkerCounts):
+        by_primer, primer_lengths = self.by_primer, self.primer_lengths
+        primer_reads, a1_reads, a2_reads = counts.primer_reads, counts.a1_reads, counts.a2_reads
+
+        counts.raw_reads += len(sequences)
+        for seq in sequences:
+            for k in primer_lengths:
+                if (hits := by_primer.get(seq[:k])) is None:
+                    continue
+                for name, a1, a2 in hits:
+                    primer_reads[name] += 1
+                    if a1.search(seq):
+                        a1_reads[name] += 1
+                    elif a2.search(seq):
+                        a2_reads[name] += 1
+
+
+def count_sex_marker_reads(fastq: Path, matcher: SexMarkerMatcher) -> SexMarkerCounts:
+    """
+    Counts primer and allele probe matches for every marker over all reads of a (plain or gzipped) FASTQ file, which
+    is read in large blocks of records.
+    """
+
+    names = [m.name for m in matcher.markers]
+    counts = SexMarkerCounts(
+        primer_reads=dict.fromkeys(names, 0), a1_reads=dict.fromkeys(names, 0), a2_reads=dict.fromkeys(names, 0)
+    )
+
+    with open_fastq(fastq) as fh:
+        reader = FastqBlockReader(fh, FASTQ_BLOCK_SIZE)
+        while block := reader.read_block():
+            matcher.count([s.rstrip(b"\r").upper() for s in block.split(b"\n")[1::4]], counts)
+
+    return counts
+
+
+def _call(marker: SexMarker, a1: float, a2: float) -> tuple[float, str, str]:
+    # Allele ratio thresholds of GTseq_Genotyper_v3.pl: >= 10 is A1 homozygous, <= 0.1 A2 homozygous, 0.2 - 5 is
+    # heterozygous; ratios in between are left uncalled, as are markers with too few reads.
+    ratio = a1 if a2 == 0 else a1 / a2
+    if a1 + a2 < SEX_GENOTYPER_MIN_READS:
+        return ratio, "00", "NA"
+    if ratio >= 10:
+        return ratio, marker.allele1 * 2, "A1HOM"
+    if ratio <= 0.1:
+        return ratio, marker.allele2 * 2, "A2HOM"
+    if 0.2 <= ratio <= 5:
+        return ratio, marker.allele1 + marker.allele2, "HET"
+    return ratio, "00", "NA"
+
+
+def format_genos(sample: str, markers: list[SexMarker], counts: SexMarkerCounts) -> str:
+    """
+    Formats marker counts and genotype calls as a .genos file, laid out like GTseq_Genotyper_v3.pl's output: a
+    summary line, then one line per marker.
+    """
+
+    lines = []
+    on_target = 0
+    background = 0.0
+    hom_reads = 0.0
+
+    for m in markers:
+        a1, a2 = counts.a1_reads[m.name], counts.a2_reads[m.name]
+        on_target += a1 + a2
+
+        # Correction factors remove the share of each probe's hits which are due to the other allele
+        a1_fix = max(a1 - m.a1_corr * a2, 0.0)
+        a2_fix = max(a2 - m.a2_corr * a1, 0.0)
+        ratio, genotype, genotype_class = _call(m, a1_fix, a2_fix)
+
+        # IFI (individual fuzziness index): other-allele background reads at homozygous markers
+        if genotype_class == "A1HOM":
+            background += a2_fix
+            hom_reads += a1_fix + a2_fix
+        elif genotype_class == "A2HOM":
+            background += a1_fix
+            hom_reads += a1_fix + a2_fix
+
+        primer_reads = counts.primer_reads[m.name]
+        lines.append(
+            f"{m.name},{m.allele1}={a1_fix:.15g},{m.allele2}={a2_fix:.15g},{ratio:.3f},{genotype},{genotype_class},"
+            f"{m.a1_corr_str},{m.a2_corr_str},{primer_reads},"
+            f"{primer_reads / counts.raw_reads * 100 if counts.raw_reads else 0:.3f},"
+            f"{(a1 + a2) / primer_reads * 100 if primer_reads else 0:.1f}"
+        )
+
+    on_target_pct = on_target / counts.raw_reads * 100 if counts.raw_reads else 0
+    ifi = background / hom_reads * 100 if hom_reads else 0
+    header = (
+        f"{sample},Raw-Reads:{counts.raw_reads},On-Target reads:{on_target},%On-Target:{on_target_pct:.1f},"
+        f"IFI_score:{ifi:.2f}"
+    )
+    return "\n".join([header, *lines]) + "\n"
+
+
+def compile_genos(genos_files: list[Path], out: Path):
+    """
+    Compiles .genos files into a single CSV of sample summaries and genotypes, laid out like the output of
+    GTseq_GenoCompile_v3.pl S 0 (genotypes, no genotyping-rate filter.) Sample names are the .genos file names.
+    """
+
+    rows = []
+    loci: list[str] = []
+    for genos in sorted(genos_files, key=lambda p: p.name):
+        with open(genos, "r") as fh:
+            summary = dict(f.split(":", 1) for f in fh.readline().rstrip("\n").split(",")[1:])
+            genotypes = [line.rstrip("\n").split(",") for line in fh if line.strip()]
+        loci = loci or [g[0] for g in genotypes]
+        n_called = sum(g[4] != "00" for g in genotypes)
+        rows.append(
+            [
+                genos.name.removesuffix(".genos"),
+                summary["Raw-Reads"],
+                summary["On-Target reads"],
+                summary["%On-Target"],
+                f"{n_called / len(genotypes) * 100 if genotypes else 0:.2f}",
+                summary["IFI_score"],
+                *(g[4] for g in genotypes),
+            ]
+        )
+
+    with open(out, "w", newline="") as fh:
+        writer = csv.writer(fh, lineterminator="\n")
+        writer.writerow(["Sample", "Raw Reads", "On-Target Reads", "%On-Target", "%GT", "IFI", *loci])
+        writer.writerows(rows)
+
+
+# Per-process compiled markers for genotyping workers; set once by _init_sex_marker_worker
+_worker_matcher: SexMarkerMatcher | None = None
+
+
+def _init_sex_marker_worker(markers: list[SexMarker]):
+    global _worker_matcher
+    _worker_matcher = SexMarkerMatcher(markers)
+
+
+def genotype_sample_sex_markers(fastq: Path, genos_file: Path, scratch_dir: Path):
+    """
+    Genotypes one sample's sex-linked markers, writing its .genos file. Runs in a worker of sex_marker_executor.
+    :param fastq: sample FASTQ (plain or gzipped.)
+    :param genos_file: .genos file to write.
+    :param scratch_dir: directory for temporary files, on the same file system as the .genos file.
+    """
+    counts = count_sex_marker_reads(fastq, _worker_matcher)
+    # Write to the scratch directory first, then move into place, so .genos files only ever exist once complete
+    genos_tmp = scratch_dir / f"{genos_file.name}.tmp"
+    genos_tmp.write_text(format_genos(str(fastq), _worker_matcher.markers, counts))
+    os.replace(genos_tmp, genos_file)
+
+
+def sex_marker_executor(marker_file: Path, processes: int) -> ProcessPoolExecutor:
+    """
+    Process pool for genotype_sample_sex_markers calls; the marker file is loaded once, and compiled once per worker.
+    """
+    markers = load_sex_markers(marker_file)
+    return ProcessPoolExecutor(max(processes, 1), initializer=_init_sex_marker_worker, initargs=(markers,))
@@ -1,36 +1,164 @@
-import matplotlib.pyplot as plt
+import contextlib
+import csv
+import multiprocessing
 import numpy as np
 import pysam
-import termplotlib as tpl
+import sys
+
 from pathlib import Path
+from typing import Iterator
+
+from .genotype_matrix import parse_record_genotypes, stack_genotypes
+from .logger import logger
+from .models import PlotMode
+from .plots import histogram, render_plots
+
+__all__ = [
+    "SNP_SUCCESS_COLUMNS",
+    "SNP_SUCCESS_CHUNK_SIZE",
+    "locus_stats",
+    "snp_success_tasks",
+    "run_snp_success",
+]
+
+SNP_SUCCESS_COLUMNS = (
+    "vcf",
+    "contig",
+    "pos",
+    "id",
+    "ref",
+    "alt",
+    "samples",
+    "called",
+    "call_rate",
+    "mean_dp",
+    "mean_gq",
+    "alt_af",
+    "het_rate",
+)
+
+# Number of records whose genotypes are held in memory at once (per worker) before being reduced to locus statistics
+SNP_SUCCESS_CHUNK_SIZE = 2048
+
+
+def locus_stats(gt: np.ndarray, dp: np.ndarray, gq: np.ndarray) -> dict[str, np.ndarray]:
+    """
+    Computes per-locus statistics from sites x samples genotype matrices (as returned by stack_genotypes.)
+    Mean DP is taken over all samples (missing = 0), so it reflects the depth the panel gets per sample; mean GQ, ALT
+    allele frequency (any non-reference allele) and heterozygosity are taken over called genotypes only.
+    """
+
+    n_samples = gt.shape[1]
+    called = (gt >= 0).all(axis=-1)
+    n_called = called.sum(axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return {
+            "samples": np.full(gt.shape[0], n_samples),
+            "called": n_called,
+            "call_rate": n_called / n_samples if n_samples else np.zeros(gt.shape[0]),
+            "mean_dp": dp.mean(axis=1) if n_samples else np.zeros(gt.shape[0]),
+            "mean_gq": np.where(called, gq, 0).sum(axis=1) / n_called,
+            "alt_af": ((gt > 0) & called[..., None]).sum(axis=(1, 2)) / (2 * n_called),
+            "het_rate": ((gt[..., 0] != gt[..., 1]) & called).sum(axis=1) / n_called,
+        }
+
+
+def snp_success_tasks(vcfs: list[Path], processes: int) -> list[tuple[Path, list[str] | None]]:
+    """
+    Splits VCF/BCF files into (file, contigs) work units. Indexed files are split into up to `processes` groups of
+    consecutive contigs with records; files without an index are read whole (contigs = None.)
+    """
+
+    tasks: list[tuple[Path, list[str] | None]] = []
+    for vcf in vcfs:
+        with pysam.VariantFile(str(vcf)) as vf:
+            contigs = list(vf.index.keys()) if vf.index is not None else None
+        if not contigs:
+            tasks.append((vcf, None))
+            continue
+        n_groups = min(processes, len(contigs))
+        tasks.extend((vcf, group.tolist()) for group in np.array_split(np.array(contigs, dtype=object), n_groups))
+    return tasks
+
+
+def _records(vf: pysam.VariantFile, contigs: list[str] | None) -> Iterator[pysam.VariantRecord]:
+    if contigs is None:
+        yield from vf
+        return
+    for contig in contigs:
+        yield from vf.fetch(contig)
+
 
-__all__ = ["run_snp_success"]
+def _snp_success_task(task: tuple[Path, list[str] | None]) -> list[tuple]:
+    vcf, contigs = task
 
+    rows: list[tuple] = []
 
-def run_snp_success(vcf: Path):
-    n_samples = 0
     with pysam.VariantFile(str(vcf)) as vf:
-        sps = []
-        for variant in vf.fetch():
-            n_samples = max(n_samples, len(variant.samples))
-            success_num = sum(1 for samp in variant.samples.values() if samp["GT"][0] is not None)
-            success_denom = len(variant.samples)
-            success_percent = success_num / success_denom * 100
-            print(
-                f"{variant.contig.rjust(14)} {str(variant.pos).ljust(9)} {success_percent:.1f}% "
-                f"({success_num} / {success_denom})"
-            )
-            sps.append(success_percent)
-
-    sps_counts, sps_edges = np.histogram(sps, bins=20)
-
-    prop_fig = tpl.figure()
-    prop_fig.hist(sps_counts, sps_edges, orientation="horizontal", force_ascii=False)
-    prop_fig.show()
-
-    plt.title(f"SNP call rate across {len(sps)} SNPs and {n_samples} samples")
-
-    plt.stairs(sps_counts, sps_edges, fill=True)
-    plt.xlabel("SNP call success %")
-    plt.ylabel("# SNPs")
-    plt.show()
+        n_samples = len(vf.header.samples)
+
+        def _flush(loci: list[tuple], genotypes: list):
+            stats = locus_stats(*stack_genotypes(genotypes, n_samples))
+            columns = [stats[c].tolist() for c in SNP_SUCCESS_COLUMNS[6:]]
+            rows.extend((str(vcf), *locus, *values) for locus, *values in zip(loci, *columns))
+
+        loci: list[tuple] = []
+        genotypes: list = []
+        for record in _records(vf, contigs):
+            loci.append((record.contig, record.pos, record.id or ".", record.ref, ",".join(record.alts or (".",))))
+            # Formatting the record back to VCF text is done by htslib, and works the same for VCF and BCF inputs
+            genotypes.append(parse_record_genotypes(str(record), n_samples))
+            if len(loci) == SNP_SUCCESS_CHUNK_SIZE:
+                _flush(loci, genotypes)
+                loci, genotypes = [], []
+
+        if loci:
+            _flush(loci, genotypes)
+
+    return rows
+
+
+def _format_value(v) -> str:
+    return f"{v:.4f}" if isinstance(v, float) else str(v)
+
+
+def run_snp_success(vcfs: list[Path], out: Path | None = None, processes: int = 1, plots: PlotMode = "png"):
+    """
+    Writes per-locus call rate, mean DP/GQ, ALT allele frequency and heterozygosity for every record of one or more
+    VCF/BCF files as a TSV (one row per file and locus, so batches can be concatenated and tracked over time.) Files
+    are processed in parallel, per group of contigs for indexed files, and rows are streamed out in input order.
+    """
+
+    tasks = snp_success_tasks(vcfs, processes)
+    logger.info(f"[SNP success] {len(vcfs)} file(s) split into {len(tasks)} task(s)")
+
+    call_rates: list[float] = []
+
+    with open(out, "w", newline="") if out else contextlib.nullcontext(sys.stdout) as fh:
+        writer = csv.writer(fh, delimiter="\t", lineterminator="\n")
+        writer.writerow(SNP_SUCCESS_COLUMNS)
+
+        # spawn rather than fork, as for the pipeline's other process pools
+        with multiprocessing.get_context("spawn").Pool(processes) as pool:
+            for rows in pool.imap(_snp_success_task, tasks):
+                writer.writerows(tuple(map(_format_value, row)) for row in rows)
+                call_rates.extend(row[SNP_SUCCESS_COLUMNS.index("call_rate")] for row in rows)
+
+    logger.info(f"[SNP success] wrote statistics for {len(call_rates)} loci")
+
+    # When the TSV goes to stdout, keep terminal histograms out of it
+    with contextlib.redirect_stdout(sys.stderr) if out is None else contextlib.nullcontext():
+        render_plots(
+            [
+                histogram(
+                    np.array(call_rates) * 100,
+                    20,
+                    title=f"SNP call rate across {len(call_rates)} loci in {len(vcfs)} file(s)",
+                    x_label="SNP call success %",
+                    y_label="# SNPs",
+                    png=Path(f"{out or vcfs[0]}.snp_success.png"),
+                )
+            ],
+            plots,
+        )
@@ -0,0 +1,191 @@
+import functools
+import hashlib
+import json
+import os
+import pickle
+from pathlib import Path
+from pydantic import BaseModel
+from typing import Any
+
+from .logger import logger
+
+__all__ = [
+    "STEP_CACHE_VERSION",
+    "code_version",
+    "file_fingerprint",
+    "value_fingerprint",
+    "StepCache",
+]
+
+# Bump when the cache entry format changes, so old entries are never read
+STEP_CACHE_VERSION = 2
+
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+@functools.cache
+def code_version() -> str:
+    """
+    Hash of this package's source code (Python modules and bundled data files such as panels), so that cached step
+    results are not re-used by a different version of the pipeline.
+    """
+    h = hashlib.sha256()
+    package_dir = Path(__file__).parent
+    for path in sorted(package_dir.rglob("*")):
+        if path.is_file() and path.suffix != ".pyc":
+            h.update(str(path.relative_to(package_dir)).encode())
+            h.update(path.read_bytes())
+    return h.hexdigest()
+
+
+def _sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        while chunk := fh.read(HASH_CHUNK_SIZE):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_fingerprint(path: Path, content_hash: bool = False) -> list:
+    """
+    Fingerprint of a file's state: its path, size and modification time, or - with content_hash - its size and the
+    SHA-256 of its contents, which survives copies and touches. Directories are fingerprinted by the (always
+    stat-based) fingerprints of every file under them; missing paths by their name only.
+    """
+    if path.is_dir():
+        files = sorted(p for p in path.rglob("*") if p.is_file())
+        return [str(path), [[str(p.relative_to(path)), *file_fingerprint(p)[1:]] for p in files]]
+    if not path.exists():
+        return [str(path), None]
+    st = path.stat()
+    if content_hash:
+        return [st.st_size, _sha256(path)]
+    return [str(path.absolute()), st.st_size, st.st_mtime_ns]
+
+
+def value_fingerprint(value: Any, content_hash: bool = False) -> Any:
+    """
+    JSON-able fingerprint of a step input value: files and directories it holds are replaced by their fingerprints,
+    models by their fields, and containers are fingerprinted recursively.
+    """
+    if isinstance(value, Path):
+        return file_fingerprint(value, content_hash) if value.exists() else str(value)
+    if isinstance(value, BaseModel):
+        return value_fingerprint(value.model_dump(), content_hash)
+    if isinstance(value, dict):
+        return [[str(k), value_fingerprint(v, content_hash)] for k, v in value.items()]
+    if isinstance(value, (list, tuple, set, frozenset)):
+        values = sorted(value, key=str) if isinstance(value, (set, frozenset)) else value
+        return [value_fingerprint(v, content_hash) for v in values]
+    return value
+
+
+def _result_files(value: Any) -> list[Path]:
+    # Every file path held by a step result, which must still be there (unchanged) for the result to be re-used
+    if isinstance(value, Path):
+        return [value]
+    if isinstance(value, BaseModel):
+        return _result_files(list(value.__dict__.values()))
+    if isinstance(value, dict):
+        return _result_files(list(value.values()))
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [p for v in value for p in _result_files(v)]
+    return []
+
+
+class StepCache:
+    """
+    Content-addressed store of step results, shared by every run in a work directory. Results are keyed by a hash of
+    the step name, its parameters, fingerprints of its input values and files, and the pipeline's code version, so a
+    result is only re-used if none of them changed - whichever run directory it was produced in.
+    """
+
+    def __init__(self, directory: Path, content_hash: bool = False):
+        self.directory = directory
+        self.content_hash = content_hash
+
+    def key(self, name: str, params: dict[str, Any], inputs: dict[str, Any], files: tuple[Path, ...]) -> str:
+        """
+        :param name: step name.
+        :param params: parameters the step's work depends on; paths here are taken as names, not fingerprinted.
+        :param inputs: input values from other steps.
+        :param files: input files (or directories) whose current state the step's work depends on.
+        """
+        payload = {
+            "cache_version": STEP_CACHE_VERSION,
+            "code_version": code_version(),
+            "name": name,
+            "params": [[k, str(v) if isinstance(v, Path) else v] for k, v in sorted(params.items())],
+            "inputs": [[k, value_fingerprint(v, self.content_hash)] for k, v in sorted(inputs.items())],
+            "files": [file_fingerprint(f, self.content_hash) for f in files],
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _entry_path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.pkl"
+
+    def get(self, key: str) -> tuple[bool, Any]:
+        """
+        Looks up a cached result. Entries whose result files or output files have since been changed or removed (by
+        anything other than a step declaring that it modifies them) are treated as missing.
+        :return: (whether a valid entry was found, cached result.)
+        """
+
+        entry_path = self._entry_path(key)
+        if not entry_path.exists():
+            return False, None
+
+        with open(entry_path, "rb") as fh:
+            entry = pickle.load(fh)
+
+        for path, fingerprint in [*entry["result_files"], *entry["output_files"]]:
+            if file_fingerprint(path) != fingerprint:
+                logger.info("Cached step result %s is stale (%s changed or was removed)", key[:12], path)
+                return False, None
+        if missing := [p for p in entry["output_dirs"] if not p.exists()]:
+            logger.info("Cached step result %s is stale (%s removed)", key[:12], missing[0])
+            return False, None
+
+        return True, entry["value"]
+
+    def put(self, keys: list[str], value: Any, output_files: tuple[Path, ...] = ()):
+        """
+        Stores a step result under one or more keys (e.g., keyed on both the input file state before and after a
+        step which modifies its input in place.)
+        :param keys: keys to store the result under.
+        :param value: the step's result.
+        :param output_files: files the step writes besides those in its result, which must be unchanged for it to be
+                             re-used.
+        """
+
+        result_paths = _result_files(value)
+        entry = {
+            "value": value,
+            "result_files": [(p, file_fingerprint(p)) for p in result_paths if p.is_file()],
+            "output_files": [(p, file_fingerprint(p)) for p in output_files if not p.is_dir()],
+            # Directories are only checked for existence: later steps may add files to them (e.g., FASTQ directories)
+            "output_dirs": [*(p for p in output_files if p.is_dir()), *(p for p in result_paths if p.is_dir())],
+        }
+        for key in dict.fromkeys(keys):
+            self._write_entry(key, entry)
+
+    def refresh_output(self, keys: list[str], path: Path):
+        """
+        Updates the fingerprint of an output file in existing entries, after a later step changed it in place (e.g.,
+        re-headering a VCF), so the entries stay valid for the file's new state.
+        """
+        for key in dict.fromkeys(keys):
+            if not (entry_path := self._entry_path(key)).exists():
+                continue
+            with open(entry_path, "rb") as fh:
+                entry = pickle.load(fh)
+            entry["output_files"] = [(p, file_fingerprint(p) if p == path else fp) for p, fp in entry["output_files"]]
+            self._write_entry(key, entry)
+
+    def _write_entry(self, key: str, entry: dict):
+        entry_path = self._entry_path(key)
+        entry_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = entry_path.with_name(f"{entry_path.name}.{os.getpid()}.tmp")  # other runs may share the cache
+        with open(tmp, "wb") as fh:
+            pickle.dump(entry, fh)
+        os.replace(tmp, entry_path)
@@ -0,0 +1,63 @@
+import hashlib
+import os
+from pathlib import Path
+
+import pysam
+
+from ..genome_cache import BWA_INDEX_EXTENSIONS, bwa_index_atomic, cache_lock, check_cached_files, write_manifest
+from ..logger import logger
+from ..panel import PanelIntervals, amplicon_contig_name, panel_allele_file
+
+__all__ = ["AMPLICON_REFERENCE_WINDOW", "amplicon_reference_file_for", "build_amplicon_reference_if_needed"]
+
+# Half-width (in bases) of the genome window extracted around each panel site for the amplicon mini-reference. Reads
+# are at most 150 bp, so this leaves plenty of flanking sequence for alignment and for mpileup's BAQ computation.
+AMPLICON_REFERENCE_WINDOW = 500
+
+FASTA_LINE_WIDTH = 80
+
+
+def amplicon_reference_file_for(species: str, genome_file: Path) -> Path:
+    """
+    Path of the cached amplicon mini-reference for a species panel, keyed on the panel contents and window size.
+    """
+
+    with open(panel_allele_file(species), "rb") as fh:
+        panel_hash = hashlib.sha256(fh.read() + str(AMPLICON_REFERENCE_WINDOW).encode()).hexdigest()[:12]
+
+    genome_stem = genome_file.name.split(".fna")[0]
+    return genome_file.parent / f"{genome_stem}.amplicons_{species}_{panel_hash}.fa"
+
+
+def build_amplicon_reference_if_needed(species: str, genome_file: Path, full_check: bool = False) -> Path:
+    """
+    Builds (once, then re-uses) a small bwa-indexed reference holding only the windows around the species panel's
+    sites, extracted from the full genome. Contigs are named with amplicon_contig_name, so alignments to them can be
+    lifted back to genome coordinates with SamLiftover. The reference is kept in the genome cache folder.
+    """
+
+    mini_ref = amplicon_reference_file_for(species, genome_file)
+
+    with cache_lock(mini_ref.parent, mini_ref.name):
+        if not check_cached_files(mini_ref, BWA_INDEX_EXTENSIONS, full_check):
+            logger.info("Already have amplicon reference: %s", mini_ref)
+            return mini_ref
+
+        panel = PanelIntervals.from_allele_file(panel_allele_file(species), AMPLICON_REFERENCE_WINDOW)
+        logger.info("Building amplicon reference from %d windows around %s panel sites", len(panel), species)
+
+        mini_ref_tmp = mini_ref.with_name(mini_ref.name + ".tmp")
+        with pysam.FastaFile(str(genome_file)) as genome, open(mini_ref_tmp, "w") as fh:
+            for contig, start, end in panel:
+                end = min(end, genome.get_reference_length(contig))
+                seq = genome.fetch(contig, start - 1, end)
+                fh.write(f">{amplicon_contig_name(contig, start, end)}\n")
+                fh.writelines(f"{seq[i : i + FASTA_LINE_WIDTH]}\n" for i in range(0, len(seq), FASTA_LINE_WIDTH))
+        os.replace(mini_ref_tmp, mini_ref)
+
+        logger.info("Indexing amplicon reference: %s", mini_ref)
+        bwa_index_atomic(mini_ref)
+
+        write_manifest(mini_ref, BWA_INDEX_EXTENSIONS)
+
+    return mini_ref
@@ -1,19 +1,215 @@
+import hashlib
+import os
 import shutil
 import subprocess
 from pathlib import Path
 
+import pysam
+
+from ..genotyper import genotype_panel
+from ..logger import logger
+from ..metrics import MeasuredPopen, measured_check_call, step_thread_pool
 from ..models import Params
+from ..panel import panel_allele_file
+from ..pileup_cache import cached_pileups, fill_missing_samples
 
 __all__ = ["call_alleles"]
 
 
+def _region_shards(allele_file: Path, genotypes_dir: Path, n_shards: int) -> list[Path]:
+    """
+    Splits the panel allele TSV into up to n_shards contiguous (in panel order) bgzipped, tabix-indexed regions files,
+    which are cached by panel contents and shard count.
+    """
+
+    with open(allele_file, "rb") as fh:
+        contents = fh.read()
+
+    lines = [line for line in contents.decode().splitlines(keepends=True) if line.strip()]
+    n_shards = max(min(n_shards, len(lines)), 1)
+
+    shards_dir = genotypes_dir / f"regions_{hashlib.sha256(contents).hexdigest()[:12]}_{n_shards}"
+    shards_dir.mkdir(exist_ok=True)
+
+    shards: list[Path] = []
+
+    for i in range(n_shards):
+        shard = shards_dir / f"{allele_file.stem}.{i + 1:03d}.tsv.gz"
+        shards.append(shard)
+
+        if Path(f"{shard}.tbi").exists():  # index is created last
+            continue
+
+        shard_tsv = shards_dir / f"{allele_file.stem}.{i + 1:03d}.tsv"
+        with open(shard_tsv, "w") as fh:
+            fh.writelines(lines[i * len(lines) // n_shards : (i + 1) * len(lines) // n_shards])
+        # Compresses the TSV to shard (removing the plain-text file) and indexes it; columns are CHROM, POS, alleles
+        pysam.tabix_index(str(shard_tsv), seq_col=0, start_col=1, end_col=1, force=True)
+
+    return shards
+
+
+def _call(source: tuple[str, ...] | Path, regions: Path, vcf_out: Path, output_type: str | None = None):
+    """
+    Runs bcftools call on genotype likelihoods produced by a source command (e.g., bcftools mpileup) or read from a
+    file, restricted to the sites and alleles in a regions file.
+    :param output_type: bcftools output type (-O); by default, bcftools picks one from the output file name.
+    """
+
+    call_cmd = (
+        "bcftools",
+        "call",
+        "-mv",
+        "-C",
+        "alleles",
+        "-T",
+        str(regions),
+        "--format-fields",
+        "gq",
+        *(("-O", output_type) if output_type else ()),
+        "-o",
+        str(vcf_out),
+    )
+
+    if isinstance(source, Path):
+        measured_check_call((*call_cmd, str(source)))
+        return
+
+    source_p = MeasuredPopen(source, stdout=subprocess.PIPE)
+
+    try:
+        measured_check_call(call_cmd, stdin=source_p.stdout)
+    finally:
+        source_p.stdout.close()
+
+    if source_p.wait() != 0:
+        raise subprocess.CalledProcessError(source_p.returncode, source_p.args)
+
+
+def _pileup_and_call(
+    ref_genome: Path,
+    bam_list: Path,
+    regions: Path,
+    vcf_out: Path,
+    indexed_regions: bool,
+    output_type: str | None = None,
+):
+    """
+    Runs bcftools mpileup | bcftools call over the BAMs in bam_list, restricted to the sites in a regions file.
+    :param indexed_regions: whether mpileup should jump to each region through the BAM indices (-R) rather than
+                            streaming through whole BAMs (-T).
+    :param output_type: bcftools output type (-O); by default, bcftools picks one from the output file name.
+    """
+
+    pileup_cmd = (
+        "bcftools",
+        "mpileup",
+        "-f",
+        str(ref_genome),
+        "-R" if indexed_regions else "-T",
+        str(regions),
+        "--annotate",
+        "AD,DP",
+        "--bam-list",
+        str(bam_list),
+    )
+    _call(pileup_cmd, regions, vcf_out, output_type)
+
+
+def _sharded_pileup_and_call(
+    ref_genome: Path,
+    bam_list: Path,
+    allele_file: Path,
+    genotypes_dir: Path,
+    vcf_out: Path,
+    n_shards: int,
+    processes: int,
+):
+    """
+    Genotypes contiguous shards of the panel concurrently, each jumping to its sites through the BAM indices, then
+    concatenates the shard results back together in panel order.
+    """
+
+    shards = _region_shards(allele_file, genotypes_dir, n_shards)
+    shard_bcfs = [genotypes_dir / f"shard_{i + 1:03d}.bcf" for i in range(len(shards))]
+
+    logger.info("Calling alleles in %d region shards with up to %d processes", len(shards), processes)
+
+    with step_thread_pool(max_workers=max(processes, 1)) as executor:
+        futures = [
+            executor.submit(_pileup_and_call, ref_genome, bam_list, shard, shard_bcf, True, "b")
+            for shard, shard_bcf in zip(shards, shard_bcfs)
+        ]
+        for future in futures:
+            future.result()
+
+    measured_check_call(("bcftools", "concat", "-o", str(vcf_out), *map(str, shard_bcfs)))
+
+    for shard_bcf in shard_bcfs:
+        os.unlink(shard_bcf)
+
+
+def _cached_pileup_and_call(
+    ref_genome: Path,
+    bams: list[Path],
+    allele_file: Path,
+    genotypes_dir: Path,
+    cache_dir: Path,
+    vcf_out: Path,
+    processes: int,
+):
+    """
+    Piles up only BAMs which have not been seen before, then jointly calls genotypes from the cached per-BAM
+    pileups. Sample order is preserved, since bcftools merge keeps the order of its input files.
+    """
+
+    regions = _region_shards(allele_file, genotypes_dir, 1)[0]
+    pileups = cached_pileups(bams, ref_genome, allele_file, regions, cache_dir, processes)
+
+    pileup_list = genotypes_dir / "pileups.txt"
+    with open(pileup_list, "w") as fh:
+        fh.writelines(f"{f}\n" for f in pileups)
+
+    # Sum the auxiliary per-site tags bcftools call relies on (e.g., QS, used to pick alleles), as in a joint mpileup.
+    # Identical BAMs (e.g., empty ones from failed samples) share a cached record, hence --force-samples.
+    merge_p = MeasuredPopen(
+        (
+            "bcftools",
+            "merge",
+            "--force-samples",
+            "--force-single",
+            "--info-rules",
+            "DP:sum,QS:sum,I16:sum,IDV:max,IMF:max",
+            "-Ov",
+            "--file-list",
+            str(pileup_list),
+        ),
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+
+    # Samples with no reads at a site have no record there to merge; give them the zero-coverage values a joint
+    # mpileup would, so that both paths call identical VCFs.
+    merged_vcf = genotypes_dir / "merged.vcf"
+    try:
+        with open(merged_vcf, "w") as fh:
+            fh.writelines(fill_missing_samples(merge_p.stdout))
+    finally:
+        merge_p.stdout.close()
+    if merge_p.wait() != 0:
+        raise subprocess.CalledProcessError(merge_p.returncode, merge_p.args)
+
+    _call(merged_vcf, allele_file, vcf_out)
+    os.unlink(merged_vcf)
+
+
 def call_alleles(
     params: Params,
     run_work_dir: Path,
     sample_bams: dict[int, Path],
     ref_genome: Path,
 ):
-    allele_file = Path(__file__).parent.parent / "alleles" / f"{params.species}.tsv"
+    allele_file = panel_allele_file(params.species)
     assert allele_file.exists()
 
     genotypes_dir = run_work_dir / "genotypes"
@@ -21,45 +217,37 @@ def call_alleles(
 
     bam_list = genotypes_dir / "bams.txt"
 
+    # In batch alignment mode, every sample maps to the same multi-sample BAM; mpileup takes sample names (in sample
+    # order) from its read groups, so each BAM only needs to be listed once.
     with open(bam_list, "w") as fh:
-        for f in sample_bams.values():
+        for f in dict.fromkeys(sample_bams.values()):
             fh.write(f"{f}\n")
 
-    pileup_p = subprocess.Popen(
-        (
-            "bcftools",
-            "mpileup",
-            "-f",
-            str(ref_genome),
-            "-T",
-            str(allele_file),
-            "--annotate",
-            "AD,DP",
-            "--bam-list",
-            str(bam_list),
-        ),
-        stdout=subprocess.PIPE,
-    )
-
     vcf_name = params.vcf.name
     vcf_run_out = run_work_dir / vcf_name
 
-    subprocess.check_call(
-        (
-            "bcftools",
-            "call",
-            "-mv",
-            "-C",
-            "alleles",
-            "-T",
-            str(allele_file),
-            "--format-fields",
-            "gq",
-            "-o",
-            str(vcf_run_out),
-        ),
-        stdin=pileup_p.stdout,
-    )
+    if params.genotyper == "native":
+        genotype_panel(
+            ref_genome, list(dict.fromkeys(sample_bams.values())), allele_file, vcf_run_out, params.processes
+        )
+
+    elif params.pileup_cache:
+        _cached_pileup_and_call(
+            ref_genome,
+            list(dict.fromkeys(sample_bams.values())),
+            allele_file,
+            genotypes_dir,
+            params.work_dir / "pileup_cache",
+            vcf_run_out,
+            params.processes,
+        )
+
+    elif params.genotype_shards <= 1:
+        _pileup_and_call(ref_genome, bam_list, allele_file, vcf_run_out, indexed_regions=False)
+    else:
+        _sharded_pileup_and_call(
+            ref_genome, bam_list, allele_file, genotypes_dir, vcf_run_out, params.genotype_shards, params.processes
+        )
 
     # Copy the VCF output from the run work directory to the final location
     shutil.copy(vcf_run_out, params.vcf, follow_symlinks=True)
@@ -1,8 +1,16 @@
+import contextlib
+import functools
 import os
-import subprocess
+import shutil
+from concurrent.futures import Executor
 from pathlib import Path
+from typing import Iterator
 
+from ..fastq import open_fastq
+from ..journal import Journal, WorkUnit, run_units, unit_key
+from ..metrics import measured_check_call, step_thread_pool
 from ..models import SexCallingParams, Sample
+from ..sex_genotyper import compile_genos, genotype_sample_sex_markers, sex_marker_executor
 
 __all__ = ["call_sex_markers"]
 
@@ -11,20 +19,54 @@ GENOTYPER = "GTseq_Genotyper_v3.pl"
 GENO_COMPILE = "GTseq_GenoCompile_v3.pl"
 
 
+@contextlib.contextmanager
+def _plain_fastq(fastq: Path, scratch_dir: Path) -> Iterator[Path]:
+    # The Campbell et al. genotyper can only read uncompressed FASTQs, so decompress (BGZF-)gzipped ones temporarily.
+    if fastq.suffix != ".gz":
+        yield fastq
+        return
+
+    plain_fastq = scratch_dir / fastq.name.removesuffix(".gz")
+    try:
+        with open_fastq(fastq) as fi, open(plain_fastq, "wb") as fo:
+            shutil.copyfileobj(fi, fo)
+        yield plain_fastq
+    finally:
+        plain_fastq.unlink(missing_ok=True)
+
+
+def _genotype_sample(genotyper: Path, marker_file: Path, fastq: Path, genos_file: Path, scratch_dir: Path):
+    # Write to the scratch directory first, then move into place: a .genos file only ever exists once complete, so it
+    # can be skipped on re-runs, and GenoCompile (which reads every *.genos file) never sees a partial one.
+    genos_tmp = scratch_dir / f"{genos_file.name}.tmp"
+    try:
+        with _plain_fastq(fastq, scratch_dir) as plain_fastq, open(genos_tmp, "w") as fh:
+            measured_check_call(("perl", str(genotyper), str(marker_file), str(plain_fastq)), stdout=fh)
+        os.replace(genos_tmp, genos_file)
+    finally:
+        genos_tmp.unlink(missing_ok=True)
+
+
 def call_sex_markers(
-    params: SexCallingParams, run_work_dir: Path, samples: list[Sample], sample_fastqs: dict[int, Path]
+    params: SexCallingParams,
+    run_work_dir: Path,
+    samples: list[Sample],
+    sample_fastqs: dict[int, Path],
+    processes: int = 1,
 ):
     # Ensure we have a sex-linked marker file, which should be in the Campbell format;
     # see https://github.com/GTseq/GTseq-Pipeline/blob/master/GTseq_Genotyper_v3.pl
     marker_file = Path(__file__).parent.parent / "alleles" / f"{params.species}.sl.csv"
     assert marker_file.exists()
 
-    # Ensure we have a path to the Campbell et al. scripts:
-    assert params.gtseq_scripts.is_dir()
+    # Ensure we have a path to the Campbell et al. scripts, unless we are using the native re-implementation:
+    native = params.sex_genotyper == "native"
+    if not native:
+        assert params.gtseq_scripts.is_dir()
     genotyper: Path = (params.gtseq_scripts / GENOTYPER).absolute()
-    assert genotyper.is_file()
+    assert native or genotyper.is_file()
     geno_compile: Path = (params.gtseq_scripts / GENO_COMPILE).absolute()
-    assert geno_compile.is_file()
+    assert native or geno_compile.is_file()
 
     # Ensure we have an output path:
     output_path = params.sex_calls
@@ -35,20 +77,40 @@ def call_sex_markers(
     out_dir = run_work_dir / "sex_linked"
     genos_dir = out_dir / "genos"
     genos_dir.mkdir(parents=True, exist_ok=True)
+    scratch_dir = out_dir / "tmp"
+    scratch_dir.mkdir(exist_ok=True)
 
-    # For each sample, call sex-linked genotypes (Campbell et al. script)
+    # For each sample, call sex-linked genotypes (Campbell et al. script, or its native re-implementation); each call is
+    # single-threaded, so run up to `processes` of them at once. Completed samples are journaled, so re-runs only redo
+    # samples which are unfinished, or whose FASTQ or genotyper changed.
+    journal = Journal(out_dir / "journal.jsonl")
+    units = []
     for si, fastq in sample_fastqs.items():
-        sample = samples[si]
-        print(f"Calling sex-linked markers for {sample.sample_id} ({fastq=})")
-        with open(genos_dir / f"{sample.full_name()}.genos", "w") as fh:
-            subprocess.check_call(("perl", str(genotyper), str(marker_file), str(fastq)), stdout=fh)
-        print("    Done.")
-
-    # Compile the genotypes into a single file (Campbell et al. script)
-    cwd = os.getcwd()
-    try:
-        os.chdir(genos_dir)
-        with open(output_path, "w") as fh:
-            subprocess.check_call(("perl", str(geno_compile), "S", "0"), stdout=fh)
-    finally:
-        os.chdir(cwd)
+        genos_file = genos_dir / f"{samples[si].full_name()}.genos"
+        units.append(
+            WorkUnit(
+                name=samples[si].full_name(),
+                key=unit_key(marker_file, params.sex_genotyper, fastq, None if native else genotyper),
+                outputs=[genos_file],
+                run=(
+                    functools.partial(genotype_sample_sex_markers, fastq, genos_file, scratch_dir)
+                    if native
+                    else functools.partial(_genotype_sample, genotyper, marker_file, fastq, genos_file, scratch_dir)
+                ),
+            )
+        )
+
+    executor: Executor = (
+        sex_marker_executor(marker_file, processes) if native else step_thread_pool(max_workers=max(processes, 1))
+    )
+    with executor:
+        run_units(units, journal, executor, f"Sex-linked marker calling ({params.sex_genotyper})")
+
+    if native:
+        compile_genos(list(genos_dir.glob("*.genos")), output_path)
+        return
+
+    # Compile the genotypes into a single file (Campbell et al. script), which reads the .genos files from its working
+    # directory; pass it as cwd= rather than changing this process' working directory, which other steps share.
+    with open(output_path, "w") as fh:
+        measured_check_call(("perl", str(geno_compile), "S", "0"), stdout=fh, cwd=genos_dir)
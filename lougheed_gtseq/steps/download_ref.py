@@ -1,12 +1,31 @@
+import gzip
+import os
 import requests
 import shutil
-import subprocess
 from pathlib import Path
 
+from lougheed_gtseq.compression import BgzfWriterPool
+from lougheed_gtseq.genome_cache import (
+    BWA_INDEX_EXTENSIONS,
+    FAIDX_EXTENSIONS,
+    bwa_index_atomic,
+    cache_lock,
+    check_cached_files,
+    faidx_atomic,
+    file_digest,
+    read_manifest,
+    write_manifest,
+)
 from lougheed_gtseq.logger import logger
 from lougheed_gtseq.models import Params
 
-__all__ = ["download_genome_if_needed"]
+__all__ = [
+    "GENOME_INDEX_EXTENSIONS",
+    "genomes_folder_for",
+    "genome_file_for",
+    "ensure_genome",
+    "download_genome_if_needed",
+]
 
 REFERENCE_GENOME_URLS = {
     "polar": (
@@ -19,37 +38,123 @@ REFERENCE_GENOME_FILE_NAMES = {
     "polar": "UrsMar_1.0_genomic.fna.gz",
 }
 
+GENOME_INDEX_EXTENSIONS = (*FAIDX_EXTENSIONS, *BWA_INDEX_EXTENSIONS)
 
-def download_genome_if_needed(params: Params) -> Path:
-    species = params.species
-    work_dir = params.work_dir
-
-    if species not in REFERENCE_GENOME_URLS:
-        raise ValueError(f"Invalid species: {species}")
-
-    genomes_folder = params.genomes or work_dir / "ref"
-    genomes_folder.mkdir(exist_ok=True)
+RECOMPRESS_CHUNK_SIZE = 4 * 1024 * 1024
 
-    genome_file = genomes_folder / REFERENCE_GENOME_FILE_NAMES[species]
 
-    if genome_file.exists():  # TODO: validate checksum and index
-        logger.info(f"Already have genome for species '{species}'")
-        return genome_file  # already have genome, so return early - nothing to do
+def genomes_folder_for(params: Params) -> Path:
+    return params.genomes or params.work_dir / "ref"
 
-    logger.info(f"Attempting to download genome for species '{species}'")
 
-    genome_url = REFERENCE_GENOME_URLS[species]
+def genome_file_for(species: str, genomes_folder: Path) -> Path:
+    if species not in REFERENCE_GENOME_URLS:
+        raise ValueError(f"Invalid species: {species}")
+    return genomes_folder / REFERENCE_GENOME_FILE_NAMES[species]
+
+
+def _fetch_ncbi_md5(genome_url: str) -> str | None:
+    # NCBI assembly directories have an md5checksums.txt file, with lines like: <md5>  ./<file name>
+    md5_url = f"{genome_url.rsplit('/', 1)[0]}/md5checksums.txt"
+    try:
+        r = requests.get(md5_url, timeout=60)
+        r.raise_for_status()
+    except requests.RequestException as e:
+        logger.warning("Could not fetch genome checksums from %s: %s", md5_url, e)
+        return None
+
+    file_name = genome_url.rsplit("/", 1)[1]
+    for line in r.text.splitlines():
+        md5, _, name = line.partition("  ")
+        if name.removeprefix("./") == file_name:
+            return md5
+    return None
+
+
+def _download_genome(genome_url: str, genome_file: Path, processes: int) -> str:
+    """
+    Downloads a gzipped genome, checks it against NCBI's published checksum, and re-compresses it as BGZF (required
+    for random access by faidx/pysam) into genome_file. Everything is written under temporary names first.
+    :return: the MD5 checksum of the downloaded file.
+    """
+
+    download_tmp = genome_file.with_name(f"{genome_file.name}.download")
+    bgzf_tmp = genome_file.with_name(f"{genome_file.name}.tmp")
+
+    logger.info("Attempting to download genome: %s", genome_url)
     with requests.get(genome_url, stream=True) as r:
-        with open(genome_file, "wb") as fh:
+        r.raise_for_status()
+        with open(download_tmp, "wb") as fh:
             shutil.copyfileobj(r.raw, fh)
 
-    logger.info(f"Finished downloading genome to path: {genome_file}")
+    md5 = file_digest(download_tmp, "md5")
+    expected_md5 = _fetch_ncbi_md5(genome_url)
+    if expected_md5 is not None and md5 != expected_md5:
+        download_tmp.unlink()
+        raise ValueError(f"Downloaded genome checksum mismatch: expected {expected_md5}, got {md5}")
+
+    logger.info("Re-compressing genome as BGZF: %s", genome_file)
+    with gzip.open(download_tmp, "rb") as fh_in, BgzfWriterPool(processes) as pool:
+        fh_out = pool.open(bgzf_tmp)
+        try:
+            while chunk := fh_in.read(RECOMPRESS_CHUNK_SIZE):
+                fh_out.write(chunk)
+        finally:
+            fh_out.close()
+
+    os.replace(bgzf_tmp, genome_file)
+    download_tmp.unlink()
+
+    return md5
+
+
+def ensure_genome(species: str, genomes_folder: Path, processes: int, full_check: bool = False) -> Path:
+    """
+    Makes sure the shared genome cache holds a complete, indexed reference genome for a species, (re-)building any
+    missing or invalid files. Concurrent callers sharing the cache folder wait for a single builder.
+    :param species: species to fetch the genome for.
+    :param genomes_folder: shared reference genome cache folder.
+    :param processes: number of threads for BGZF re-compression.
+    :param full_check: whether to verify checksums of existing files, rather than just their presence and sizes.
+    :return: path to the bgzipped genome FASTA.
+    """
+
+    genomes_folder.mkdir(parents=True, exist_ok=True)
+    genome_file = genome_file_for(species, genomes_folder)
+
+    with cache_lock(genomes_folder, genome_file.name):
+        if not (problems := check_cached_files(genome_file, GENOME_INDEX_EXTENSIONS, full_check)):
+            if read_manifest(genome_file) is None:  # complete genome from before the cache had manifests
+                write_manifest(genome_file, GENOME_INDEX_EXTENSIONS)
+            logger.info(f"Already have genome for species '{species}'")
+            return genome_file
+
+        for path, problem in problems.items():
+            logger.warning("Genome cache file %s: %s", path, problem)
+
+        manifest = read_manifest(genome_file)
+        source_url = manifest.source_url if manifest else None
+        source_md5 = manifest.source_md5 if manifest else None
+
+        rebuild_genome = genome_file in problems
+        if rebuild_genome:
+            source_url = REFERENCE_GENOME_URLS[species]
+            source_md5 = _download_genome(source_url, genome_file, processes)
+            logger.info(f"Finished downloading genome to path: {genome_file}")
+
+        if rebuild_genome or any(Path(f"{genome_file}{ext}") in problems for ext in FAIDX_EXTENSIONS):
+            logger.info(f"Building FASTA index for genome: {genome_file}")
+            faidx_atomic(genome_file)
+
+        if rebuild_genome or any(Path(f"{genome_file}{ext}") in problems for ext in BWA_INDEX_EXTENSIONS):
+            logger.info(f"Indexing genome: {genome_file}")
+            bwa_index_atomic(genome_file)
+
+        # The manifest is written last, recording the set of files as complete
+        write_manifest(genome_file, GENOME_INDEX_EXTENSIONS, source_url, source_md5)
 
-    logger.info(f"Re-compressing genome as bgzip: {genome_file}")
-    subprocess.check_call(("gunzip", str(genome_file)))
-    subprocess.check_call(("bgzip", "-@", str(params.processes), str(genome_file).replace(".gz", "")))
+    return genome_file
 
-    logger.info(f"Indexing downloaded genome: {genome_file}")
-    subprocess.check_call(("bwa", "index", genome_file))
 
-    return genome_file
+def download_genome_if_needed(params: Params) -> Path:
+    return ensure_genome(params.species, genomes_folder_for(params), params.processes)
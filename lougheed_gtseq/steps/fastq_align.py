@@ -1,20 +1,128 @@
-import pysam
+import functools
+import os
 import subprocess
+import threading
+import pysam
 from pathlib import Path
 
+from ..fastq import open_fastq, read_paired_blocks, interleave_records
+from ..journal import Journal, WorkUnit, atomic_path, run_units, unit_key, valid_bam
 from ..logger import logger
-from ..models import Params, Sample
+from ..metrics import MeasuredPopen, measured_check_call, step_thread_pool
+from ..models import Params, Sample, SplitManifest
+from ..panel import PanelIntervals, SamLiftover, panel_allele_file
+from ..scheduling import CpuBudget, plan_threads
 
 __all__ = ["fastq_align"]
 
+# Number of read pairs per bwa/samtools thread when sizing per-sample thread allocations
+ALIGN_READS_PER_THREAD = 50000
+
+# Size of the FASTQ blocks read from each sample's files when streaming reads to a batch-mode bwa process
+ALIGN_FEED_BLOCK_SIZE = 1024 * 1024
+
+
+def _pipeline_threads(processes: int, streaming_stages: int) -> tuple[int, int]:
+    """
+    Splits a grant of threads between the stages of an alignment pipeline, so that it stays within the grant.
+    While reads stream through, bwa does almost all the work, alongside one thread for each other streaming stage
+    (samtools sort reading its input, and any feeder, liftover or panel filter.) samtools sort's worker threads mostly
+    compress the output once bwa has finished, so they can have the rest of the grant then.
+    :param processes: number of threads granted to the pipeline.
+    :param streaming_stages: number of single-threaded stages running alongside bwa.
+    :return: (bwa mem -t threads, samtools sort -@ additional threads)
+    """
+    return max(processes - streaming_stages, 1), max(processes - 1, 0)
+
+
+def _sort_alignments(
+    align_p: subprocess.Popen,
+    sorted_bam: Path,
+    sort_threads: int,
+    panel_bed: Path | None,
+    liftover: SamLiftover | None,
+):
+    """
+    Coordinate-sorts an aligner process' SAM output straight into a BAM (samtools sort reads SAM, so no separate
+    SAM -> BAM conversion stage is needed.) If a liftover is given, alignments to an amplicon mini-reference are first
+    lifted back to genome coordinates; if a panel BED file is given, only alignments overlapping its intervals are kept
+    (by samtools view -L, which streams; unmapped reads placed at their mate's position are kept with on-target mates.)
+    """
+
+    sort_cmd = ("samtools", "sort", "-@", str(sort_threads), "-o", str(sorted_bam), "-")
+    # The aligner's output goes to the first process of the chain, or through the liftover if there is one
+    head_stdin = subprocess.PIPE if liftover else align_p.stdout
+
+    filter_p: subprocess.Popen | None = None
+    if panel_bed is not None:
+        filter_p = MeasuredPopen(
+            ("samtools", "view", "-u", "-L", str(panel_bed), "-"),
+            stdin=head_stdin,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        sort_p = MeasuredPopen(sort_cmd, stdin=filter_p.stdout, stderr=subprocess.DEVNULL)
+        filter_p.stdout.close()
+    else:
+        sort_p = MeasuredPopen(sort_cmd, stdin=head_stdin, stderr=subprocess.DEVNULL)
+    head_p = filter_p or sort_p
+
+    if liftover is None:
+        # Close our copy of the pipe, so that the aligner gets SIGPIPE if samtools exits early
+        align_p.stdout.close()
+    else:
+        try:
+            head_p.stdin.writelines(liftover.lift_lines(align_p.stdout))
+        finally:
+            align_p.stdout.close()
+            head_p.stdin.close()
+
+    for p in (filter_p, sort_p):
+        if p is not None and p.wait() != 0:
+            raise subprocess.CalledProcessError(p.returncode, p.args)
+
+
+def _index_into_place(tmp_bam: Path, sorted_bam: Path):
+    # Index the complete temporary BAM, then move BAM and index into place; a BAM at its final path is always complete
+    measured_check_call(("samtools", "index", str(tmp_bam), f"{tmp_bam}.bai"))
+    try:
+        os.replace(tmp_bam, sorted_bam)
+        os.replace(f"{tmp_bam}.bai", f"{sorted_bam}.bai")
+    finally:
+        Path(f"{tmp_bam}.bai").unlink(missing_ok=True)
+
 
-def align_sample_to_bam(ref_genome: Path, fq_r1: Path, fq_r2: Path, sorted_bam: Path, processes: int):
-    align_p = subprocess.Popen(
+def align_sample_to_bam(
+    ref_genome: Path,
+    fq_r1: Path,
+    fq_r2: Path,
+    sorted_bam: Path,
+    processes: int,
+    panel_bed: Path | None = None,
+    liftover: SamLiftover | None = None,
+):
+    with atomic_path(sorted_bam) as tmp_bam:
+        _align_sample(ref_genome, fq_r1, fq_r2, tmp_bam, processes, panel_bed, liftover)
+        _index_into_place(tmp_bam, sorted_bam)
+
+
+def _align_sample(
+    ref_genome: Path,
+    fq_r1: Path,
+    fq_r2: Path,
+    sorted_bam: Path,
+    processes: int,
+    panel_bed: Path | None,
+    liftover: SamLiftover | None,
+):
+    bwa_threads, sort_threads = _pipeline_threads(processes, 1 + (panel_bed is not None) + (liftover is not None))
+
+    align_p = MeasuredPopen(
         (
             "bwa",
             "mem",
             "-t",
-            str(processes),
+            str(bwa_threads),
             str(ref_genome),
             str(fq_r1),
             str(fq_r2),
@@ -23,22 +131,130 @@ def align_sample_to_bam(ref_genome: Path, fq_r1: Path, fq_r2: Path, sorted_bam:
         stderr=subprocess.DEVNULL,
     )
 
-    bam_p = subprocess.Popen(
-        ("samtools", "view", "-Sb", "-"),
-        stdin=align_p.stdout,
+    _sort_alignments(align_p, sorted_bam, sort_threads, panel_bed, liftover)
+
+    # Reap the aligner (several alignments may be running at once) and make sure it succeeded
+    if align_p.wait() != 0:
+        raise subprocess.CalledProcessError(align_p.returncode, align_p.args)
+
+
+def _feed_interleaved_reads(
+    samples: list[Sample], sample_files_r1: dict[int, Path], sample_files_r2: dict[int, Path], fh
+):
+    # Stream every sample's read pairs, interleaved and tagged with the sample's read group, into bwa's standard input
+    for si, fq_r1 in sample_files_r1.items():
+        comment = f"RG:Z:{samples[si].full_name()}".encode()
+        with open_fastq(fq_r1) as fq1, open_fastq(sample_files_r2[si]) as fq2:
+            for block_r1, block_r2 in read_paired_blocks(fq1, fq2, ALIGN_FEED_BLOCK_SIZE):
+                fh.write(interleave_records(block_r1, block_r2, comment))
+
+
+def align_batch_to_bam(
+    ref_genome: Path,
+    samples: list[Sample],
+    sample_files_r1: dict[int, Path],
+    sample_files_r2: dict[int, Path],
+    sorted_bam: Path,
+    processes: int,
+    panel_bed: Path | None = None,
+    liftover: SamLiftover | None = None,
+):
+    """
+    Aligns all samples' reads with a single bwa mem process, so the reference index is only loaded once per batch.
+    Each read carries its sample's read group, producing one coordinate-sorted multi-sample BAM with an @RG header line
+    (ID and SM both set to the sample's full name) for every sample, in sample order - including samples without reads.
+    """
+
+    rg_header = sorted_bam.with_suffix(".rg.txt")
+    with open(rg_header, "w") as fh:
+        for sample in samples:
+            fh.write(f"@RG\tID:{sample.full_name()}\tSM:{sample.full_name()}\n")
+
+    with atomic_path(sorted_bam) as tmp_bam:
+        _align_batch(
+            ref_genome, samples, sample_files_r1, sample_files_r2, rg_header, tmp_bam, processes, panel_bed, liftover
+        )
+        _index_into_place(tmp_bam, sorted_bam)
+
+
+def _align_batch(
+    ref_genome: Path,
+    samples: list[Sample],
+    sample_files_r1: dict[int, Path],
+    sample_files_r2: dict[int, Path],
+    rg_header: Path,
+    sorted_bam: Path,
+    processes: int,
+    panel_bed: Path | None,
+    liftover: SamLiftover | None,
+):
+    # The read feeder is a streaming stage too
+    bwa_threads, sort_threads = _pipeline_threads(processes, 2 + (panel_bed is not None) + (liftover is not None))
+
+    align_p = MeasuredPopen(
+        # -p: interleaved paired-end input; -C: copy the RG:Z: comment into the SAM record; -H: add @RG header lines
+        ("bwa", "mem", "-t", str(bwa_threads), "-p", "-C", "-H", str(rg_header), str(ref_genome), "-"),
+        stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
         stderr=subprocess.DEVNULL,
     )
 
-    with open(sorted_bam, "wb") as fh:
-        subprocess.check_call(
-            ("samtools", "sort", "-@", str(processes), "-"),
-            stdin=bam_p.stdout,
-            stdout=fh,
-            stderr=subprocess.DEVNULL,
-        )
+    feed_error: list[BaseException] = []
+
+    def _feed():
+        try:
+            _feed_interleaved_reads(samples, sample_files_r1, sample_files_r2, align_p.stdin)
+        except Exception as e:  # includes BrokenPipeError if bwa exits early
+            feed_error.append(e)
+            align_p.kill()
+        finally:
+            try:
+                align_p.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    feeder = threading.Thread(target=_feed, name="bwa-feed")
+    feeder.start()
+
+    try:
+        _sort_alignments(align_p, sorted_bam, sort_threads, panel_bed, liftover)
+    finally:
+        feeder.join()
+
+    align_p.wait()
+    if feed_error:
+        raise feed_error[0]
+    if align_p.returncode != 0:
+        raise subprocess.CalledProcessError(align_p.returncode, align_p.args)
+
 
-    subprocess.check_call(("samtools", "index", str(sorted_bam)))
+def split_bam_by_read_group(samples: list[Sample], batch_bam: Path, out_dir: Path, processes: int) -> dict[int, Path]:
+    """
+    Splits a sorted multi-sample BAM into sorted, indexed per-sample BAMs named like the per-sample alignment mode's.
+    """
+
+    measured_check_call(
+        (
+            "samtools",
+            "split",
+            "-@",
+            str(processes),
+            "--output-fmt",
+            "bam",
+            "-f",
+            str(out_dir / "GTSeq_%!.bam"),
+            str(batch_bam),
+        ),
+        stderr=subprocess.DEVNULL,
+    )
+
+    sample_bams: dict[int, Path] = {
+        si: out_dir / f"GTSeq_{sample.full_name()}.bam" for si, sample in enumerate(samples)
+    }
+    for bam in sample_bams.values():
+        measured_check_call(("samtools", "index", str(bam)))
+
+    return sample_bams
 
 
 def fastq_align(
@@ -47,27 +263,123 @@ def fastq_align(
     samples: list[Sample],
     sample_files_r1: dict[int, Path],
     sample_files_r2: dict[int, Path],
+    split_manifest: SplitManifest,
     ref_genome: Path,
+    amplicon_ref: Path | None = None,
 ) -> dict[int, Path]:
     align = run_work_dir / "align"
     align.mkdir(exist_ok=True)
 
-    sample_bams: dict[int, Path] = {}
+    # When aligning to an amplicon mini-reference, alignments are lifted back to genome coordinates before sorting, so
+    # BAMs (and everything downstream of them) are the same as if reads had been aligned to the whole genome.
+    align_ref = ref_genome
+    liftover: SamLiftover | None = None
+    if amplicon_ref is not None:
+        align_ref = amplicon_ref
+        with pysam.FastaFile(str(ref_genome)) as genome:
+            liftover = SamLiftover(zip(genome.references, genome.lengths))
+        logger.info("Aligning to amplicon reference: %s", amplicon_ref)
+
+    # Only the panel's sites are ever genotyped, so BAMs can optionally be restricted to alignments near them
+    panel_bed: Path | None = None
+    if params.panel_bams:
+        panel = PanelIntervals.from_allele_file(panel_allele_file(params.species))
+        panel_bed = align / "panel.bed"
+        panel.write_bed(panel_bed)
+        logger.info("Restricting BAMs to %d intervals around %s panel sites", len(panel), params.species)
+
+    # Completed alignments are journaled, so a re-run of an interrupted step only redoes unfinished samples/batches.
+    # A unit's key covers its inputs and everything which changes its BAM(s).
+    journal = Journal(align / "journal.jsonl")
+    align_key = (align_ref, params.species, params.panel_bams)
+
+    if params.align_mode != "sample":
+        # Batch modes: one bwa process for all samples, with samples distinguished by read group
+        batch_bam = align / f"GTSeq_{params.batch}.bam"
+        batch_key = unit_key(*align_key, samples, sample_files_r1, sample_files_r2)
+        logger.info(
+            "Aligning %d read pairs from %d samples in a single batch with %d threads",
+            sum(stats.read_pairs for stats in split_manifest.samples.values()),
+            len(sample_files_r1),
+            params.processes,
+        )
+
+        with step_thread_pool(max_workers=1) as executor:
+            run_units(
+                [
+                    WorkUnit(
+                        name="batch",
+                        key=batch_key,
+                        outputs=[batch_bam],
+                        run=lambda: align_batch_to_bam(
+                            align_ref,
+                            samples,
+                            sample_files_r1,
+                            sample_files_r2,
+                            batch_bam,
+                            params.processes,
+                            panel_bed,
+                            liftover,
+                        ),
+                        validate_output=valid_bam,
+                    )
+                ],
+                journal,
+                executor,
+                "Batch alignment",
+            )
 
-    for si, sample in enumerate(samples):
-        fq_r1 = sample_files_r1[si]
-        fq_r2 = sample_files_r2[si]
+            if params.align_mode == "batch-split":
+                sample_bams = {si: align / f"GTSeq_{sample.full_name()}.bam" for si, sample in enumerate(samples)}
+                run_units(
+                    [
+                        WorkUnit(
+                            name="batch-split",
+                            key=unit_key(batch_key, batch_bam),
+                            outputs=list(sample_bams.values()),
+                            run=lambda: split_bam_by_read_group(samples, batch_bam, align, params.processes),
+                            validate_output=valid_bam,
+                        )
+                    ],
+                    journal,
+                    executor,
+                    "Batch BAM split",
+                )
+                return sample_bams
 
-        with pysam.FastxFile(str(fq_r1)) as fqf:
-            n_reads = sum(1 for _ in fqf)
+        # Every sample's reads are in the same BAM; call_alleles reads sample names from its read groups
+        return {si: batch_bam for si in range(len(samples))}
 
-        logger.info(f"Aligning %d reads for sample: %s", n_reads, sample)
+    # Read counts were collected while splitting reads by sample, so we don't need to re-read the FASTQs here
+    sample_n_reads: dict[int, int] = {si: split_manifest.read_pairs(si) for si in range(len(samples))}
 
-        sorted_bam = align / f"GTSeq_{sample.full_name()}.bam"
+    # GTseq samples are small, so bwa startup and index loading dominate alignment time. Run several samples' alignment
+    # pipelines at once, splitting the CPU budget between them by read count instead of giving every sample all threads.
+    budget = CpuBudget(params.processes)
+    sample_threads = plan_threads(sample_n_reads, budget.total, ALIGN_READS_PER_THREAD)
 
-        # Run the alignment -> compress -> sort task
-        align_sample_to_bam(ref_genome, fq_r1, fq_r2, sorted_bam, params.processes)
+    sample_bams: dict[int, Path] = {si: align / f"GTSeq_{sample.full_name()}.bam" for si, sample in enumerate(samples)}
 
-        sample_bams[si] = sorted_bam
+    def _align(si: int):
+        with budget.reserve(sample_threads[si]) as threads:
+            logger.info(f"Aligning %d reads with %d threads for sample: %s", sample_n_reads[si], threads, samples[si])
+            # Run the alignment -> (liftover) -> (panel filter) -> sort task
+            align_sample_to_bam(
+                align_ref, sample_files_r1[si], sample_files_r2[si], sample_bams[si], threads, panel_bed, liftover
+            )
+
+    # Start the largest samples first, so that small samples fill in around them at the end
+    units = [
+        WorkUnit(
+            name=samples[si].full_name(),
+            key=unit_key(*align_key, sample_files_r1[si], sample_files_r2[si]),
+            outputs=[sample_bams[si]],
+            run=functools.partial(_align, si),
+            validate_output=valid_bam,
+        )
+        for si in sorted(sample_n_reads, key=sample_n_reads.get, reverse=True)
+    ]
+    with step_thread_pool(max_workers=budget.total) as executor:
+        run_units(units, journal, executor, "Sample alignment")
 
     return sample_bams
@@ -1,6 +1,6 @@
-import subprocess
 from pathlib import Path
 
+from ..metrics import measured_check_call
 from ..models import Params
 
 __all__ = ["fastq_generate"]
@@ -8,7 +8,7 @@ __all__ = ["fastq_generate"]
 
 def fastq_generate(params: Params, fastq_dir: Path) -> Path:
     with open(fastq_dir / "bcl2fastq.stdout", "w") as fo, open(fastq_dir / "bcl2fastq.stderr", "w") as fe:
-        subprocess.check_call(
+        measured_check_call(
             (
                 "bcl2fastq",
                 "-R",
@@ -1,59 +1,242 @@
-import pysam
-import re
+import multiprocessing
+import time
+import numpy as np
 
+from collections import deque
+from contextlib import closing
 from pathlib import Path
-from typing import TextIO
+from typing import BinaryIO, Iterator
 
-from ..barcodes import get_i7_barcode, get_i5_barcode
+from ..barcodes import get_i7_barcode, get_i5_barcode, build_index_table, lookup_index_fields
+from ..compression import Compression, BgzfWriter, BgzfWriterPool
+from ..fastq import open_fastq, read_paired_blocks, FastqRecords, scan_records, gather_ranges
 from ..logger import logger
-from ..models import Sample
+from ..metrics import record_throughput
+from ..models import Sample, SplitStats, SplitManifest
+from ..utils import prefetch
 
 __all__ = ["fastq_split"]
 
-READ_INDEX_PATTERN = re.compile(r"^[ACGT]{6}\+[ACGT]{6}$")
+# Approximate size, in bytes, of the R1 FASTQ block in each chunk handed to a demultiplexing worker
+SPLIT_BLOCK_SIZE = 4 * 1024 * 1024
 
+# Per-process index lookup table for chunk workers; set once by _init_chunk_worker rather than sent with every chunk
+_chunk_index_table: np.ndarray | None = None
 
-def split_file(
-    samples: list[Sample], index_seqs_lookup: dict[str, int], fq_path: Path, split_dir: Path, suffix: str
-) -> dict[int, Path]:
-    sample_files: dict[int, Path] = {}
-    sample_file_handles: dict[int, TextIO] = {}
+# Type for a chunk worker's result:
+#   ({sample index: (R1 bytes, R2 bytes, # read pairs, # bases, sum of base qualities)}, # of unassigned read pairs)
+ChunkResult = tuple[dict[int, tuple[bytes, bytes, int, int, int]], int]
 
-    logger.info(f"Splitting reads from {fq_path}")
+
+def _read_names(buf: np.ndarray, records: FastqRecords) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Finds the (start, end) offsets of each record's read name, i.e., the header up to the first space. Older Illumina
+    read names carry a /1 or /2 mate suffix instead of putting the mate number in the comment; this is excluded.
+    """
+
+    spaces = np.flatnonzero(buf == ord(" "))
+    first_spaces = np.append(spaces, len(buf))[np.searchsorted(spaces, records.starts)]
+    name_ends = np.minimum(first_spaces, records.header_ends)
+    has_mate_suffix = (buf[np.maximum(name_ends - 2, 0)] == ord("/")) & np.isin(
+        buf[np.maximum(name_ends - 1, 0)], (ord("1"), ord("2"))
+    )
+    return records.starts + 1, name_ends - 2 * has_mate_suffix
+
+
+def _check_read_names(chunks: tuple[bytes, bytes], records_r1: FastqRecords, records_r2: FastqRecords):
+    data_r1, data_r2 = chunks
+    starts_r1, ends_r1 = _read_names(np.frombuffer(data_r1, dtype=np.uint8), records_r1)
+    starts_r2, ends_r2 = _read_names(np.frombuffer(data_r2, dtype=np.uint8), records_r2)
+
+    # Fast path: all names have the same lengths and their concatenations are equal
+    if np.array_equal(ends_r1 - starts_r1, ends_r2 - starts_r2) and gather_ranges(
+        data_r1, starts_r1, ends_r1
+    ) == gather_ranges(data_r2, starts_r2, ends_r2):
+        return
+
+    for s1, e1, s2, e2 in zip(starts_r1.tolist(), ends_r1.tolist(), starts_r2.tolist(), ends_r2.tolist()):
+        if (name_r1 := data_r1[s1:e1]) != (name_r2 := data_r2[s2:e2]):
+            raise ValueError(f"R1/R2 read names out of sync: {name_r1.decode()} != {name_r2.decode()}")
+
+
+def _quality_sums(buf: np.ndarray, records: FastqRecords) -> np.ndarray:
+    # Sum of PHRED (Sanger/Illumina 1.8+ encoding) base qualities for each record
+    if not len(records):
+        return np.zeros(0, dtype=np.int64)
+    lengths = records.qual_ends - records.qual_starts
+    raw_sums = np.add.reduceat(buf, np.column_stack((records.qual_starts, records.qual_ends)).ravel(), dtype=np.int64)
+    return np.where(lengths > 0, raw_sums[::2], 0) - 33 * lengths
+
+
+def _init_chunk_worker(index_table: np.ndarray):
+    global _chunk_index_table
+    _chunk_index_table = index_table
+
+
+def _split_chunk(chunks: tuple[bytes, bytes]) -> ChunkResult:
+    buf_r1 = np.frombuffer(chunks[0], dtype=np.uint8)
+    buf_r2 = np.frombuffer(chunks[1], dtype=np.uint8)
+    records_r1 = scan_records(buf_r1)
+    records_r2 = scan_records(buf_r2)
+
+    if len(records_r1) != len(records_r2):
+        raise ValueError("R1 and R2 FASTQs have different numbers of reads")
+
+    _check_read_names(chunks, records_r1, records_r2)
+
+    # bcl2fastq puts the i7+i5 index sequences at the end of the R1 read comment, i.e., at the end of the header line;
+    # look up the sample for every record in the chunk at once.
+    sample_indices = lookup_index_fields(_chunk_index_table, buf_r1, records_r1.header_ends)
+
+    # Group the original record bytes by sample, keeping records in input order within each sample
+    order = np.argsort(sample_indices, kind="stable")
+    order = order[sample_indices[order] >= 0]
+    n_unassigned = len(sample_indices) - len(order)
+
+    sorted_indices = sample_indices[order]
+    group_starts = np.flatnonzero(np.diff(sorted_indices, prepend=-1))
+    group_ends = np.append(group_starts[1:], len(order))
+
+    # Collect per-sample statistics while we're here, so downstream steps don't need to re-read the split FASTQs
+    bases = (records_r1.seq_ends - records_r1.seq_starts) + (records_r2.seq_ends - records_r2.seq_starts)
+    quality_sums = _quality_sums(buf_r1, records_r1) + _quality_sums(buf_r2, records_r2)
+    group_bases = np.add.reduceat(bases[order], group_starts).tolist() if len(order) else []
+    group_quality_sums = np.add.reduceat(quality_sums[order], group_starts).tolist() if len(order) else []
+
+    res: dict[int, tuple[bytes, bytes, int, int, int]] = {}
+    for gi, (gs, ge) in enumerate(zip(group_starts.tolist(), group_ends.tolist())):
+        group = order[gs:ge]
+        res[int(sorted_indices[gs])] = (
+            gather_ranges(chunks[0], records_r1.starts[group], records_r1.ends[group]),
+            gather_ranges(chunks[1], records_r2.starts[group], records_r2.ends[group]),
+            ge - gs,
+            group_bases[gi],
+            group_quality_sums[gi],
+        )
+
+    return res, n_unassigned
+
+
+def _iter_split_chunks(
+    index_table: np.ndarray, chunk_pairs: Iterator[tuple[bytes, bytes]], processes: int
+) -> Iterator[ChunkResult]:
+    """
+    Classifies chunks across a process pool, yielding results in input order. Only a bounded number of chunks are
+    read ahead of the writer, to keep memory usage flat on large runs.
+    """
+
+    # spawn rather than fork: other pipeline steps' threads may be running, holding locks a forked child would inherit
+    with multiprocessing.get_context("spawn").Pool(
+        processes, initializer=_init_chunk_worker, initargs=(index_table,)
+    ) as pool:
+        pending = deque()
+        for chunk_pair in chunk_pairs:
+            pending.append(pool.apply_async(_split_chunk, (chunk_pair,)))
+            if len(pending) >= processes * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def split_paired_files(
+    samples: list[Sample],
+    index_table: np.ndarray,
+    fq_path_r1: Path,
+    fq_path_r2: Path,
+    split_dir: Path,
+    processes: int = 1,
+    compression: Compression = "none",
+) -> tuple[dict[int, Path], dict[int, Path], SplitManifest]:
+    """
+    Splits paired R1/R2 FASTQ files by sample in a single pass. Each read pair is assigned to a sample once, using the
+    index sequences of the R1 read, and both mates are written to the sample's R1/R2 files.
+
+    The files are read in large, record-aligned blocks of raw bytes, which are classified by a pool of worker processes
+    if processes > 1. Per-sample output is written in input order, so the output is byte-identical regardless of the
+    number of processes used.
+    :param samples: list of samples from the sample sheet.
+    :param index_table: index pair lookup table, from build_index_table.
+    :param fq_path_r1: path to the multiplexed R1 FASTQ.
+    :param fq_path_r2: path to the multiplexed R2 FASTQ.
+    :param split_dir: directory to write per-sample FASTQs to.
+    :param processes: number of worker processes to classify reads with (and threads to compress output with.)
+    :param compression: compression for the per-sample FASTQs; "bgzf" output is compressed in background threads.
+    :return: tuple of (sample R1 FASTQ dictionary, sample R2 FASTQ dictionary, demultiplexing statistics manifest)
+    """
+
+    sample_files_r1: dict[int, Path] = {}
+    sample_files_r2: dict[int, Path] = {}
+    sample_file_handles: dict[int, tuple[BinaryIO | BgzfWriter, BinaryIO | BgzfWriter]] = {}
+    sample_stats: dict[int, SplitStats] = {}
+
+    n_unassigned = 0
+
+    writer_pool = BgzfWriterPool(processes) if compression == "bgzf" else None
+    ext = ".fastq.gz" if writer_pool else ".fastq"
+
+    logger.info(f"Splitting read pairs from {fq_path_r1} and {fq_path_r2} ({processes=}, {compression=})")
+    start = time.perf_counter()
     try:
-        with pysam.FastxFile(str(fq_path)) as fq:
-            for read in fq:
-                read_index = read.comment.split(":")[-1]
-                if not READ_INDEX_PATTERN.match(read_index):
-                    logger.debug(
-                        f"Could not find read index sequences in read {read.name} {read.comment}; skipping read"
-                    )
-                    continue
-
-                if read_index not in index_seqs_lookup:
-                    logger.debug(f"Could not find read index {read_index} in lookup table; skipping read")
-                    continue
-
-                si = index_seqs_lookup[read_index]
-                s = samples[si]
-
-                if si not in sample_files:
-                    new_sample_file = split_dir / f"GTSeq_{s.full_name()}_{suffix}.fastq"
-                    sample_files[si] = new_sample_file
-                    sample_file_handles[si] = open(new_sample_file, mode="w")
-
-                fh = sample_file_handles[si]
-                fh.write(str(read) + "\n")
+        # Decompress/read blocks in a background thread while earlier blocks are classified and written; the reader is
+        # stopped before the files are closed, even if splitting fails part-way.
+        with (
+            open_fastq(fq_path_r1) as fq1,
+            open_fastq(fq_path_r2) as fq2,
+            closing(prefetch(read_paired_blocks(fq1, fq2, SPLIT_BLOCK_SIZE), max_ahead=2)) as chunk_pairs,
+        ):
+            if processes > 1:
+                chunk_results = _iter_split_chunks(index_table, chunk_pairs, processes)
+            else:
+                _init_chunk_worker(index_table)
+                chunk_results = map(_split_chunk, chunk_pairs)
+
+            for chunk_records, chunk_n_unassigned in chunk_results:
+                n_unassigned += chunk_n_unassigned
+
+                for si, (records_r1, records_r2, *chunk_stats) in chunk_records.items():
+                    if si not in sample_file_handles:
+                        sample_name = samples[si].full_name()
+                        sample_files_r1[si] = split_dir / f"GTSeq_{sample_name}_R1{ext}"
+                        sample_files_r2[si] = split_dir / f"GTSeq_{sample_name}_R2{ext}"
+                        sample_stats[si] = SplitStats()
+                        sample_file_handles[si] = (
+                            writer_pool.open(sample_files_r1[si]) if writer_pool else open(sample_files_r1[si], "wb"),
+                            writer_pool.open(sample_files_r2[si]) if writer_pool else open(sample_files_r2[si], "wb"),
+                        )
+
+                    fh1, fh2 = sample_file_handles[si]
+                    fh1.write(records_r1)
+                    fh2.write(records_r2)
+                    sample_stats[si].add(*chunk_stats)
     finally:
-        for v in sample_file_handles.values():
-            v.close()
+        for fh1, fh2 in sample_file_handles.values():
+            fh1.close()
+            fh2.close()
+        if writer_pool:
+            writer_pool.shutdown()
 
-    return sample_files
+    logger.info(f"Could not assign %d read pairs to a sample", n_unassigned)
+
+    n_read_pairs = n_unassigned + sum(stats.read_pairs for stats in sample_stats.values())
+    elapsed = time.perf_counter() - start
+    logger.info("Split %d read pairs in %.1fs", n_read_pairs, elapsed)
+    record_throughput("read_pairs_per_second", n_read_pairs / elapsed if elapsed else 0.0)
+
+    manifest = SplitManifest(samples=sample_stats, unassigned_read_pairs=n_unassigned)
+    with open(split_dir / "manifest.json", "w") as fh:
+        fh.write(manifest.model_dump_json(indent=2))
+
+    return sample_files_r1, sample_files_r2, manifest
 
 
 def fastq_split(
-    samples: list[Sample], fastq_dir: Path, r1_r2: tuple[Path, Path] | None
-) -> tuple[dict[int, Path], dict[int, Path]]:
+    samples: list[Sample],
+    fastq_dir: Path,
+    r1_r2: tuple[Path, Path] | None,
+    processes: int = 1,
+    index_mismatches: int = 1,
+    compression: Compression = "none",
+) -> tuple[dict[int, Path], dict[int, Path], SplitManifest]:
     if r1_r2 is None:
         fq_path_r1 = next(fastq_dir.glob("Undetermined_*_R1_*.fastq.gz"), None)
         assert fq_path_r1 is not None
@@ -65,15 +248,18 @@ def fastq_split(
     split_dir = fastq_dir / "split"
     split_dir.mkdir(exist_ok=True)
 
-    index_seqs_lookup: dict[str, int] = {
-        f"{get_i7_barcode(s.i7)}+{get_i5_barcode(s.i5)}": i for i, s in enumerate(samples)
+    index_pairs: dict[tuple[str, str], int] = {
+        (get_i7_barcode(s.i7), get_i5_barcode(s.i5)): i for i, s in enumerate(samples)
     }
 
-    logger.info(f"Using index lookup table for %d samples:", len(samples))
-    for s, idx in index_seqs_lookup.items():
-        logger.info(f"%s: %d --> %s", s.rjust(30), idx, samples[idx])
+    logger.info(f"Using index lookup table for %d samples (allowing %d mismatches):", len(samples), index_mismatches)
+    for (i7, i5), idx in index_pairs.items():
+        logger.info(f"%s: %d --> %s", f"{i7}+{i5}".rjust(30), idx, samples[idx])
+
+    if len(index_pairs) != len(samples):
+        logger.warning("%d samples share an index pair with another sample", len(samples) - len(index_pairs))
 
-    sample_files_r1 = split_file(samples, index_seqs_lookup, fq_path_r1, split_dir, "R1")
-    sample_files_r2 = split_file(samples, index_seqs_lookup, fq_path_r2, split_dir, "R2")
+    index_table = build_index_table(index_pairs, index_mismatches)
 
-    return sample_files_r1, sample_files_r2
+    # Split R1 and R2 together, so that we only make one pass through the multiplexed reads
+    return split_paired_files(samples, index_table, fq_path_r1, fq_path_r2, split_dir, processes, compression)
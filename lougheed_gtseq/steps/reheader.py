@@ -1,9 +1,8 @@
-import subprocess
-
 from logging import Logger
 from pathlib import Path
 from pysam import VariantFile
 
+from ..metrics import MeasuredPopen
 from ..models import Sample
 from .load_samples import load_samples
 
@@ -39,7 +38,7 @@ def reheader_vcf(samples: list[Sample], vcf: Path, logger: Logger):
     try:
         vcf_new = Path(str(vcf) + ".new")
         with open(vcf_new, "w") as fh:
-            p = subprocess.Popen(("bcftools", "reheader", "--samples", str(vcf_path_reheader), vcf_str), stdout=fh)
+            p = MeasuredPopen(("bcftools", "reheader", "--samples", str(vcf_path_reheader), vcf_str), stdout=fh)
             p.wait()
         vcf.rename(Path(vcf_str + ".pre-reheader"))
         vcf_new.rename(vcf)
@@ -1,5 +1,60 @@
-__all__ = ["ascii_normalize"]
+import queue
+import threading
+from typing import Iterable, Iterator, TypeVar
+
+__all__ = ["ascii_normalize", "prefetch"]
+
+T = TypeVar("T")
 
 
 def ascii_normalize(s: str) -> str:
     return s.encode("ascii", "ignore").decode("utf-8")
+
+
+_PREFETCH_DONE = object()
+_PREFETCH_PUT_TIMEOUT = 0.1  # seconds
+
+
+def prefetch(iterable: Iterable[T], max_ahead: int) -> Iterator[T]:
+    """
+    Iterates over an iterable in a background thread, staying up to max_ahead items ahead of the consumer. Useful for
+    overlapping I/O and decompression (which release the GIL) with processing of the items. If the consumer stops
+    early, closing the returned generator (e.g., with contextlib.closing) stops the background thread and waits for it.
+    """
+
+    q: queue.Queue = queue.Queue(maxsize=max_ahead)
+    stop = threading.Event()
+
+    def _put(entry) -> bool:
+        # Bounded waits, so that a producer blocked on a full queue notices when the consumer has gone away
+        while not stop.is_set():
+            try:
+                q.put(entry, timeout=_PREFETCH_PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce():
+        try:
+            for item in iterable:
+                if not _put((item, None)):
+                    return
+            _put((_PREFETCH_DONE, None))
+        except BaseException as e:
+            _put((_PREFETCH_DONE, e))
+
+    producer = threading.Thread(target=_produce, daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            item, exc = q.get()
+            if item is _PREFETCH_DONE:
+                if exc is not None:
+                    raise exc
+                return
+            yield item
+    finally:
+        stop.set()
+        producer.join()
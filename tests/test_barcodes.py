@@ -1,3 +1,4 @@
+import numpy as np
 import pytest
 
 from lougheed_gtseq.barcodes import (
@@ -7,6 +8,11 @@ from lougheed_gtseq.barcodes import (
     I5_BARCODES,
     normalize_i5_coordinate,
     get_i5_barcode,
+    INDEX_NO_MATCH,
+    INDEX_AMBIGUOUS,
+    encode_index_pair,
+    build_index_table,
+    lookup_index_fields,
 )
 
 
@@ -36,3 +42,47 @@ def test_extract_i5():
     assert get_i5_barcode("10A") == I5_BARCODES["A10"]
     assert get_i5_barcode("11A") == I5_BARCODES["A11"]
     assert get_i5_barcode("10F") == I5_BARCODES["F10"]
+
+
+def test_encode_index_pair():
+    assert encode_index_pair("AAAAAA", "AAAAAA") == 0
+    assert encode_index_pair("AAAAAA", "AAAAAT") == 3
+    assert encode_index_pair("CAAAAA", "AAAAAA") == 1 << 22
+    with pytest.raises(ValueError):
+        encode_index_pair("AAAAAN", "AAAAAA")
+
+
+def test_index_table():
+    # CTTGTA / CTTGTT are one mismatch apart, so their neighbours in common are ambiguous
+    pairs = {("ATCACG", "AAACGG"): 0, ("CTTGTA", "AAACGG"): 1, ("CTTGTT", "AAACGG"): 2}
+
+    exact = build_index_table(pairs, max_mismatches=0)
+    assert exact[encode_index_pair("ATCACG", "AAACGG")] == 0
+    assert exact[encode_index_pair("ATCACG", "AAACGA")] == INDEX_NO_MATCH
+
+    table = build_index_table(pairs)
+    assert table[encode_index_pair("ATCACG", "AAACGA")] == 0
+    assert table[encode_index_pair("TTCACG", "AAACGG")] == 0
+    assert table[encode_index_pair("ATCACG", "AAACTA")] == INDEX_NO_MATCH  # two mismatches
+    assert table[encode_index_pair("CTTGTA", "AAACGG")] == 1  # exact matches take precedence
+    assert table[encode_index_pair("CTTGTT", "AAACGG")] == 2
+    assert table[encode_index_pair("CTTGTC", "AAACGG")] == INDEX_AMBIGUOUS
+
+
+def test_lookup_index_fields():
+    table = build_index_table({("ATCACG", "AAACGG"): 0, ("CGATGT", "AAACGG"): 1})
+    headers = [
+        b"@r1 1:N:0:ATCACG+AAACGG\n",
+        b"@r2 1:N:0:CGATGA+AAACGG\n",
+        b"@r3 1:N:0:ATCACG+AAACNG\n",
+        b"@r4 1:N:0:ATCACGAAAACGG\n",
+        b"@r5\n",
+        b"@r6 1:N:0:ATCACG+AAANNG\n",
+        b"@r7 1:N:0:ATCACT+AAACNG\n",
+    ]
+    buf = np.frombuffer(b"".join(headers), dtype=np.uint8)
+    field_ends = np.cumsum([len(h) for h in headers]) - 1
+    assert lookup_index_fields(table, buf, field_ends).tolist() == [0, 1, 0, *[INDEX_NO_MATCH] * 4]
+
+    exact = build_index_table({("ATCACG", "AAACGG"): 0}, max_mismatches=0)
+    assert lookup_index_fields(exact, buf, field_ends).tolist()[:3] == [0, INDEX_NO_MATCH, INDEX_NO_MATCH]
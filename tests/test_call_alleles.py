@@ -0,0 +1,108 @@
+import pysam
+import pytest
+import shutil
+
+from lougheed_gtseq.steps.call_alleles import _cached_pileup_and_call, _pileup_and_call, _sharded_pileup_and_call
+
+REF_SEQS = {"c1": "ACGTTGCA" * 40, "c2": "TTGACCAG" * 40}
+
+# Panel sites (1-based) with REF/ALT alleles, and each sample's number of ALT reads (out of 10) at every site; None for
+# no reads at all
+PANEL = [("c1", 101, "T", "C"), ("c1", 205, "T", "G"), ("c2", 60, "A", "G"), ("c2", 150, "C", "T")]
+SAMPLE_ALT_READS = {
+    "A": [10, 5, 0, 5],
+    "B": [0, 5, 10, 0],
+    "C": [5, None, 5, 10],
+    "D": [None, None, None, None],
+}
+
+
+def _write_fixture(tmp_path):
+    ref = tmp_path / "ref.fa"
+    ref.write_text("".join(f">{c}\n{seq}\n" for c, seq in REF_SEQS.items()))
+    pysam.faidx(str(ref))
+
+    allele_file = tmp_path / "panel.tsv"
+    allele_file.write_text("".join(f"{c}\t{pos}\t{ref_a},{alt}\n" for c, pos, ref_a, alt in PANEL))
+
+    bams = []
+    for sample, alt_reads in SAMPLE_ALT_READS.items():
+        header = {
+            "HD": {"VN": "1.6", "SO": "coordinate"},
+            "SQ": [{"SN": c, "LN": len(seq)} for c, seq in REF_SEQS.items()],
+            "RG": [{"ID": sample, "SM": sample}],
+        }
+        bam = tmp_path / f"{sample}.bam"
+        with pysam.AlignmentFile(str(bam), "wb", header=header) as bf:
+            for si, ((contig, pos, _, alt), n_alt) in enumerate(zip(PANEL, alt_reads)):
+                if n_alt is None:
+                    continue
+                start = pos - 21
+                for i in range(10):
+                    seq = list(REF_SEQS[contig][start : start + 40])
+                    if i < n_alt:
+                        seq[20] = alt
+                    read = pysam.AlignedSegment(bf.header)
+                    read.query_name = f"{sample}_{si}_{i}"
+                    read.reference_id = bf.get_tid(contig)
+                    read.reference_start = start
+                    read.cigarstring = "40M"
+                    read.mapping_quality = 60
+                    read.query_sequence = "".join(seq)
+                    read.query_qualities = pysam.qualitystring_to_array("I" * 40)
+                    read.set_tag("RG", sample)
+                    bf.write(read)
+        pysam.index(str(bam))
+        bams.append(bam)
+
+    return ref, allele_file, bams
+
+
+def _calls(vcf, fields: tuple[str, ...] = ("GT",)) -> list[tuple]:
+    with pysam.VariantFile(str(vcf)) as vf:
+        return [
+            (r.contig, r.pos, r.alleles, tuple(tuple(s[f] for f in fields) for s in r.samples.values())) for r in vf
+        ]
+
+
+@pytest.mark.skipif(shutil.which("bcftools") is None, reason="requires bcftools")
+def test_sharded_pileup_and_call(tmp_path):
+    ref, allele_file, bams = _write_fixture(tmp_path)
+    bam_list = tmp_path / "bams.txt"
+    bam_list.write_text("".join(f"{b}\n" for b in bams))
+
+    _pileup_and_call(ref, bam_list, allele_file, tmp_path / "joint.vcf", indexed_regions=False)
+    calls = _calls(tmp_path / "joint.vcf")
+    assert [(c, pos) for c, pos, *_ in calls] == [(c, pos) for c, pos, *_ in PANEL]
+    assert calls[0][3] == (((1, 1),), ((0, 0),), ((0, 1),), ((None, None),))
+
+    # Shards split the panel across contigs too; output must be identical, in panel order
+    _sharded_pileup_and_call(ref, bam_list, allele_file, tmp_path, tmp_path / "sharded.vcf", n_shards=3, processes=2)
+    assert _calls(tmp_path / "sharded.vcf") == calls
+    assert not list(tmp_path.glob("shard_*.bcf"))
+
+
+@pytest.mark.skipif(shutil.which("bcftools") is None, reason="requires bcftools")
+def test_cached_pileup_and_call(tmp_path, monkeypatch):
+    ref, allele_file, bams = _write_fixture(tmp_path)
+    bam_list = tmp_path / "bams.txt"
+    bam_list.write_text("".join(f"{b}\n" for b in bams))
+    fields = ("GT", "PL", "DP", "AD", "GQ")
+
+    _pileup_and_call(ref, bam_list, allele_file, tmp_path / "joint.vcf", indexed_regions=False)
+    joint = _calls(tmp_path / "joint.vcf", fields)
+    # Sample D has no reads anywhere, and sample C none at the second site
+    assert joint[1][3][2] == joint[1][3][3] == ((None, None), (0, 0, 0), 0, (0, 0), 0)
+
+    # Merged per-sample pileups call the same genotypes, with the same per-sample values, as a joint mpileup
+    cache_dir = tmp_path / "cache"
+    _cached_pileup_and_call(ref, bams, allele_file, tmp_path, cache_dir, tmp_path / "cached.vcf", processes=2)
+    assert _calls(tmp_path / "cached.vcf", fields) == joint
+
+    # Re-runs find BAM digests by file fingerprint, without decompressing the BAMs again
+    def _fail(bam):
+        raise AssertionError(f"{bam} checksummed again")
+
+    monkeypatch.setattr("lougheed_gtseq.pileup_cache.bam_content_digest", _fail)
+    _cached_pileup_and_call(ref, bams, allele_file, tmp_path, cache_dir, tmp_path / "rerun.vcf", processes=2)
+    assert _calls(tmp_path / "rerun.vcf", fields) == joint
@@ -0,0 +1,181 @@
+import os
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from lougheed_gtseq.models import Sample, SexCallingParams
+from lougheed_gtseq.sex_genotyper import (
+    SexMarkerMatcher,
+    compile_genos,
+    count_sex_marker_reads,
+    format_genos,
+    load_sex_markers,
+)
+from lougheed_gtseq.steps.call_sex_markers import GENO_COMPILE, GENOTYPER, call_sex_markers
+
+# Directory with the Campbell et al. GTseq-Pipeline scripts, to compare the native genotyper against; they are not
+# bundled with this package (see --gtseq-scripts)
+GTSEQ_SCRIPTS = os.environ.get("GTSEQ_SCRIPTS")
+
+# Markers for the genotyping edge case fixture: AM941047.1_3 without correction factors, AM941047.1_2 with them
+EDGE_CASE_MARKERS = (
+    "M1,G,A,TCACCCGTCAGAG,TCACCCATCAGAG,TGTGTGGAGTGCGGTAAAGG,0,0\n"
+    "M2,G,A,TGCTGGGGCTCTG,TGCTGGAGCTCTG,CGAATGCGATGAGTGTGGGA,0.05,0.1\n"
+)
+_M1_A1 = "TGTGTGGAGTGCGGTAAAGGACGTCTCTGACGGGTGATT"  # probes are matched in either orientation
+_M1_A2 = "TGTGTGGAGTGCGGTAAAGGACGTCTCTGATGGGTGATT"
+_M2_A1 = "CGAATGCGATGAGTGTGGGAAATGCTGGGGCTCTGAA"
+_M2_A2 = "CGAATGCGATGAGTGTGGGAAATGCTGGAGCTCTGAA"
+_M2_NO_PROBE = "CGAATGCGATGAGTGTGGGAAACCCCCCCCCCCCCAA"
+_OFF_TARGET = "ACGTACGTACGTACGTACGT"
+
+# Sample -> reads, covering: no A2 reads (ratio with a zero denominator), ratios between the HOM and HET thresholds
+# (0.1-0.2, 5-10), too few reads to call, and correction factors
+EDGE_CASE_READS = {
+    "hom": [_M1_A1] * 12 + [_M2_A2] * 15 + [_OFF_TARGET] * 3,
+    "gap_low": [_M1_A1] * 3 + [_M1_A2] * 20 + [_M2_A1] * 8 + [_M2_A2] * 8,
+    "gap_high": [_M1_A1] * 14 + [_M1_A2] * 2 + [_M2_A1] * 30 + [_M2_A2] * 8 + [_M2_NO_PROBE],
+    "few": [_M1_A1] * 4 + [_M1_A2] * 3 + [_M2_NO_PROBE] * 8,
+}
+
+
+def _edge_case_fixture(tmp_path: Path) -> tuple[Path, dict[str, Path]]:
+    marker_file = tmp_path / "markers.csv"
+    marker_file.write_text(EDGE_CASE_MARKERS)
+    fastqs = {}
+    for sample, reads in EDGE_CASE_READS.items():
+        fastqs[sample] = tmp_path / f"{sample}.fastq"
+        fastqs[sample].write_text("".join(f"@r{i}\n{r}\n+\n{'I' * len(r)}\n" for i, r in enumerate(reads)))
+    return marker_file, fastqs
+
+
+def _native_genos(marker_file: Path, fastq: Path) -> str:
+    markers = load_sex_markers(marker_file)
+    return format_genos(str(fastq), markers, count_sex_marker_reads(fastq, SexMarkerMatcher(markers)))
+
+
+class _Params(SexCallingParams):
+    species: str
+
+
+@pytest.mark.skipif(shutil.which("perl") is None, reason="requires perl")
+def test_call_sex_markers(tmp_path):
+    # Stand-ins for the Campbell et al. scripts: the genotyper echoes its FASTQ (and logs it, to count calls), while
+    # GenoCompile lists the .genos files
+    calls_log = tmp_path / "calls.log"
+    scripts = tmp_path / "scripts"
+    scripts.mkdir()
+    (scripts / GENOTYPER).write_text(
+        f'open(my $log, ">>", "{calls_log}"); print $log "$ARGV[1]\\n"; print "$ARGV[1]\\n";\n'
+    )
+    (scripts / GENO_COMPILE).write_text('print "$_\\n" for sort glob("*.genos");\n')
+
+    samples = [Sample(sample_id=s, batch="TEST", plate=1, i7=i + 1, i5="A01") for i, s in enumerate("ABC")]
+    fastqs = {}
+    for si, sample in enumerate(samples):
+        fastqs[si] = tmp_path / f"{sample.sample_id}.fastq"
+        fastqs[si].write_text("@r1\nACGT\n+\nIIII\n")
+
+    params = _Params(
+        call_sex=True, sex_genotyper="perl", gtseq_scripts=scripts, sex_calls=tmp_path / "sex.csv", species="polar"
+    )
+    work_dir = tmp_path / "work"
+    genos_dir = work_dir / "sex_linked" / "genos"
+
+    call_sex_markers(params, work_dir, samples, fastqs, processes=2)
+
+    assert (genos_dir / f"{samples[1].full_name()}.genos").read_text() == f"{fastqs[1]}\n"
+    assert params.sex_calls.read_text().splitlines() == [f"{s.full_name()}.genos" for s in samples]
+    assert not list((work_dir / "sex_linked" / "tmp").iterdir())
+    assert len(calls_log.read_text().splitlines()) == 3
+
+    # Journaled samples are not called again, unless their FASTQ changed or their .genos file went missing
+    call_sex_markers(params, work_dir, samples, fastqs, processes=2)
+    assert len(calls_log.read_text().splitlines()) == 3
+
+    fastqs[1].write_text("@r1\nACGTA\n+\nIIIII\n")
+    (genos_dir / f"{samples[2].full_name()}.genos").unlink()
+    calls_log.unlink()
+    call_sex_markers(params, work_dir, samples, fastqs, processes=2)
+    assert sorted(calls_log.read_text().splitlines()) == [str(fastqs[1]), str(fastqs[2])]
+
+
+def test_call_sex_markers_native(tmp_path):
+    # Reads for the two polar bear markers: AM941047.1_3 is homozygous for allele 1 (probe in either orientation);
+    # AM941047.1_2 is heterozygous. Off-target reads only count towards raw reads.
+    reads = (
+        ["TGTGTGGAGTGCGGTAAAGGACGTTCACCCGTCAGAGTT"] * 8
+        + ["TGTGTGGAGTGCGGTAAAGGACGTCTCTGACGGGTGATT"] * 4
+        + ["CGAATGCGATGAGTGTGGGAAATGCTGGGGCTCTGAA"] * 6
+        + ["CGAATGCGATGAGTGTGGGAAATGCTGGAGCTCTGAA"] * 6
+        + ["CGAATGCGATGAGTGTGGGAAACCCCCCCCCCCCCAA"]
+        + ["ACGTACGTACGTACGTACGT"] * 5
+    )
+
+    samples = [Sample(sample_id="A", batch="TEST", plate=1, i7=1, i5="A01")]
+    fastq = tmp_path / "A.fastq"
+    fastq.write_text("".join(f"@r{i}\n{r}\n+\n{'I' * len(r)}\n" for i, r in enumerate(reads)))
+
+    params = _Params(
+        call_sex=True,
+        sex_genotyper="native",
+        gtseq_scripts=tmp_path / "missing",
+        sex_calls=tmp_path / "sex.csv",
+        species="polar",
+    )
+    call_sex_markers(params, tmp_path / "work", samples, {0: fastq}, processes=1)
+
+    genos = (tmp_path / "work" / "sex_linked" / "genos" / f"{samples[0].full_name()}.genos").read_text()
+    assert genos.splitlines() == [
+        f"{fastq},Raw-Reads:30,On-Target reads:24,%On-Target:80.0,IFI_score:0.00",
+        "AM941047.1_3,G=12,A=0,12.000,GG,A1HOM,0,0,12,40.000,100.0",
+        "AM941047.1_2,G=6,A=6,1.000,GA,HET,0,0,13,43.333,92.3",
+    ]
+    assert params.sex_calls.read_text().splitlines() == [
+        "Sample,Raw Reads,On-Target Reads,%On-Target,%GT,IFI,AM941047.1_3,AM941047.1_2",
+        f"{samples[0].full_name()},30,24,80.0,100.00,0.00,GG,GA",
+    ]
+
+
+def test_sex_genotyper_edge_cases(tmp_path):
+    marker_file, fastqs = _edge_case_fixture(tmp_path)
+    calls = {
+        sample: [line.split(",")[4:6] for line in _native_genos(marker_file, fastq).splitlines()[1:]]
+        for sample, fastq in fastqs.items()
+    }
+    assert calls == {
+        "hom": [["GG", "A1HOM"], ["AA", "A2HOM"]],
+        "gap_low": [["00", "NA"], ["GA", "HET"]],
+        "gap_high": [["00", "NA"], ["00", "NA"]],
+        "few": [["00", "NA"], ["00", "NA"]],
+    }
+
+
+@pytest.mark.skipif(
+    not GTSEQ_SCRIPTS or shutil.which("perl") is None,
+    reason="set GTSEQ_SCRIPTS to a GTseq-Pipeline checkout (and install perl) to compare against the Perl scripts",
+)
+def test_sex_genotyper_matches_perl(tmp_path):
+    # Golden test: the native genotyper's .genos files and compiled CSV must be identical to the Perl scripts'
+    scripts = Path(GTSEQ_SCRIPTS)
+    marker_file, fastqs = _edge_case_fixture(tmp_path)
+    genos_dir = tmp_path / "genos"
+    genos_dir.mkdir()
+
+    for sample, fastq in fastqs.items():
+        perl_genos = subprocess.run(
+            ("perl", str(scripts / GENOTYPER), str(marker_file), str(fastq)),
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        assert _native_genos(marker_file, fastq) == perl_genos, sample
+        (genos_dir / f"{sample}.genos").write_text(perl_genos)
+
+    perl_compiled = subprocess.run(
+        ("perl", str(scripts / GENO_COMPILE), "S", "0"), check=True, capture_output=True, text=True, cwd=genos_dir
+    ).stdout
+    compile_genos(list(genos_dir.glob("*.genos")), tmp_path / "native.csv")
+    assert (tmp_path / "native.csv").read_text() == perl_compiled
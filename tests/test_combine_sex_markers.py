@@ -0,0 +1,27 @@
+import io
+
+from lougheed_gtseq import combine_sex_markers as csm
+
+
+def test_combine_sex_markers(tmp_path, monkeypatch):
+    # Force several runs per file and more than one merge pass
+    monkeypatch.setattr(csm, "COMBINE_SEX_MARKERS_RUN_ROWS", 2)
+    monkeypatch.setattr(csm, "COMBINE_SEX_MARKERS_MAX_OPEN_RUNS", 2)
+
+    a = tmp_path / "a.csv"
+    a.write_text("Sample,Sex,Reads\nS3,M,10\nS1,F,20\nS5,F,5\nS2,M,7\n")
+    b = tmp_path / "b.csv"
+    b.write_text("Sample,Sex,Ratio\nS4,F,0.1\nS1,M,0.9,extra\n")
+
+    out = io.StringIO()
+    csm.combine_sex_markers([a, b], out)
+
+    assert out.getvalue().splitlines() == [
+        "Sample,Sex,Reads,Ratio",
+        "S1,F,20,",
+        "S1,M,,0.9",
+        "S2,M,7,",
+        "S3,M,10,",
+        "S4,F,,0.1",
+        "S5,F,5,",
+    ]
@@ -0,0 +1,77 @@
+import io
+import numpy as np
+import pytest
+
+from lougheed_gtseq.fastq import FastqBlockReader, read_paired_blocks, scan_records, gather_ranges, interleave_records
+
+
+def _records(n: int, seq: str = "ACGTACGTAC") -> bytes:
+    return b"".join(f"@read{i} 1:N:0:ATCACG+AAACGG\n{seq}\n+\n{'F' * len(seq)}\n".encode() for i in range(n))
+
+
+def test_block_reader_record_aligned():
+    data = _records(50)
+    reader = FastqBlockReader(io.BytesIO(data), block_size=100)
+    blocks = list(iter(reader.read_block, b""))
+    assert len(blocks) > 1
+    assert b"".join(blocks) == data
+    assert all(b.startswith(b"@read") and b.count(b"\n") % 4 == 0 for b in blocks)
+
+
+def test_block_reader_missing_final_newline():
+    data = _records(3)
+    reader = FastqBlockReader(io.BytesIO(data[:-1]), block_size=1000)
+    assert reader.read_block() == data
+
+
+def test_block_reader_long_record():
+    data = _records(2) + _records(1, seq="A" * 500) + _records(2)
+    reader = FastqBlockReader(io.BytesIO(data), block_size=64)
+    blocks = list(iter(reader.read_block, b""))
+    assert b"".join(blocks) == data
+
+
+def test_block_reader_truncated_record():
+    data = _records(3)
+    reader = FastqBlockReader(io.BytesIO(data + b"\n\n"), block_size=1000)  # trailing blank lines are fine
+    assert reader.read_block() == data
+
+    reader = FastqBlockReader(io.BytesIO(data + b"@read3 1:N:0:ATCACG+AAACGG\nACGT\n"), block_size=1000)
+    with pytest.raises(ValueError):
+        reader.read_block()
+
+    reader = FastqBlockReader(io.BytesIO(data[:-20]), block_size=1000)
+    assert reader.read_records(2) == _records(2)
+    with pytest.raises(ValueError):
+        reader.read_records(2)
+
+
+def test_paired_blocks_same_record_counts():
+    r1 = _records(40)
+    r2 = _records(40, seq="ACGTACGTACGTACGTACGTACGT")
+    pairs = list(read_paired_blocks(io.BytesIO(r1), io.BytesIO(r2), block_size=128))
+    assert all(b1.count(b"\n") == b2.count(b"\n") for b1, b2 in pairs)
+    assert b"".join(b2 for _, b2 in pairs) == r2
+
+    pairs = list(read_paired_blocks(io.BytesIO(r1), io.BytesIO(_records(41)), block_size=128))
+    assert pairs[-1][0] == b""
+
+
+def test_scan_records():
+    data = _records(3) + b"@x\r\nAC\r\n+x\r\nFF\r\n"
+    buf = np.frombuffer(data, dtype=np.uint8)
+    records = scan_records(buf)
+    assert len(records) == 4
+    assert data[records.starts[1] : records.ends[1]] == b"@read1 1:N:0:ATCACG+AAACGG\nACGTACGTAC\n+\nFFFFFFFFFF\n"
+    assert data[records.starts[3] : records.header_ends[3]] == b"@x"
+    assert data[records.seq_starts[3] : records.seq_ends[3]] == b"AC"
+    assert data[records.qual_starts[3] : records.qual_ends[3]] == b"FF"
+    assert gather_ranges(data, records.seq_starts, records.seq_ends) == b"ACGTACGTAC" * 3 + b"AC"
+
+
+def test_interleave_records():
+    r1 = b"@a/1 1:N:0:ATCACG+AAACGG\nACGT\n+\nFFFF\n@b\nAA\n+\nFF\n"
+    r2 = b"@a/2 2:N:0:ATCACG+AAACGG\nTTTT\n+\nFFFF\n@b\tx\nCC\n+\nFF\n"
+    assert interleave_records(r1, r2, b"RG:Z:s1") == (
+        b"@a/1 RG:Z:s1\nACGT\n+\nFFFF\n@a/2 RG:Z:s1\nTTTT\n+\nFFFF\n@b RG:Z:s1\nAA\n+\nFF\n@b RG:Z:s1\nCC\n+\nFF\n"
+    )
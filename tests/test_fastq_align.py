@@ -0,0 +1,8 @@
+from lougheed_gtseq.steps.fastq_align import _pipeline_threads
+
+
+def test_pipeline_threads():
+    # bwa gets the grant minus the other streaming stages, then samtools sort's workers take over once bwa is done
+    assert _pipeline_threads(8, 1) == (7, 7)
+    assert _pipeline_threads(8, 3) == (5, 7)
+    assert _pipeline_threads(1, 2) == (1, 0)
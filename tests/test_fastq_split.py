@@ -0,0 +1,144 @@
+import pysam
+import pytest
+import threading
+
+from lougheed_gtseq.barcodes import get_i7_barcode, get_i5_barcode
+from lougheed_gtseq.logger import logger
+from lougheed_gtseq.models import Sample
+from lougheed_gtseq.scheduling import CpuBudget, Step, run_steps
+from lougheed_gtseq.steps.fastq_split import fastq_split
+
+SAMPLES = [
+    Sample(sample_id="A", batch="TEST", plate=1, i7=1, i5="A01"),
+    Sample(sample_id="B", batch="TEST", plate=1, i7=2, i5="B03"),
+]
+
+
+def _index(s: Sample) -> str:
+    return f"{get_i7_barcode(s.i7)}+{get_i5_barcode(s.i5)}"
+
+
+def _record(name: str, mate: int, index: str, seq: str) -> str:
+    return f"@{name} {mate}:N:0:{index}\n{seq}\n+\n{'I' * len(seq)}\n"
+
+
+def _write_pair(tmp_path, reads: list[tuple[str, str]], r2_names: list[str] | None = None):
+    r1 = tmp_path / "r1.fastq"
+    r2 = tmp_path / "r2.fastq"
+    r2_names = r2_names or [n for n, _ in reads]
+    r1.write_text("".join(_record(n, 1, idx, "ACGTACGT") for n, idx in reads))
+    r2.write_text("".join(_record(n2, 2, idx, "TTGGCCAA") for n2, (_, idx) in zip(r2_names, reads)))
+    return r1, r2
+
+
+def test_fastq_split_paired(tmp_path):
+    reads = [
+        ("read1", _index(SAMPLES[0])),
+        ("read2", _index(SAMPLES[1])),
+        ("read3", "NNNNNN+NNNNNN"),
+        ("read4", _index(SAMPLES[0])),
+    ]
+    r1, r2 = _write_pair(tmp_path, reads)
+
+    files_r1, files_r2, manifest = fastq_split(SAMPLES, tmp_path, (r1, r2))
+
+    assert set(files_r1.keys()) == set(files_r2.keys()) == {0, 1}
+    assert manifest.unassigned_read_pairs == 1
+    assert manifest.read_pairs(0) == 2
+    assert manifest.samples[0].bases == 2 * 16
+    assert manifest.samples[0].mean_quality == ord("I") - 33
+    assert (tmp_path / "split" / "manifest.json").exists()
+    assert files_r1[0].read_text() == _record("read1", 1, reads[0][1], "ACGTACGT") + _record(
+        "read4", 1, reads[3][1], "ACGTACGT"
+    )
+    assert files_r2[0].read_text() == _record("read1", 2, reads[0][1], "TTGGCCAA") + _record(
+        "read4", 2, reads[3][1], "TTGGCCAA"
+    )
+    assert files_r2[1].read_text() == _record("read2", 2, reads[1][1], "TTGGCCAA")
+
+
+def test_fastq_split_out_of_sync(tmp_path):
+    reads = [("read1", _index(SAMPLES[0])), ("read2", _index(SAMPLES[1]))]
+    r1, r2 = _write_pair(tmp_path, reads, r2_names=["read1", "read3"])
+
+    with pytest.raises(ValueError):
+        fastq_split(SAMPLES, tmp_path, (r1, r2))
+
+
+def test_fastq_split_parallel_deterministic(tmp_path, monkeypatch):
+    monkeypatch.setattr("lougheed_gtseq.steps.fastq_split.SPLIT_BLOCK_SIZE", 300)
+
+    indices = [_index(SAMPLES[0]), _index(SAMPLES[1]), "ACGTAC+ACGTAC"]
+    reads = [(f"read{i}", indices[i % 5 % 3]) for i in range(100)]
+    r1, r2 = _write_pair(tmp_path, reads)
+
+    outputs = []
+    for processes in (1, 3):
+        fastq_dir = tmp_path / f"p{processes}"
+        fastq_dir.mkdir()
+        files_r1, files_r2, _ = fastq_split(SAMPLES, fastq_dir, (r1, r2), processes=processes)
+        outputs.append({si: (files_r1[si].read_bytes(), files_r2[si].read_bytes()) for si in files_r1})
+
+    assert outputs[0] == outputs[1]
+    assert outputs[0][1][0].count(b"\n") == 4 * sum(1 for _, idx in reads if idx == indices[1])
+
+
+def test_fastq_split_index_mismatch(tmp_path):
+    i7, i5 = _index(SAMPLES[1]).split("+")
+    reads = [("read1", f"{i7[:-1]}N+{i5}"), ("read2", f"{i7}+{'T' if i5[0] != 'T' else 'A'}{i5[1:]}")]
+    r1, r2 = _write_pair(tmp_path, reads)
+
+    files_r1, _, _ = fastq_split(SAMPLES, tmp_path, (r1, r2), index_mismatches=0)
+    assert not files_r1
+
+    files_r1, _, _ = fastq_split(SAMPLES, tmp_path, (r1, r2), index_mismatches=1)
+    assert list(files_r1.keys()) == [1]
+    assert files_r1[1].read_text() == "".join(_record(name, 1, idx, "ACGTACGT") for name, idx in reads)
+
+
+def test_fastq_split_bgzf(tmp_path):
+    indices = [_index(SAMPLES[0]), _index(SAMPLES[1])]
+    reads = [(f"read{i}", indices[i % 2]) for i in range(500)]
+    r1, r2 = _write_pair(tmp_path, reads)
+
+    plain_dir, bgzf_dir = tmp_path / "plain", tmp_path / "bgzf"
+    plain_dir.mkdir()
+    bgzf_dir.mkdir()
+    plain_r1, plain_r2, _ = fastq_split(SAMPLES, plain_dir, (r1, r2), processes=2)
+    bgzf_r1, bgzf_r2, _ = fastq_split(SAMPLES, bgzf_dir, (r1, r2), processes=2, compression="bgzf")
+
+    for plain_files, bgzf_files in ((plain_r1, bgzf_r1), (plain_r2, bgzf_r2)):
+        assert plain_files.keys() == bgzf_files.keys()
+        for si, bgzf_file in bgzf_files.items():
+            assert bgzf_file.name.endswith(".fastq.gz")
+            with pysam.BGZFile(str(bgzf_file), "rb") as fh:
+                assert fh.read() == plain_files[si].read_bytes()
+
+
+def test_fastq_split_alongside_other_steps(tmp_path):
+    # Demultiplexing starts its process pool while another step's thread is busy taking locks (here, logging's), as
+    # happens when run_steps runs pipeline steps concurrently; pool workers must not inherit a held lock.
+    indices = [_index(SAMPLES[0]), _index(SAMPLES[1])]
+    reads = [(f"read{i}", indices[i % 2]) for i in range(200)]
+    r1, r2 = _write_pair(tmp_path, reads)
+    split_done = threading.Event()
+
+    def _split(threads: int):
+        try:
+            return fastq_split(SAMPLES, tmp_path, (r1, r2), processes=threads, compression="bgzf")
+        finally:
+            split_done.set()
+
+    def _busy(threads: int):
+        n = 0
+        while not split_done.is_set():
+            logger.debug("busy step still running (%d)", n)
+            n += 1
+
+    values, _ = run_steps(
+        [Step(name="split", call=_split, outputs=("split",), threads=2), Step(name="busy", call=_busy)], CpuBudget(3)
+    )
+
+    files_r1, _, manifest = values["split"]
+    assert set(files_r1) == {0, 1}
+    assert sum(stats.read_pairs for stats in manifest.samples.values()) == len(reads)
@@ -0,0 +1,64 @@
+import gzip
+import pysam
+
+from lougheed_gtseq.compression import bgzf_compress, BGZF_EOF
+from lougheed_gtseq.genome_cache import (
+    check_cached_files,
+    faidx_atomic,
+    read_manifest,
+    verify_cached_files,
+    write_manifest,
+)
+
+FASTA = b">c1\nACGTACGTAC\n>c2\nGGGGCCCC\n"
+
+
+def test_cached_files_manifest(tmp_path):
+    main_file = tmp_path / "ref.fa"
+    main_file.write_bytes(FASTA)
+    (tmp_path / "ref.fa.idx").write_bytes(b"index")
+
+    # No manifest: files are adopted as long as they are present
+    assert check_cached_files(main_file, (".idx",)) == {}
+    assert check_cached_files(main_file, (".idx", ".other")) == {tmp_path / "ref.fa.other": "missing"}
+
+    manifest = write_manifest(main_file, (".idx",), source_url="https://example.org/ref.fa")
+    assert read_manifest(main_file) == manifest
+    assert set(manifest.files) == {"ref.fa", "ref.fa.idx"}
+    assert check_cached_files(main_file, (".idx",), full=True) == {}
+
+    (tmp_path / "ref.fa.idx").write_bytes(b"INDEX")  # same size, different contents
+    assert check_cached_files(main_file, (".idx",)) == {}
+    assert check_cached_files(main_file, (".idx",), full=True) == {tmp_path / "ref.fa.idx": "checksum mismatch"}
+
+    (tmp_path / "ref.fa.idx").write_bytes(b"idx")
+    assert "size mismatch" in check_cached_files(main_file, (".idx",))[tmp_path / "ref.fa.idx"]
+
+
+def test_verify_cached_files_no_folder(tmp_path):
+    main_file = tmp_path / "genomes" / "ref.fa"
+    assert verify_cached_files(main_file, (".idx",)) == {
+        main_file: "missing",
+        tmp_path / "genomes" / "ref.fa.idx": "missing",
+    }
+    assert not main_file.parent.exists()
+
+
+def test_cached_files_truncated_bgzf(tmp_path):
+    main_file = tmp_path / "ref.fa.gz"
+    main_file.write_bytes(bgzf_compress(FASTA))
+    assert check_cached_files(main_file, ()) == {main_file: "truncated (no BGZF end-of-file marker)"}
+
+    main_file.write_bytes(bgzf_compress(FASTA) + BGZF_EOF)
+    assert check_cached_files(main_file, ()) == {}
+
+
+def test_faidx_atomic(tmp_path):
+    main_file = tmp_path / "ref.fa.gz"
+    main_file.write_bytes(bgzf_compress(FASTA) + BGZF_EOF)
+    assert gzip.decompress(main_file.read_bytes()) == FASTA
+
+    faidx_atomic(main_file)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["ref.fa.gz", "ref.fa.gz.fai", "ref.fa.gz.gzi"]
+    with pysam.FastaFile(str(main_file)) as fa:
+        assert fa.fetch("c2", 2, 6) == "GGCC"
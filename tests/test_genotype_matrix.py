@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from lougheed_gtseq.genotype_matrix import (
+    GT_MISSING,
+    _int_column,
+    read_genotype_matrix,
+    sigma_bounds,
+    write_masked_vcf,
+)
+
+VCF = (
+    "##fileformat=VCFv4.2\n"
+    "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\ts2\ts3\n"
+    "c1\t10\t.\tA\tG\t50\t.\t.\tGT:PL:DP:AD:GQ\t0/1:1,0,1:20:10,10:99\t1/1:9,3,0:4:0,4:10\t./.\n"
+    "c1\t20\t.\tC\tT\t50\t.\t.\tGT:DP:GQ\t0|0:30:.\t./.:.:.\t1/1:70000:50\n"
+)
+
+
+def test_read_genotype_matrix(tmp_path):
+    vcf = tmp_path / "in.vcf"
+    vcf.write_text(VCF)
+
+    gm = read_genotype_matrix(vcf)
+    assert gm.samples == ["s1", "s2", "s3"]
+    assert gm.n_sites == 2
+    assert gm.gt.tolist() == [[[0, 1], [1, 1], [GT_MISSING] * 2], [[0, 0], [GT_MISSING] * 2, [1, 1]]]
+    assert gm.dp.tolist() == [[20, 4, 0], [30, 0, 65535]]
+    assert gm.gq.tolist() == [[99, 10, 0], [0, 0, 50]]
+
+    assert gm.called(min_dp=5, min_gq=20).tolist() == [[True, False, False], [False, False, True]]
+    assert gm.heterozygous().tolist() == [[True, False, False], [False, False, False]]
+
+    out = tmp_path / "out.vcf"
+    write_masked_vcf(vcf, out, np.array([[False, True, False], [True, False, False]]))
+    lines = out.read_text().splitlines()
+    assert lines[2].split("\t")[9:] == ["0/1:1,0,1:20:10,10:99", "./.:9,3,0:4:0,4:10", "./."]
+    assert lines[3].split("\t")[9:] == ["./.:30:.", "./.:.:.", "1/1:70000:50"]
+
+
+def test_int_column():
+    assert _int_column(["12", ".", "70000", "0"]).tolist() == [12, 0, 65535, 0]
+    with pytest.raises(ValueError):
+        _int_column(["1.5"])  # not silently read as 105
+
+
+def test_sigma_bounds():
+    assert sigma_bounds(np.array([1.0, 3.0]), 2) == (0.0, 4.0)
@@ -0,0 +1,118 @@
+import numpy as np
+import pysam
+
+from lougheed_gtseq.genotyper import GENOTYPER_QUALITY_BINS, call_genotypes, genotype_likelihoods, genotype_panel
+
+
+def _counts(ref_q: list[int], alt_q: list[int]) -> np.ndarray:
+    counts = np.zeros((2, GENOTYPER_QUALITY_BINS), dtype=np.uint16)
+    np.add.at(counts, (0, ref_q), 1)
+    np.add.at(counts, (1, alt_q), 1)
+    return counts
+
+
+def test_genotype_likelihoods_and_calls():
+    counts = np.stack([_counts([30] * 10, []), _counts([30] * 5, [30] * 5), _counts([], [30] * 10), _counts([], [])])
+    pl = genotype_likelihoods(counts[None])
+
+    assert pl.shape == (1, 4, 3)
+    assert pl[0, 0].argmin() == 0 and pl[0, 1].argmin() == 1 and pl[0, 2].argmin() == 2
+    assert np.all(pl[0, 3] == 0)
+    assert pl[0, 0, 2] > pl[0, 0, 1] > 0  # hom-alt is less likely than het for a hom-ref sample
+
+    called = np.array([[True, True, True, False]])
+    genotypes, gq, qual = call_genotypes(pl, called)
+    assert genotypes.tolist() == [[0, 1, 2, -1]]
+    assert np.all(gq[called] > 20)
+    assert qual[0] > 100
+
+
+def test_genotype_panel_multi_sample_bam(tmp_path):
+    ref_seq = "ACGT" * 50
+    ref = tmp_path / "ref.fa"
+    ref.write_text(f">c1\n{ref_seq}\n")
+    pysam.faidx(str(ref))
+
+    allele_file = tmp_path / "panel.tsv"
+    allele_file.write_text("c1\t101\tA,G\nc1\t150\tC,T\n")
+
+    header = {
+        "HD": {"VN": "1.6", "SO": "coordinate"},
+        "SQ": [{"SN": "c1", "LN": len(ref_seq)}],
+        "RG": [{"ID": "a", "SM": "A"}, {"ID": "b", "SM": "B"}],
+    }
+    bam = tmp_path / "batch.bam"
+    with pysam.AlignmentFile(str(bam), "wb", header=header) as bf:
+        for i in range(20):
+            # Sample A is homozygous for the ALT allele at 101; sample B is het. Neither has reads at 150.
+            seq = list(ref_seq[80:130])
+            seq[20] = "G" if i < 10 or i % 2 else "A"
+            read = pysam.AlignedSegment(bf.header)
+            read.query_name = f"r{i}"
+            read.reference_id = 0
+            read.reference_start = 80
+            read.cigarstring = "50M"
+            read.mapping_quality = 60
+            read.query_sequence = "".join(seq)
+            read.query_qualities = pysam.qualitystring_to_array("I" * 50)
+            read.set_tag("RG", "a" if i < 10 else "b")
+            bf.write(read)
+    pysam.index(str(bam))
+
+    vcf = tmp_path / "out.vcf"
+    genotype_panel(ref, [bam], allele_file, vcf, processes=1)
+
+    with pysam.VariantFile(str(vcf)) as vf:
+        assert list(vf.header.samples) == ["A", "B"]
+        records = list(vf)
+
+    assert [(r.pos, r.alleles) for r in records] == [(101, ("A", "G"))]  # no reads at 150: not a variant site
+    a, b = records[0].samples.values()
+    assert a["GT"] == (1, 1) and a["AD"] == (0, 10) and a["DP"] == 10
+    assert b["GT"] == (0, 1) and b["AD"] == (5, 5)
+
+
+def test_genotype_panel_off_allele_sample(tmp_path):
+    ref_seq = "ACGT" * 50
+    ref = tmp_path / "ref.fa"
+    ref.write_text(f">c1\n{ref_seq}\n")
+    pysam.faidx(str(ref))
+
+    allele_file = tmp_path / "panel.tsv"
+    allele_file.write_text("c1\t101\tA,G\n")
+
+    # Samples R1-R3 are confidently homozygous REF, V homozygous ALT; X only has bases which are neither allele (T)
+    bases = {"R1": "A", "R2": "A", "R3": "A", "V": "G", "X": "T"}
+    header = {
+        "HD": {"VN": "1.6", "SO": "coordinate"},
+        "SQ": [{"SN": "c1", "LN": len(ref_seq)}],
+        "RG": [{"ID": s, "SM": s} for s in bases],
+    }
+    bam = tmp_path / "batch.bam"
+    with pysam.AlignmentFile(str(bam), "wb", header=header) as bf:
+        for sample, base in bases.items():
+            for i in range(10):
+                seq = list(ref_seq[80:130])
+                seq[20] = base
+                read = pysam.AlignedSegment(bf.header)
+                read.query_name = f"{sample}{i}"
+                read.reference_id = 0
+                read.reference_start = 80
+                read.cigarstring = "50M"
+                read.mapping_quality = 60
+                read.query_sequence = "".join(seq)
+                read.query_qualities = pysam.qualitystring_to_array("I" * 50)
+                read.set_tag("RG", sample)
+                bf.write(read)
+    pysam.index(str(bam))
+
+    vcf = tmp_path / "out.vcf"
+    genotype_panel(ref, [bam], allele_file, vcf, processes=1)
+
+    with pysam.VariantFile(str(vcf)) as vf:
+        (record,) = list(vf)
+
+    x = record.samples["X"]
+    assert x["GT"] == (None, None) and x["GQ"] is None and x["AD"] == (0, 0) and x["DP"] == 10
+    assert [record.samples[s]["GT"] for s in ("R1", "R2", "R3", "V")] == [(0, 0)] * 3 + [(1, 1)]
+    assert record.info["AN"] == 8
@@ -0,0 +1,49 @@
+import functools
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from lougheed_gtseq.compression import BGZF_EOF
+from lougheed_gtseq.journal import Journal, WorkUnit, atomic_path, run_units, unit_key, valid_bam
+
+
+def _write(path: Path, text: str):
+    with atomic_path(path) as tmp:
+        tmp.write_text(text)
+        if text == "fail":
+            raise ValueError(text)
+
+
+def test_valid_bam(tmp_path):
+    bam = tmp_path / "s.bam"
+    bam.write_bytes(b"BAM\1" + BGZF_EOF)
+    assert not valid_bam(bam)  # no index
+    (tmp_path / "s.bam.bai").touch()
+    assert valid_bam(bam)
+    bam.write_bytes(b"BAM\1" + BGZF_EOF[:-1])  # truncated
+    assert not valid_bam(bam)
+
+
+def test_journal(tmp_path):
+    outs = [tmp_path / f"{s}.txt" for s in "abc"]
+    units = [
+        WorkUnit(name=p.stem, key=unit_key(p.stem, 1), outputs=[p], run=functools.partial(_write, p, p.stem))
+        for p in outs
+    ]
+    units[2].run = functools.partial(_write, outs[2], "fail")
+
+    journal = Journal(tmp_path / "journal.jsonl")
+    with ThreadPoolExecutor(2) as executor, pytest.raises(ValueError):
+        run_units(units, journal, executor, "test")
+
+    # Failed units leave no partial output behind, while the others are recorded
+    assert [p.exists() for p in outs] == [True, True, False]
+    with open(tmp_path / "journal.jsonl", "a") as fh:
+        fh.write('{"unit": "c", "ke')  # torn line
+
+    journal = Journal(tmp_path / "journal.jsonl")
+    assert [journal.done(u) for u in units] == [True, True, False]
+
+    outs[0].write_text("changed")
+    assert not journal.done(units[0])
+    assert not journal.done(units[1].model_copy(update={"key": unit_key("b", 2)}))
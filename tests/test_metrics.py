@@ -0,0 +1,92 @@
+import json
+import pytest
+import subprocess
+import threading
+
+from lougheed_gtseq.metrics import (
+    METRICS_TABLE_COLUMNS,
+    MeasuredPopen,
+    measure_step,
+    measured_check_call,
+    metrics_table,
+    record_metrics,
+    record_throughput,
+    step_thread_pool,
+    write_run_metrics,
+)
+
+
+def test_metrics(tmp_path):
+    with record_metrics() as recorder:
+        with measure_step("write"):
+            with open(tmp_path / "out.bin", "wb") as fh:
+                measured_check_call(("head", "-c", "100000", "/dev/zero"), stdout=fh)
+            record_throughput("files_per_second", 2.0)
+
+        with measure_step("pipe"):
+            # Commands run from a step's thread pool are attributed to the step too
+            with step_thread_pool(max_workers=1) as executor:
+                p = executor.submit(MeasuredPopen, ("cat", str(tmp_path / "out.bin")), stdout=subprocess.PIPE).result()
+            assert len(p.stdout.read()) == 100000
+            p.stdout.close()
+            assert p.wait() == 0
+
+            with pytest.raises(subprocess.CalledProcessError):
+                measured_check_call(("false",))
+
+        measured_check_call(("true",))  # outside any step
+
+        metrics = recorder.report()
+
+    commands = {c.label: c for c in metrics.commands}
+    assert [(c.step, c.returncode) for c in commands.values()] == [("write", 0), ("pipe", 0), ("pipe", 1), (None, 0)]
+    assert commands["head"].write_bytes == 100000
+    assert commands["cat"].read_bytes >= 100000
+    assert commands["cat"].max_rss > 0
+
+    steps = {s.name: s for s in metrics.steps}
+    assert (steps["write"].commands, steps["pipe"].commands) == (1, 2)
+    assert steps["write"].throughput == {"files_per_second": 2.0}
+    assert steps["write"].concurrent_steps == []
+    assert metrics.write_bytes >= 100000
+
+    rows = metrics_table(metrics)
+    assert [(r["kind"], r["name"]) for r in rows] == [
+        ("step", "write"),
+        ("step", "pipe"),
+        ("command", "cat"),
+        ("command", "false"),
+        ("command", "head"),
+        ("command", "true"),
+        ("run", "total"),
+    ]
+
+    write_run_metrics(metrics, tmp_path)
+    assert len(json.loads((tmp_path / "metrics.json").read_text())["commands"]) == 4
+    assert (tmp_path / "metrics.tsv").read_text().splitlines()[0].split("\t") == list(METRICS_TABLE_COLUMNS)
+
+
+@pytest.mark.parametrize("have_waitid", [True, False])
+def test_measured_popen_wait(monkeypatch, have_waitid):
+    monkeypatch.setattr("lougheed_gtseq.metrics._HAVE_WAITID", have_waitid)  # e.g., macOS
+
+    with record_metrics() as recorder:
+        p = MeasuredPopen(("sleep", "10"))
+        with pytest.raises(subprocess.TimeoutExpired):
+            p.wait(timeout=0.05)
+        assert p.poll() is None
+
+        # Killing from another thread while wait() blocks; kill() polls without waiting for the waiting thread
+        threading.Timer(0.05, p.kill).start()
+        assert p.wait() == -9
+        assert p.poll() == -9
+
+        p = MeasuredPopen(("sh", "-c", "exit 3"))
+        assert p.wait(timeout=5) == 3
+
+        metrics = recorder.report()
+
+    assert [c.returncode for c in metrics.commands] == [-9, 3]
+    assert all(c.wall_time > 0 for c in metrics.commands)
+    if not have_waitid:
+        assert all(c.read_bytes is None for c in metrics.commands)
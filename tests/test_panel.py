@@ -0,0 +1,76 @@
+import io
+import pysam
+import pytest
+import shutil
+import subprocess
+
+from lougheed_gtseq.metrics import MeasuredPopen
+from lougheed_gtseq.panel import PanelIntervals, SamLiftover, load_panel_sites, panel_allele_file
+from lougheed_gtseq.steps.fastq_align import _sort_alignments
+
+
+def test_panel_intervals():
+    panel = PanelIntervals([("c1", 1100), ("c1", 1000), ("c1", 5000), ("c1", 1301), ("c2", 50)], window=100)
+    assert len(panel) == 3  # overlapping or adjacent c1 windows are merged
+    assert list(panel) == [("c1", 900, 1401), ("c1", 4900, 5100), ("c2", 1, 150)]
+
+
+def test_panel_write_bed(tmp_path):
+    panel = PanelIntervals([("c1", 1000), ("c1", 1100), ("c2", 50)], window=100)
+    panel.write_bed(tmp_path / "panel.bed")
+    assert (tmp_path / "panel.bed").read_text() == "c1\t899\t1200\nc2\t0\t150\n"
+
+
+@pytest.mark.skipif(shutil.which("samtools") is None, reason="requires samtools")
+def test_sort_alignments_panel_filter(tmp_path):
+    seq = "A" * 30
+    sam = tmp_path / "in.sam"
+    sam.write_text(
+        "@SQ\tSN:c1\tLN:10000\n@SQ\tSN:c2\tLN:10000\n"
+        f"r1\t99\tc1\t880\t60\t10S10M5D10M\t=\t950\t0\t{seq}\t*\n"  # reference span 880-904
+        f"r2\t99\tc1\t870\t60\t20M\t=\t950\t0\t{seq[:20]}\t*\n"  # reference span 870-889
+        "r3\t4\t*\t0\t0\t*\t*\t0\t0\tA\t*\n"
+        f"r4\t99\tc2\t1000\t60\t20M\t=\t950\t0\t{seq[:20]}\t*\n"
+        "r5\t137\tc1\t1000\t0\t*\t=\t1000\t0\tA\t*\n"  # unmapped, placed at its mate's position
+    )
+    bed = tmp_path / "panel.bed"
+    PanelIntervals([("c1", 1000)], window=100).write_bed(bed)
+
+    bam = tmp_path / "out.bam"
+    _sort_alignments(MeasuredPopen(("cat", str(sam)), stdout=subprocess.PIPE), bam, 1, bed, None)
+    with pysam.AlignmentFile(str(bam)) as bf:
+        assert [r.query_name for r in bf] == ["r1", "r5"]
+
+
+def test_panel_allele_file():
+    sites = load_panel_sites(panel_allele_file("polar"))
+    assert len(sites) > 300
+    assert sites[0] == ("NW_007907022.1", 5780671)
+
+
+def test_sam_liftover():
+    liftover = SamLiftover([("c1", 10000), ("c2", 5000)])
+    sam = (
+        b"@HD\tVN:1.6\n"
+        b"@SQ\tSN:c1_501_1500\tLN:1000\n"
+        b"@SQ\tSN:c1_3001_4000\tLN:1000\n"
+        b"@RG\tID:s1\tSM:s1\n"
+        b"r1\t99\tc1_501_1500\t10\t60\t20M\t=\t50\t60\tA\tF\tRG:Z:s1\tXA:Z:c1_3001_4000,+10,20M,1;\n"
+        b"r2\t65\tc1_501_1500\t10\t60\t20M\tc1_3001_4000\t20\t0\tA\tF\n"
+        b"r3\t4\t*\t0\t0\t*\t*\t0\t0\tA\tF\n"
+        b"r4\t97\tc1_501_1500\t10\t60\t20M\tc1_3001_4000\t20\t0\tA\tF\tMC:Z:5S10M2D5M\n"
+        b"r4\t145\tc1_3001_4000\t20\t60\t5S10M2D5M\tc1_501_1500\t10\t0\tA\tF\tMC:Z:20M\n"
+        b"r5\t97\tc1_501_1500\t10\t60\t20M\tc1_3001_4000\t20\t0\tA\tF\n"
+    )
+    assert list(liftover.lift_lines(io.BytesIO(sam))) == [
+        b"@HD\tVN:1.6\n",
+        b"@SQ\tSN:c1\tLN:10000\n@SQ\tSN:c2\tLN:5000\n",
+        b"@RG\tID:s1\tSM:s1\n",
+        b"r1\t99\tc1\t510\t60\t20M\t=\t550\t60\tA\tF\tRG:Z:s1\n",
+        # Mates on different amplicons of one genome contig: TLEN from 5' end to 5' end, as bwa computes it
+        b"r2\t65\tc1\t510\t60\t20M\t=\t3020\t2511\tA\tF\n",
+        b"r3\t4\t*\t0\t0\t*\t*\t0\t0\tA\tF\n",
+        b"r4\t97\tc1\t510\t60\t20M\t=\t3020\t2527\tA\tF\tMC:Z:5S10M2D5M\n",
+        b"r4\t145\tc1\t3020\t60\t5S10M2D5M\t=\t510\t-2527\tA\tF\tMC:Z:20M\n",
+        b"r5\t97\tc1\t510\t60\t20M\t=\t3020\t0\tA\tF\n",  # no MC tag: the reverse mate's end is unknown
+    ]
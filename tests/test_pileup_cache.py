@@ -0,0 +1,61 @@
+import pysam
+
+from lougheed_gtseq.pileup_cache import add_panel_alleles, bam_content_digest, cached_bam_digest, fill_missing_samples
+
+PANEL = {("c1", 500): ["G", "A"], ("c1", 600): ["T", "C"]}
+
+
+def test_add_panel_alleles():
+    lines = [
+        "##fileformat=VCFv4.2\n",
+        "c1\t500\t.\tG\t<*>\t0\t.\tDP=20;QS=1,0;MQ0F=0\tPL:DP:AD\t0,60,214:20:20,0\n",
+        "c1\t600\t.\tT\tC,<*>\t0\t.\tDP=20;QS=0.5,0.5,0\tPL:DP:AD\t161,0,161,191,191,255:20:10,10,0\n",
+        "c1\t700\t.\tA\t<*>\t0\t.\tDP=20;QS=1,0\tPL:DP:AD\t0,60,214:20:20,0\n",
+    ]
+    out = list(add_panel_alleles(lines, PANEL))
+    # The unseen panel ALT takes on the likelihoods of the <*> (any other allele) placeholder
+    assert out[1] == "c1\t500\t.\tG\tA,<*>\t0\t.\tDP=20;QS=1,0,0;MQ0F=0\tPL:DP:AD\t0,60,214,60,214,214:20:20,0,0\n"
+    assert out[0] == lines[0]
+    assert out[2:] == lines[2:]
+
+
+def test_fill_missing_samples():
+    lines = [
+        "##fileformat=VCFv4.2\n",
+        "c1\t500\t.\tG\tA,<*>\t0\t.\tDP=20\tPL:DP:AD\t0,60,214,60,214,214:20:20,0,0\t.:.:.\t.\n",
+    ]
+    out = list(fill_missing_samples(lines))
+    assert out[0] == lines[0]
+    assert out[1] == (
+        "c1\t500\t.\tG\tA,<*>\t0\t.\tDP=20\tPL:DP:AD\t0,60,214,60,214,214:20:20,0,0"
+        "\t0,0,0,0,0,0:0:0,0,0\t0,0,0,0,0,0:0:0,0,0\n"
+    )
+
+
+def test_bam_content_digest(tmp_path):
+    def _write(path, pg_cl: str, seq: str):
+        header = {"HD": {"VN": "1.6"}, "SQ": [{"SN": "c1", "LN": 1000}], "PG": [{"ID": "bwa", "CL": pg_cl}]}
+        with pysam.AlignmentFile(str(path), "wb", header=header) as fh:
+            read = pysam.AlignedSegment(fh.header)
+            read.query_name = "r1"
+            read.query_sequence = seq
+            read.reference_id = 0
+            read.reference_start = 10
+            read.cigarstring = f"{len(seq)}M"
+            fh.write(read)
+
+    _write(tmp_path / "a.bam", "bwa mem run_1/a.fq", "ACGT")
+    _write(tmp_path / "b.bam", "bwa mem run_2/a.fq", "ACGT")
+    _write(tmp_path / "c.bam", "bwa mem run_2/a.fq", "ACGA")
+
+    assert bam_content_digest(tmp_path / "a.bam") == bam_content_digest(tmp_path / "b.bam")
+    assert bam_content_digest(tmp_path / "a.bam") != bam_content_digest(tmp_path / "c.bam")
+
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    assert cached_bam_digest(tmp_path / "a.bam", cache_dir) == bam_content_digest(tmp_path / "a.bam")
+    assert len(list((cache_dir / "digests").iterdir())) == 1
+
+    # A changed BAM has a new file fingerprint, so it is checksummed again
+    _write(tmp_path / "a.bam", "bwa mem run_1/a.fq", "ACGA")
+    assert cached_bam_digest(tmp_path / "a.bam", cache_dir) == bam_content_digest(tmp_path / "c.bam")
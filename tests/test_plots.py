@@ -0,0 +1,17 @@
+import numpy as np
+
+from lougheed_gtseq.plots import histogram, render_plots, wait_for_plots
+
+
+def test_render_plots(tmp_path, capsys):
+    h = histogram(np.array([0.1, 0.2, 0.2, 0.9]), 4, title="t", x_label="x", y_label="y", png=tmp_path / "h.png")
+    assert h.counts == [3, 0, 0, 1]
+
+    render_plots([h], "none")
+    render_plots([h], "terminal")
+    assert not (tmp_path / "h.png").exists()
+    assert capsys.readouterr().out.strip()
+
+    render_plots([h], "png")
+    wait_for_plots()
+    assert (tmp_path / "h.png").stat().st_size > 0
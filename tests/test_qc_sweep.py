@@ -0,0 +1,54 @@
+import numpy as np
+
+from lougheed_gtseq.genotype_matrix import GenotypeMatrix, genotype_matrix_cache_path, load_genotype_matrix
+from lougheed_gtseq.qc_sweep import called_counts, sweep_qc
+
+
+def _random_matrix(n_sites: int, n_samples: int) -> GenotypeMatrix:
+    rng = np.random.default_rng(1)
+    return GenotypeMatrix(
+        samples=[f"s{i}" for i in range(n_samples - 1)] + ["control"],
+        gt=rng.integers(-1, 2, size=(n_sites, n_samples, 2), dtype=np.int8),
+        dp=rng.integers(0, 40, size=(n_sites, n_samples), dtype=np.uint16),
+        gq=rng.integers(0, 60, size=(n_sites, n_samples), dtype=np.uint16),
+    )
+
+
+def test_called_counts():
+    gm = _random_matrix(50, 20)
+    samples = np.ones(20, dtype=bool)
+    min_dps, min_gqs = np.array([0, 5, 20]), np.array([0, 18, 30])
+
+    n_called, n_het = called_counts(gm, samples, min_dps, min_gqs)
+    for di, min_dp in enumerate(min_dps):
+        for gi, min_gq in enumerate(min_gqs):
+            called = gm.called(min_dp, min_gq)
+            assert n_called[di, gi].tolist() == called.sum(axis=0).tolist()
+            assert n_het[di, gi].tolist() == (called & gm.heterozygous()).sum(axis=0).tolist()
+
+
+def test_sweep_qc():
+    gm = _random_matrix(50, 20)
+    rows = sweep_qc(gm, [10, 0], [18], [0.0, 0.9], [2])
+
+    assert [(r["min_dp"], r["min_called_prop"]) for r in rows] == [(0, 0.0), (0, 0.9), (10, 0.0), (10, 0.9)]
+    assert all(r["samples"] == 19 for r in rows)  # the control sample is excluded
+    assert rows[1]["failed_prop_called"] == 19  # random genotypes are far from 90% called
+
+    r = rows[0]
+    assert r["failed_prop_called"] == 0
+    assert r["passed"] == 19 - r["failed_heterozygosity"]
+    assert np.isclose(r["het_ub"] - r["het_mean"], 2 * r["het_sd"])
+
+
+def test_load_genotype_matrix_cache(tmp_path):
+    vcf = tmp_path / "in.vcf"
+    vcf.write_text("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\nc1\t1\t.\tA\tG\t.\t.\t.\tGT:DP\t0/1:5\n")
+
+    gm = load_genotype_matrix(vcf)
+    assert genotype_matrix_cache_path(vcf).exists()
+    cached = load_genotype_matrix(vcf)
+    assert cached.samples == gm.samples and np.array_equal(cached.dp, gm.dp)
+
+    vcf.write_text(vcf.read_text().replace("0/1:5", "1/1:17"))
+    assert load_genotype_matrix(vcf).dp.tolist() == [[17]]  # changed VCF: cache is re-built
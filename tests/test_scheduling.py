@@ -0,0 +1,148 @@
+import pytest
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from lougheed_gtseq.scheduling import CpuBudget, Step, plan_threads, run_steps
+from lougheed_gtseq.step_cache import StepCache
+
+
+def test_plan_threads():
+    assert plan_threads({0: 0, 1: 10, 2: 250, 3: 10000}, 8, 100) == {0: 1, 1: 1, 2: 3, 3: 8}
+
+
+def test_cpu_budget_limit():
+    budget = CpuBudget(4)
+    lock = threading.Lock()
+    in_use = []
+    current = 0
+
+    def _job(n: int):
+        nonlocal current
+        with budget.reserve(n) as reserved:
+            with lock:
+                current += reserved
+                in_use.append(current)
+            time.sleep(0.01)
+            with lock:
+                current -= reserved
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(_job, [3, 1, 2, 6, 1, 1, 2, 4]))
+
+    assert max(in_use) <= 4
+    assert current == 0
+
+
+def test_run_steps(tmp_path):
+    calls = []
+
+    def _sleep(name: str, seconds: float, res=None):
+        def _call(threads: int, **kwargs):
+            calls.append((name, threads, kwargs))
+            time.sleep(seconds)
+            return res
+
+        return _call
+
+    steps = [
+        Step(name="a", call=_sleep("a", 0.05, (1, 2)), outputs=("x", "y"), threads=2, cache=True),
+        Step(name="b", call=_sleep("b", 0.2, 3), inputs=("x",), outputs=("z",), threads=2),
+        Step(name="c", call=_sleep("c", 0.05), inputs=("y",), threads=2),  # runs alongside b
+        Step(name="d", call=_sleep("d", 0.0), after=("c",), only_if=False, outputs=("w",)),
+        Step(name="e", call=_sleep("e", 0.0), inputs=("z", "w"), threads=0),
+    ]
+
+    values, report = run_steps(steps, CpuBudget(4), StepCache(tmp_path))
+    assert values == {"x": 1, "y": 2, "z": 3, "w": None}
+    assert sorted(calls) == [("a", 2, {}), ("b", 2, {"x": 1}), ("c", 2, {"y": 2}), ("e", 0, {"z": 3, "w": None})]
+    assert report.critical_path == ["a", "b", "e"]
+    assert report.wall_time < report.step_time
+    assert {t.name: t.status for t in report.steps}["d"] == "skipped"
+
+    # Cached steps are re-used
+    calls.clear()
+    values, report = run_steps(steps, CpuBudget(4), StepCache(tmp_path))
+    assert values["x"] == 1 and "a" not in [c[0] for c in calls]
+
+    with pytest.raises(ValueError):
+        run_steps([Step(name="f", call=_sleep("f", 0), inputs=("g",), outputs=("h",))], CpuBudget(1))
+    with pytest.raises(ValueError):
+        run_steps(
+            [Step(name="f", call=_sleep("f", 0), after=("g",)), Step(name="g", call=_sleep("g", 0), after=("f",))],
+            CpuBudget(1),
+        )
+
+
+def test_run_steps_priority():
+    granted = {}
+
+    def _sleep(name: str, seconds: float):
+        def _call(threads: int, **kwargs):
+            granted[name] = threads
+            time.sleep(seconds)
+
+        return _call
+
+    # A low-priority step which becomes ready first leaves the high-priority step its guaranteed share
+    steps = [
+        Step(name="dep", call=_sleep("dep", 0.05), outputs=("x",), threads=0),
+        Step(name="heavy", call=_sleep("heavy", 0.05), inputs=("x",), threads=4, min_threads=3),
+        Step(name="side", call=_sleep("side", 0.2), threads=4, min_threads=1),
+    ]
+    run_steps(steps, CpuBudget(4))
+    assert granted == {"dep": 0, "heavy": 3, "side": 1}
+
+    # Steps wait for their minimum number of threads, and the critical path follows waits for threads
+    steps = [
+        Step(name="a", call=_sleep("a", 0.05), threads=2),
+        Step(name="b", call=_sleep("b", 0.05), threads=2),
+    ]
+    _, report = run_steps(steps, CpuBudget(2))
+    assert granted["b"] == 2
+    assert {t.name: t.blocked_by for t in report.steps} == {"a": None, "b": "a"}
+    assert report.critical_path == ["a", "b"]
+
+
+def test_run_steps_modifies(tmp_path):
+    vcf = tmp_path / "out.vcf"
+    calls = []
+
+    def _call_alleles(threads: int):
+        calls.append("call")
+        vcf.write_text("S1\tS2\n")
+
+    def _reheader(threads: int):
+        calls.append("reheader")
+        vcf.write_text(vcf.read_text().lower())
+
+    steps = [
+        Step(name="call", call=_call_alleles, cache=True, output_files=(vcf,)),
+        Step(name="reheader", call=_reheader, after=("call",), cache=True, key_files=(vcf,), modifies=(vcf,)),
+    ]
+    run_steps(steps, CpuBudget(1), StepCache(tmp_path / "cache"))
+
+    # The VCF changed in place after it was called, but by a step declaring it; both steps are re-used
+    run_steps(steps, CpuBudget(1), StepCache(tmp_path / "cache"))
+    assert calls == ["call", "reheader"]
+
+    # A VCF overwritten by anything else is called again
+    vcf.write_text("other\n")
+    run_steps(steps, CpuBudget(1), StepCache(tmp_path / "cache"))
+    assert calls == ["call", "reheader", "call", "reheader"]
+
+
+def test_run_steps_cache_lookup_once(tmp_path, monkeypatch):
+    cache = StepCache(tmp_path)
+    n_keys = []
+    key = cache.key
+    monkeypatch.setattr(cache, "key", lambda *args: n_keys.append(args[0]) or key(*args))
+
+    # b is ready at once, but waits for a's threads; its key is only computed once (plus once more, after it ran)
+    steps = [
+        Step(name="a", call=lambda threads: time.sleep(0.1), threads=1),
+        Step(name="b", call=lambda threads: None, threads=1, cache=True),
+    ]
+    run_steps(steps, CpuBudget(1), cache)
+    assert n_keys == ["b", "b"]
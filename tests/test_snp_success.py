@@ -0,0 +1,48 @@
+import csv
+import pysam
+
+from lougheed_gtseq.snp_success import SNP_SUCCESS_COLUMNS, run_snp_success, snp_success_tasks
+
+VCF = (
+    "##fileformat=VCFv4.2\n"
+    "##contig=<ID=c1>\n"
+    "##contig=<ID=c2>\n"
+    '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n'
+    '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Depth">\n'
+    '##FORMAT=<ID=GQ,Number=1,Type=Integer,Description="Genotype quality">\n'
+    "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\ts2\ts3\ts4\n"
+    "c1\t10\tsnp1\tA\tG\t50\t.\t.\tGT:DP:GQ\t0/1:20:99\t1/1:4:10\t./.:.:.\t0/0:6:20\n"
+    "c2\t20\t.\tC\tT\t50\t.\t.\tGT:DP:GQ\t./.:.:.\t./.:.:.\t./.:.:.\t./.:.:.\n"
+)
+
+
+def test_snp_success(tmp_path):
+    vcf = tmp_path / "batch1.vcf"
+    vcf.write_text(VCF)
+    pysam.tabix_index(str(vcf), preset="vcf", keep_original=True)
+    vcf_gz = tmp_path / "batch1.vcf.gz"
+
+    assert snp_success_tasks([vcf, vcf_gz], processes=4) == [(vcf, None), (vcf_gz, ["c1"]), (vcf_gz, ["c2"])]
+
+    out = tmp_path / "snp_success.tsv"
+    run_snp_success([vcf, vcf_gz], out=out, processes=2, plots="none")
+
+    with open(out) as fh:
+        rows = list(csv.DictReader(fh, delimiter="\t"))
+
+    assert tuple(rows[0].keys()) == SNP_SUCCESS_COLUMNS
+    assert [(r["vcf"], r["contig"], r["pos"]) for r in rows] == [
+        (str(vcf), "c1", "10"),
+        (str(vcf), "c2", "20"),
+        (str(vcf_gz), "c1", "10"),
+        (str(vcf_gz), "c2", "20"),
+    ]
+    assert rows[0] == rows[2] | {"vcf": str(vcf)}
+    assert (rows[0]["id"], rows[0]["called"], rows[0]["call_rate"]) == ("snp1", "3", "0.7500")
+    assert (rows[0]["mean_dp"], rows[0]["mean_gq"], rows[0]["alt_af"], rows[0]["het_rate"]) == (
+        "7.5000",
+        "43.0000",
+        "0.5000",
+        "0.3333",
+    )
+    assert (rows[1]["called"], rows[1]["call_rate"], rows[1]["mean_gq"]) == ("0", "0.0000", "nan")
@@ -0,0 +1,63 @@
+import os
+
+from lougheed_gtseq.models import Sample
+from lougheed_gtseq.step_cache import StepCache
+
+
+def test_step_cache(tmp_path):
+    cache = StepCache(tmp_path / "cache")
+
+    vcf = tmp_path / "in.vcf"
+    vcf.write_text("v1")
+    out = tmp_path / "out.txt"
+    out.write_text("result")
+    samples = [Sample(sample_id="A", batch="TEST", plate=1, i7=1, i5="A01")]
+
+    key = cache.key("qc", {"min_dp": 10, "vcf": vcf}, {"samples": samples}, (vcf,))
+    assert cache.get(key) == (False, None)
+
+    cache.put([key], {"out": out})
+    assert cache.get(key) == (True, {"out": out})
+    assert cache.key("qc", {"min_dp": 10, "vcf": vcf}, {"samples": samples}, (vcf,)) == key
+
+    # Parameters, input values and input files are all part of the key
+    assert cache.key("qc", {"min_dp": 11, "vcf": vcf}, {"samples": samples}, (vcf,)) != key
+    samples_b = [samples[0].model_copy(update={"sample_id": "B"})]
+    assert cache.key("qc", {"min_dp": 10, "vcf": vcf}, {"samples": samples_b}, (vcf,)) != key
+    vcf.write_text("v2!")
+    assert cache.key("qc", {"min_dp": 10, "vcf": vcf}, {"samples": samples}, (vcf,)) != key
+
+    # Directory input values are fingerprinted by their contents
+    (tmp_path / "split").mkdir()
+    (tmp_path / "split" / "a.fastq").write_text("@r\nACGT\n+\nIIII\n")
+    dir_key = cache.key("align", {}, {"split_dir": tmp_path / "split"}, ())
+    (tmp_path / "split" / "b.fastq").write_text("@r\nACGT\n+\nIIII\n")
+    assert cache.key("align", {}, {"split_dir": tmp_path / "split"}, ()) != dir_key
+
+    # Entries whose result files have changed are stale
+    st = out.stat()
+    os.utime(out, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000))
+    assert cache.get(key) == (False, None)
+
+    # ... as are entries whose output files were overwritten, unless their new state was recorded with refresh_output
+    out_vcf = tmp_path / "out.vcf"
+    out_vcf.write_text("called")
+    cache.put([key], None, (out_vcf,))
+    assert cache.get(key) == (True, None)
+    out_vcf.write_text("other run")
+    assert cache.get(key) == (False, None)
+    cache.refresh_output([key], out_vcf)
+    assert cache.get(key) == (True, None)
+
+
+def test_step_cache_content_hash(tmp_path):
+    cache = StepCache(tmp_path / "cache", content_hash=True)
+
+    a, b = tmp_path / "a.fastq", tmp_path / "b.fastq"
+    a.write_text("@r\nACGT\n+\nIIII\n")
+    b.write_text("@r\nACGT\n+\nIIII\n")
+
+    # Copies of a file have the same fingerprint when hashing contents
+    assert cache.key("split", {}, {"fastq": a}, ()) == cache.key("split", {}, {"fastq": b}, ())
+    b.write_text("@r\nACGA\n+\nIIII\n")
+    assert cache.key("split", {}, {"fastq": a}, ()) != cache.key("split", {}, {"fastq": b}, ())
@@ -0,0 +1,27 @@
+import threading
+import time
+from contextlib import closing
+
+from lougheed_gtseq.utils import prefetch
+
+
+def test_prefetch():
+    assert list(prefetch(range(10), max_ahead=2)) == list(range(10))
+
+
+def test_prefetch_consumer_stops_early():
+    produced = []
+
+    def _items():
+        for i in range(100):
+            produced.append(i)
+            yield i
+
+    n_threads = threading.active_count()
+    with closing(prefetch(_items(), max_ahead=2)) as items:
+        assert next(items) == 0
+        time.sleep(0.05)
+
+    # The producer, blocked on the full queue, stops once the consumer is gone
+    assert threading.active_count() == n_threads
+    assert len(produced) <= 4